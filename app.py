@@ -1,10 +1,29 @@
 import os
 import json
 import time
+import mimetypes
+import hashlib
+import socket
+import asyncio
 import threading
-from flask import Flask, render_template, request, jsonify, send_from_directory, abort, session
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from flask import Flask, Response, render_template, request, jsonify, abort, session
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 import video_downloader
+import postprocess
+import ytdl_pool
+import metrics
+import metadata_cache
+import file_serving
+import bandwidth
+import storage
+from job_scheduler import JobScheduler, QueueFull
+from progress import ProgressBroker
+from catalog import Catalog, is_catalog_file
+from job_store import create_job_store, new_job_id
+from async_engine import AsyncEngine
 
 # Configure app
 app = Flask(__name__)
@@ -14,8 +33,238 @@ app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 DOWNLOAD_DIR = "./downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-# Store active downloads
-active_downloads = {}
+# Download job state, shared between worker processes (see JOB_STORE_URL)
+job_store = create_job_store()
+
+# Index of finished files in the download directory
+download_catalog = Catalog(DOWNLOAD_DIR)
+
+# Storage quota; eviction takes the least recently used files from the catalog
+storage.default_manager.catalog = download_catalog
+
+# Largest page /api/downloads returns
+MAX_PER_PAGE = 500
+
+# Bounded worker pool that runs queued downloads
+scheduler = JobScheduler()
+
+# "threads" runs downloads on the scheduler; "asyncio" runs them as coroutines
+# on one event loop thread, for many concurrent slow downloads
+DOWNLOAD_ENGINE = os.environ.get("DOWNLOAD_ENGINE", "threads")
+async_engine = AsyncEngine() if DOWNLOAD_ENGINE == "asyncio" else None
+
+# Start youtube-dl worker processes as soon as a web worker starts, not on first use
+YTDL_PREWARM = os.environ.get("YTDL_PREWARM", "0") == "1"
+
+# Process whose background threads are running; a forked worker starts its own
+background_pid = None
+background_lock = threading.Lock()
+
+# Job store key of this worker process, which owns the jobs it queues
+worker_id = None
+worker_pid = None
+worker_lock = threading.Lock()
+
+# Seconds between a worker process's heartbeats in the job store
+WORKER_HEARTBEAT_INTERVAL = 10
+
+# Seconds without a heartbeat after which a worker's unfinished jobs are orphans
+WORKER_TIMEOUT = 60
+
+# Seconds a finished job's status stays available before it is removed
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 86400))
+
+# Most finished jobs kept; the oldest are removed first
+JOB_RETENTION_COUNT = int(os.environ.get("JOB_RETENTION_COUNT", 1000))
+
+# Seconds between sweeps for orphaned and expired jobs
+JOB_SWEEP_INTERVAL = 60
+
+# Job store record whose version changes when the /api/downloads listing does
+LISTING_KEY = "meta:listing"
+
+# Wakes event streams for downloads running in this process
+progress_broker = ProgressBroker()
+
+# Seconds between job store checks for downloads running in other processes
+JOB_POLL_INTERVAL = 1.0
+
+# Seconds an event stream stays open before the client is told to reconnect, so
+# streams don't hold a server thread for the whole of a long download
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "300"))
+
+# Statuses after which a download no longer changes
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+# Job fields shown by /api/downloads; other updates leave its ETag alone
+LISTED_FIELDS = {"status", "title", "file_path"}
+
+# Extracts batch entries ahead of their downloads so workers find the info cached
+batch_prefetcher = ThreadPoolExecutor(max_workers=video_downloader.BATCH_EXTRACT_AHEAD,
+                                      thread_name_prefix="batch-extract")
+
+# Largest number of URLs one /api/batch request may submit
+MAX_BATCH_URLS = 1000
+
+# Job store key of bandwidth limits set through /api/bandwidth, shared by all workers
+BANDWIDTH_SETTINGS_KEY = "settings:bandwidth"
+
+# Seconds a stream waits for more bytes of an in-progress download
+STREAM_WAIT_TIMEOUT = 30
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def start_background():
+    """Start the download workers, event loop, catalog reconciler and evictor in this process
+    
+    Importing the app starts no threads, so gunicorn --preload can fork
+    workers from a master that never ran one. Each worker starts its own
+    from gunicorn.conf.py's post_fork, or at the latest on its first request.
+    """
+    global background_pid
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+        scheduler.start()
+        if async_engine is not None:
+            async_engine.start()
+        download_catalog.start_reconciler()
+        storage.default_manager.start_evictor()
+        current_worker()
+        for target, name in ((run_worker_heartbeat, "worker-heartbeat"),
+                             (run_job_sweeper, "job-sweeper")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        if YTDL_PREWARM:
+            thread = threading.Thread(target=ytdl_pool.default_pool.warm, name="ytdl-prewarm")
+            thread.daemon = True
+            thread.start()
+
+def warmup():
+    """Load what workers would otherwise load on their first requests
+    
+    Meant for the gunicorn master under --preload (see gunicorn.conf.py), so
+    forked workers share it copy-on-write. Starts no threads or processes.
+    """
+    video_downloader.load_ffmpeg()
+    ytdl_pool.available()
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+
+def current_worker():
+    """This process's worker ID, registering it in the job store on first use"""
+    global worker_id, worker_pid
+    with worker_lock:
+        if worker_pid != os.getpid():
+            worker_id = "worker:" + new_job_id()
+            worker_pid = os.getpid()
+            job_store.create(worker_id, {"type": "worker", "host": socket.gethostname(),
+                                         "pid": worker_pid, "heartbeat": time.time()})
+        return worker_id
+
+def run_worker_heartbeat():
+    """Keep this process's worker record fresh so its jobs aren't taken for orphans"""
+    while True:
+        time.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            key = current_worker()
+            if job_store.update(key, heartbeat=time.time()) is None:
+                # Removed by a worker that took this one for dead
+                job_store.create_if_absent(key, {"type": "worker", "host": socket.gethostname(),
+                                                 "pid": os.getpid(), "heartbeat": time.time()})
+        except Exception as e:
+            app.logger.error(f"Worker heartbeat failed: {e}")
+
+def worker_alive(owner):
+    """Whether the worker process that queued a job is still running"""
+    if owner is None:
+        # Jobs from before owners were recorded
+        return False
+    if owner == worker_id and worker_pid == os.getpid():
+        return True
+    _, worker = job_store.get(owner)
+    if worker is None or time.time() - worker["heartbeat"] > WORKER_TIMEOUT:
+        return False
+    if worker["host"] == socket.gethostname():
+        # A restarted worker is noticed before its heartbeat runs out
+        try:
+            os.kill(worker["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return True
+
+def job_orphaned(state):
+    """Whether an unfinished job was left behind by a worker process that stopped"""
+    return state["status"] not in FINISHED_STATUSES and not worker_alive(state.get("owner"))
+
+def fail_orphaned_job(download_id):
+    update_download(download_id, status="failed",
+                    error="The worker process running this download stopped")
+
+def sweep_jobs():
+    """Fail orphaned jobs and remove finished jobs past their retention"""
+    now = time.time()
+    finished = []
+    expired = []
+    batches = []
+    jobs = set()
+    for key, state in job_store.list():
+        kind = state.get("type")
+        if kind == "worker":
+            if key != worker_id and now - state["heartbeat"] > WORKER_TIMEOUT:
+                expired.append(key)
+        elif kind == "batch":
+            if state["status"] != "expanding":
+                batches.append((key, state["job_ids"]))
+        elif kind is None:
+            jobs.add(key)
+            if job_orphaned(state):
+                app.logger.warning(f"Download {key} was orphaned by a stopped worker process")
+                fail_orphaned_job(key)
+            elif state["status"] in FINISHED_STATUSES:
+                # Jobs from before finished_at was recorded count as the oldest
+                finished.append((state.get("finished_at", 0), key))
+    finished.sort(reverse=True)
+    for index, (finished_at, key) in enumerate(finished):
+        if index >= JOB_RETENTION_COUNT or now - finished_at > JOB_RETENTION:
+            expired.append(key)
+            jobs.discard(key)
+    # A batch goes once none of its jobs are left
+    expired.extend(key for key, job_ids in batches if jobs.isdisjoint(job_ids))
+    for key in expired:
+        job_store.delete(key)
+    if expired:
+        touch_listing()
+    # Broker entries of jobs that are gone, such as ones updated after they finished
+    removed = set(expired)
+    for job_id in progress_broker.job_ids():
+        if job_id in removed or job_store.get(job_id)[1] is None:
+            progress_broker.discard(job_id)
+    return len(expired)
+
+def run_job_sweeper():
+    """Sweep jobs when the worker starts, then every JOB_SWEEP_INTERVAL seconds"""
+    while True:
+        try:
+            removed = sweep_jobs()
+            if removed:
+                app.logger.info(f"Removed {removed} expired jobs and worker records")
+        except Exception as e:
+            app.logger.error(f"Job sweep failed: {e}")
+        time.sleep(JOB_SWEEP_INTERVAL)
+
+def touch_listing():
+    """Change the /api/downloads ETag after a change the listing shows"""
+    if job_store.update(LISTING_KEY, changed_at=time.time()) is None:
+        job_store.create_if_absent(LISTING_KEY, {"type": "listing", "changed_at": time.time()})
+
+@app.before_request
+def ensure_background():
+    if background_pid != os.getpid():
+        start_background()
 
 @app.route('/')
 def index():
@@ -30,110 +279,721 @@ def download_video():
     if not video_url:
         return jsonify({"error": "No URL provided"}), 400
     
+    try:
+        priority = int(request.form.get('priority', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid priority"}), 400
+    
+    # Optional per-job profiling for diagnosing slow jobs
+    profile = request.form.get('profile') or None
+    if profile is not None:
+        if not metrics.JOB_PROFILING:
+            return jsonify({"error": "Profiling is disabled (set JOB_PROFILING=1)"}), 400
+        if profile not in metrics.PROFILE_MODES:
+            return jsonify({"error": f"profile must be one of {', '.join(metrics.PROFILE_MODES)}"}), 400
+    
+    # Weight against other jobs under BANDWIDTH_LIMIT, and an optional cap in bytes per second
+    try:
+        weight = float(request.form.get('weight', 1))
+        max_rate = int(request.form.get('max_rate', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid weight or max_rate"}), 400
+    if weight <= 0 or max_rate < 0:
+        return jsonify({"error": "weight must be positive and max_rate not negative"}), 400
+    
+    try:
+        download_id, attached = start_download(video_url, priority, profile=profile,
+                                               weight=weight, max_rate=max_rate)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    
+    return jsonify({
+        "success": True,
+        "download_id": download_id,
+        "attached": attached,
+        "message": "Attached to a download already in progress" if attached else "Download queued",
+        "queue_position": scheduler.queue_position(download_id)
+    })
+
+def inflight_key(video_url):
+    """Job store key that maps a video URL to its unfinished job"""
+    normalized = metadata_cache.normalize_url(video_url)
+    return "inflight:" + hashlib.sha1(normalized.encode()).hexdigest()
+
+def attach_inflight(video_url, download_id):
+    """Register download_id as the job for video_url; returns the ID to use
+    
+    If another unfinished job already holds the URL, in this process or
+    another worker process, that job's ID is returned instead. A job whose
+    worker process stopped is marked failed and the URL taken over.
+    """
+    key = inflight_key(video_url)
+    while True:
+        if job_store.create_if_absent(key, {"type": "inflight", "job_id": download_id}):
+            return download_id
+        version, alias = job_store.get(key)
+        if alias is None:
+            continue
+        _, state = job_store.get(alias["job_id"])
+        if state is not None and job_orphaned(state):
+            fail_orphaned_job(alias["job_id"])
+        elif (state is not None and state["status"] not in FINISHED_STATUSES
+                and not state.get("cancel_requested")):
+            return alias["job_id"]
+        # Drop the stale entry, unless another worker has replaced it meanwhile
+        job_store.delete_if(key, version)
+
+def release_inflight(video_url, download_id):
+    """Drop the URL's in-flight entry if it still points at download_id"""
+    key = inflight_key(video_url)
+    version, alias = job_store.get(key)
+    if alias is not None and alias.get("job_id") == download_id:
+        job_store.delete_if(key, version)
+
+def start_download(video_url, priority=0, batch_id=None, profile=None, weight=1.0, max_rate=0):
+    """Create a download job and queue it; returns (ID, attached)
+    
+    A URL that already has an unfinished job isn't downloaded twice: the
+    existing job's ID is returned with attached True. Raises QueueFull,
+    without leaving a job behind, if the queue is full.
+    """
     # Generate a download ID
-    download_id = str(int(time.time()))
+    download_id = new_job_id()
     
     # Initialize download status
-    active_downloads[download_id] = {
-        "status": "initializing",
+    job_store.create(download_id, {
+        "status": "queued",
         "progress": 0,
         "title": None,
         "url": video_url,
         "file_path": None,
+        "error": None,
+        "batch_id": batch_id,
+        "profile": profile,
+        "bandwidth": {"weight": weight, "limit": max_rate},
+        "owner": current_worker()
+    })
+    
+    existing_id = attach_inflight(video_url, download_id)
+    if existing_id != download_id:
+        job_store.delete(download_id)
+        return existing_id, True
+    
+    # Queue the download on the scheduler or the event loop
+    try:
+        if async_engine is not None:
+            async_engine.submit(download_id, process_download_async,
+                                args=(download_id, video_url))
+        else:
+            scheduler.submit(
+                download_id,
+                process_download,
+                args=(download_id, video_url),
+                host=urlparse(video_url).netloc.lower(),
+                priority=priority
+            )
+    except QueueFull:
+        release_inflight(video_url, download_id)
+        job_store.delete(download_id)
+        raise
+    touch_listing()
+    return download_id, False
+
+@app.route('/api/batch', methods=['POST'])
+def download_batch():
+    """API endpoint to download a list of videos and playlists
+    
+    Takes a JSON body {"urls": [...], "priority": 0} or form fields with one
+    URL per line. Playlists are expanded and duplicates dropped in the
+    background; the returned batch ID reports their combined progress.
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+    if urls is None:
+        urls = request.form.get('urls', '').splitlines()
+    if not isinstance(urls, list):
+        return jsonify({"error": "urls must be a list"}), 400
+    urls = [url.strip() for url in urls if isinstance(url, str) and url.strip()]
+    
+    if not urls:
+        return jsonify({"error": "No URLs provided"}), 400
+    if len(urls) > MAX_BATCH_URLS:
+        return jsonify({"error": f"At most {MAX_BATCH_URLS} URLs per batch"}), 400
+    
+    try:
+        priority = int(data.get('priority', request.form.get('priority', 0)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid priority"}), 400
+    
+    batch_id = new_job_id()
+    job_store.create(batch_id, {
+        "type": "batch",
+        "status": "expanding",
+        "urls": urls,
+        "job_ids": [],
+        "duplicates": 0,
+        "rejected": 0,
         "error": None
-    }
+    })
     
-    # Start download in a separate thread
-    thread = threading.Thread(
-        target=process_download,
-        args=(download_id, video_url)
-    )
+    thread = threading.Thread(target=process_batch, args=(batch_id, urls, priority),
+                              name=f"batch-{batch_id[:8]}")
     thread.daemon = True
     thread.start()
     
     return jsonify({
         "success": True,
-        "download_id": download_id,
-        "message": "Download started"
+        "batch_id": batch_id,
+        "message": "Batch queued"
     })
 
-def process_download(download_id, url):
-    """Process video download in background"""
+def process_batch(batch_id, urls, priority):
+    """Expand a batch's playlists and queue a download for each unique video"""
     try:
-        # Update status
-        active_downloads[download_id]["status"] = "extracting_info"
+        job_ids = []
+        duplicates = rejected = 0
+        seen = set()
+        for url in urls:
+            entries, found = video_downloader.unique_urls([url], seen=seen)
+            duplicates += found
+            for entry in entries:
+                try:
+                    job_ids.append(start_download(entry, priority, batch_id)[0])
+                except QueueFull:
+                    rejected += 1
+                    continue
+                # Extract ahead so the worker that picks this job finds the info cached
+                batch_prefetcher.submit(video_downloader.get_video_info, entry)
+            # Publish each playlist's jobs as soon as they are queued
+            job_store.update(batch_id, job_ids=list(job_ids), duplicates=duplicates,
+                             rejected=rejected)
         
-        # Get video info
-        video_info = video_downloader.get_video_info(url)
-        
-        if not video_info:
-            active_downloads[download_id]["status"] = "failed"
-            active_downloads[download_id]["error"] = "Failed to extract video information"
+        job_store.update(batch_id, status="queued")
+    except Exception as e:
+        job_store.update(batch_id, status="failed", error=str(e))
+
+def get_batch_status(batch_id):
+    """Combined status of a batch's downloads, or None if unknown"""
+    _, batch = job_store.get(batch_id)
+    if batch is None or batch.get("type") != "batch":
+        return None
+    
+    jobs = []
+    counts = {}
+    downloaded_bytes = total_bytes = 0
+    progress = 0.0
+    for job_id in batch["job_ids"]:
+        _, state = job_store.get(job_id)
+        if state is None:
+            continue
+        counts[state["status"]] = counts.get(state["status"], 0) + 1
+        downloaded_bytes += state.get("downloaded_bytes") or 0
+        total_bytes += state.get("total_bytes") or 0
+        progress += 100 if state["status"] in FINISHED_STATUSES else state.get("progress") or 0
+        jobs.append({
+            "id": job_id,
+            "url": state["url"],
+            "title": state.get("title"),
+            "status": state["status"],
+            "progress": state.get("progress", 0),
+            "error": state.get("error")
+        })
+    
+    status = batch["status"]
+    if status == "queued" and jobs:
+        if all(job["status"] in FINISHED_STATUSES for job in jobs):
+            status = "completed"
+        elif any(job["status"] != "queued" for job in jobs):
+            status = "downloading"
+    
+    return {
+        "batch_id": batch_id,
+        "status": status,
+        "total": len(jobs),
+        "counts": counts,
+        "duplicates": batch["duplicates"],
+        "rejected": batch["rejected"],
+        "progress": round(progress / len(jobs), 1) if jobs else 0,
+        "downloaded_bytes": downloaded_bytes,
+        "total_bytes": total_bytes,
+        "error": batch["error"],
+        "downloads": jobs
+    }
+
+def update_download(download_id, cancel_event=None, **fields):
+    """Update a download's status and notify event stream subscribers
+    
+    With a cancel_event, a cancellation requested through another worker
+    process is passed on to the running download.
+    """
+    if fields.get("status") in FINISHED_STATUSES:
+        fields["finished_at"] = time.time()
+    state = job_store.update(download_id, **fields)
+    if state is None:
+        return None
+    if fields.get("status") in FINISHED_STATUSES:
+        metrics.jobs_finished.inc(status=fields["status"])
+        release_inflight(state["url"], download_id)
+    if LISTED_FIELDS.intersection(fields):
+        touch_listing()
+    if cancel_event is not None and state.get("cancel_requested"):
+        cancel_event.set()
+    if cancel_event is not None and state.get("bandwidth"):
+        # Pick up weight and cap changes made through another worker process
+        apply_job_bandwidth(download_id, state["bandwidth"])
+    progress_broker.publish(download_id, state["status"])
+    if fields.get("status") in FINISHED_STATUSES:
+        # Subscribers have been woken and read the final state from the job store
+        progress_broker.discard(download_id)
+    return state
+
+def apply_job_bandwidth(download_id, settings):
+    """Bring a job's running bandwidth share in line with its stored settings"""
+    share = bandwidth.default_shaper.find(download_id)
+    if share is not None and (share.weight, share.limit) != (settings["weight"], settings["limit"]):
+        bandwidth.default_shaper.adjust(share, settings["weight"], settings["limit"])
+
+def job_share(download_id):
+    """Bandwidth share for a job running in this process, from its stored settings"""
+    _, state = job_store.get(download_id)
+    settings = (state or {}).get("bandwidth") or {}
+    return bandwidth.default_shaper.share(download_id, settings.get("weight", 1.0),
+                                          settings.get("limit", 0))
+
+def load_bandwidth_settings():
+    """Limits set through /api/bandwidth, for the shaper to pick up in every worker"""
+    _, settings = job_store.get(BANDWIDTH_SETTINGS_KEY)
+    return settings
+
+bandwidth.default_shaper.sync = load_bandwidth_settings
+
+def get_download_status(download_id):
+    """Status of a download as reported by the API, or None if unknown"""
+    _, status = job_store.get(download_id)
+    if status is not None and status["status"] == "queued":
+        status["queue_position"] = scheduler.queue_position(download_id)
+    share = bandwidth.default_shaper.find(download_id)
+    if status is not None and share is not None:
+        # The rate the shaper currently gives the job, for jobs running here
+        status["bandwidth"] = dict(status.get("bandwidth") or {}, **share.status())
+    return status
+
+def prepare_download(download_id, url, cancel_event):
+    """Extract video info for a job; returns None if the job shouldn't go on"""
+    # Skip jobs cancelled through another worker process while queued
+    _, state = job_store.get(download_id)
+    if state is None or state.get("cancel_requested"):
+        return None
+    
+    # Update status
+    update_download(download_id, status="extracting_info")
+    
+    # Get video info
+    video_info = video_downloader.get_video_info(url)
+    
+    if not video_info:
+        update_download(download_id, status="failed",
+                        error="Failed to extract video information")
+        return None
+    
+    # Update status with video info
+    update_download(download_id, cancel_event,
+                    title=video_info.get("title", "Unknown Title"),
+                    file_path=video_info.get("output_path"),
+                    status="downloading")
+    return video_info
+
+def progress_reporter(download_id, cancel_event):
+    """Progress callback that records a job's progress in the job store"""
+    reported = {}
+    def on_progress(event):
+        fields = {}
+        if "file_path" in event and event["file_path"] != reported.get("file_path"):
+            # Reported by direct downloads, whose name may differ from the title
+            fields["file_path"] = reported["file_path"] = event["file_path"]
+        update_download(download_id, cancel_event,
+                        progress=round(event["percent"], 1),
+                        downloaded_bytes=event["downloaded_bytes"],
+                        total_bytes=event["total_bytes"],
+                        speed=event["speed"],
+                        eta=event["eta"],
+                        **fields)
+    return on_progress
+
+def finish_download(download_id, result, cancel_event):
+    """Record the outcome of a job"""
+    if cancel_event is not None and cancel_event.is_set():
+        update_download(download_id, status="cancelled")
+        return
+    
+    if not result:
+        update_download(download_id, status="failed", error="Download failed")
+        return
+    
+    # Update status to complete; the stored file name may differ from the title
+    download_catalog.add(result)
+    update_download(download_id, file_path=result, status="completed", progress=100)
+
+def process_download(download_id, url, cancel_event=None):
+    """Process video download in background"""
+    _, state = job_store.get(download_id)
+    if state is None or not state.get("profile"):
+        run_download(download_id, url, cancel_event)
+        return
+    
+    try:
+        with metrics.profile_job(download_id, state["profile"]) as report:
+            run_download(download_id, url, cancel_event)
+    except metrics.ProfilerBusy as e:
+        # Fail the job rather than leave it queued with its URL attached
+        update_download(download_id, status="failed", error=str(e))
+        return
+    update_download(download_id, profile_report=report)
+
+def run_download(download_id, url, cancel_event):
+    """Extract and download one job, recording the outcome"""
+    try:
+        video_info = prepare_download(download_id, url, cancel_event)
+        if video_info is None:
             return
         
-        # Update status with video info
-        active_downloads[download_id]["title"] = video_info.get("title", "Unknown Title")
-        active_downloads[download_id]["file_path"] = video_info.get("output_path")
-        active_downloads[download_id]["status"] = "downloading"
+        # Start download, reusing the extracted info
+        with job_share(download_id) as share:
+            result = video_downloader.download_video(url, info=video_info,
+                                                     cancel_event=cancel_event,
+                                                     progress_callback=progress_reporter(
+                                                         download_id, cancel_event),
+                                                     share=share)
+        finish_download(download_id, result, cancel_event)
         
-        # Start download
-        result = video_downloader.download_video(url)
-        
-        if not result:
-            active_downloads[download_id]["status"] = "failed"
-            active_downloads[download_id]["error"] = "Download failed"
+    except Exception as e:
+        update_download(download_id, status="failed", error=str(e))
+
+def prepare_download_profiled(download_id, url, cancel_event):
+    """prepare_download, profiled if the job asked for it"""
+    _, state = job_store.get(download_id)
+    if state is None or not state.get("profile"):
+        return prepare_download(download_id, url, cancel_event)
+    with metrics.profile_job(download_id, state["profile"]) as report:
+        video_info = prepare_download(download_id, url, cancel_event)
+    update_download(download_id, profile_report=report)
+    return video_info
+
+async def process_download_async(download_id, url):
+    """process_download for the asyncio engine"""
+    cancel_event = threading.Event()
+    try:
+        # Profiles cover extraction only; the rest runs interleaved on the loop
+        video_info = await async_engine.run_blocking(prepare_download_profiled, download_id, url,
+                                                     cancel_event)
+        if video_info is None:
             return
-            
-        # Update status to complete
-        active_downloads[download_id]["status"] = "completed"
-        active_downloads[download_id]["progress"] = 100
         
+        with job_share(download_id) as share:
+            result = await async_engine.download_video(url, info=video_info,
+                                                       cancel_event=cancel_event,
+                                                       progress_callback=progress_reporter(
+                                                           download_id, cancel_event),
+                                                       share=share)
+        await async_engine.run_blocking(finish_download, download_id, result, cancel_event)
+    
+    except asyncio.CancelledError:
+        cancel_event.set()
+        await asyncio.shield(async_engine.run_blocking(finish_download, download_id, None,
+                                                       cancel_event))
+        raise
     except Exception as e:
-        active_downloads[download_id]["status"] = "failed"
-        active_downloads[download_id]["error"] = str(e)
+        await async_engine.run_blocking(lambda: update_download(download_id, status="failed",
+                                                                error=str(e)))
 
 @app.route('/api/download-status/<download_id>')
 def download_status(download_id):
     """API endpoint to check download status"""
-    if download_id not in active_downloads:
+    status = get_download_status(download_id)
+    if status is None:
+        return jsonify({"error": "Download not found"}), 404
+    
+    return jsonify(status)
+
+@app.route('/api/batch/<batch_id>')
+def batch_status(batch_id):
+    """API endpoint to check the combined status of a batch"""
+    status = get_batch_status(batch_id)
+    if status is None:
+        return jsonify({"error": "Batch not found"}), 404
+    
+    return jsonify(status)
+
+@app.route('/api/download-events/<download_id>')
+def download_events(download_id):
+    """Server-Sent Events stream of a download's status and progress"""
+    if job_store.get(download_id)[1] is None:
+        return jsonify({"error": "Download not found"}), 404
+    
+    def generate():
+        # The job store is the source of truth; the broker only wakes us early
+        # for downloads running in this process, others are polled
+        last_version = 0
+        broker_version = progress_broker.wait(download_id, 0, timeout=0)[0]
+        started = last_sent = time.time()
+        while True:
+            version, state = job_store.get(download_id)
+            if state is None:
+                return
+            if version != last_version:
+                last_version = version
+                if state["status"] == "queued":
+                    state["queue_position"] = scheduler.queue_position(download_id)
+                yield f"data: {json.dumps(state)}\n\n"
+                last_sent = time.time()
+                if state["status"] in FINISHED_STATUSES:
+                    return
+            elif time.time() - started >= SSE_MAX_SECONDS:
+                # The client opens a new stream, which starts with the current state
+                yield "event: reconnect\ndata: {}\n\n"
+                return
+            elif time.time() - last_sent >= 15:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            broker_version = progress_broker.wait(download_id, broker_version,
+                                                  timeout=JOB_POLL_INTERVAL)[0]
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/api/cancel-download/<download_id>', methods=['POST'])
+def cancel_download(download_id):
+    """API endpoint to cancel a queued or running download"""
+    status = get_download_status(download_id)
+    if status is None:
+        return jsonify({"error": "Download not found"}), 404
+    
+    if status["status"] in FINISHED_STATUSES:
+        return jsonify({"error": "Download is not active"}), 409
+    
+    # Jobs owned by another worker process notice the flag on their next update
+    scheduler.cancel(download_id)
+    if async_engine is not None:
+        async_engine.cancel(download_id)
+    fields = {"cancel_requested": True}
+    
+    # Queued jobs never start, so mark them cancelled right away
+    if status["status"] == "queued":
+        fields["status"] = "cancelled"
+    update_download(download_id, **fields)
+    
+    return jsonify({"success": True, "message": "Download cancelled"})
+
+@app.route('/api/stats')
+def stats():
+    """API endpoint reporting queue depths of this worker process"""
+    return jsonify({
+        "scheduler": scheduler.stats(),
+        "async_engine": async_engine.stats() if async_engine is not None else None,
+        "postprocess": postprocess.default_processor.stats(),
+        "youtube_dl": ytdl_pool.default_pool.stats(),
+    })
+
+def read_rate(data, name):
+    """A bytes-per-second limit from a request, None if absent; raises ValueError"""
+    value = data.get(name)
+    if value is None:
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return value
+
+@app.route('/api/bandwidth', methods=['GET', 'POST'])
+def bandwidth_limits():
+    """API endpoint to read or change bandwidth limits
+    
+    POST a JSON body with any of limit (all downloads of a worker process),
+    host_limit (default per host) and hosts ({"host": limit}, replacing the
+    per-host caps), in bytes per second with 0 for no cap. Every cap applies
+    in each worker process separately, so with N workers the total may reach
+    N times it. Changes reach every worker process within about a second.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        try:
+            settings = {name: read_rate(data, name) for name in ("limit", "host_limit")}
+            hosts = data.get("hosts")
+            if hosts is not None:
+                if not isinstance(hosts, dict):
+                    raise ValueError("hosts must be an object")
+                settings["hosts"] = {host.lower(): read_rate(hosts, host) for host in hosts}
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"Invalid bandwidth limit: {e}"}), 400
+        settings = {name: value for name, value in settings.items() if value is not None}
+        
+        shaper = bandwidth.default_shaper
+        job_store.create_if_absent(BANDWIDTH_SETTINGS_KEY, {
+            "type": "settings",
+            "limit": shaper.limit,
+            "host_limit": shaper.host_limit,
+            "hosts": dict(shaper.host_limits)
+        })
+        stored = job_store.update(BANDWIDTH_SETTINGS_KEY, **settings)
+        shaper.configure(stored["limit"], stored["host_limit"], stored["hosts"])
+    
+    return jsonify(bandwidth.default_shaper.stats())
+
+@app.route('/api/bandwidth/<download_id>', methods=['POST'])
+def job_bandwidth(download_id):
+    """API endpoint to change a download's weight or max_rate while it runs"""
+    _, state = job_store.get(download_id)
+    if state is None or "type" in state:
         return jsonify({"error": "Download not found"}), 404
     
-    return jsonify(active_downloads[download_id])
+    data = request.get_json(silent=True) or request.form
+    settings = dict(state.get("bandwidth") or {"weight": 1.0, "limit": 0})
+    try:
+        if data.get("weight") is not None:
+            settings["weight"] = float(data["weight"])
+            if settings["weight"] <= 0:
+                raise ValueError("weight must be positive")
+        max_rate = read_rate(data, "max_rate")
+        if max_rate is not None:
+            settings["limit"] = max_rate
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid bandwidth setting: {e}"}), 400
+    
+    # Jobs in other worker processes pick this up on their next progress update
+    job_store.update(download_id, bandwidth=settings)
+    apply_job_bandwidth(download_id, settings)
+    return jsonify({"success": True, "bandwidth": get_download_status(download_id)["bandwidth"]})
+
+@app.route('/api/storage')
+def storage_status():
+    """API endpoint reporting storage use, the quota, reservations and evictions"""
+    return jsonify(storage.default_manager.stats())
+
+@app.route('/api/profile/<download_id>')
+def download_profile(download_id):
+    """API endpoint returning a profiled job's report as text"""
+    _, state = job_store.get(download_id)
+    report = state.get("profile_report") if state is not None else None
+    if not report or not os.path.exists(report):
+        return jsonify({"error": "No profile for this download"}), 404
+    
+    with open(report) as f:
+        return Response(f.read(), mimetype='text/plain')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus metrics for this worker process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics.default_registry.collector
+def collect_runtime_metrics():
+    """Queue depths, threads and cache counters, read at scrape time"""
+    queues = [
+        ({"pool": "scheduler", "state": "queued"}, scheduler.stats()["queued"]),
+        ({"pool": "scheduler", "state": "running"}, scheduler.stats()["running"]),
+    ]
+    processor = postprocess.default_processor.stats()
+    queues += [({"pool": "postprocess", "state": "queued"}, processor["queued"]),
+               ({"pool": "postprocess", "state": "running"}, processor["running"])]
+    youtube_dl = ytdl_pool.default_pool.stats()
+    queues.append(({"pool": "youtube_dl", "state": "running"},
+                   youtube_dl["workers"] - youtube_dl["free"]))
+    if async_engine is not None:
+        queues.append(({"pool": "async_engine", "state": "running"},
+                       async_engine.stats()["tasks"]))
+    yield ("downloader_queue_depth", "Jobs waiting or running in each pool", "gauge", queues)
+    
+    yield ("downloader_threads", "Live Python threads in this process", "gauge",
+           [({}, threading.active_count())])
+    
+    disk = storage.default_manager.stats()
+    yield ("downloader_storage_bytes", "Bytes in the downloads directory and still to be "
+           "written by downloads in progress", "gauge",
+           [({"state": "used"}, disk["used"]), ({"state": "pending"}, disk["pending"])])
+    yield ("downloader_storage_quota_bytes", "Storage quota, 0 for none", "gauge",
+           [({}, disk["quota"])])
+    yield ("downloader_storage_evicted_files_total", "Files evicted to make room, by this "
+           "process", "counter", [({}, disk["evicted_files"])])
+    yield ("downloader_storage_rejected_total", "Downloads that failed for lack of storage, "
+           "in this process", "counter", [({}, disk["rejected"])])
+    
+    cache = metadata_cache.default_cache.stats()
+    lookups = cache["hits"] + cache["misses"]
+    yield ("downloader_metadata_cache_hits_total", "Metadata cache hits", "counter",
+           [({}, cache["hits"])])
+    yield ("downloader_metadata_cache_misses_total", "Metadata cache misses", "counter",
+           [({}, cache["misses"])])
+    yield ("downloader_metadata_cache_hit_ratio", "Share of metadata lookups served from cache",
+           "gauge", [({}, cache["hits"] / lookups if lookups else 0.0)])
 
 @app.route('/api/downloads')
 def list_downloads():
-    """API endpoint to list all downloads"""
-    # List both active downloads and files in download directory
+    """API endpoint to list all downloads
+    
+    Query parameters: page (from 1), per_page, sort (title, size or mtime)
+    and order (asc or desc). Active downloads are listed on the first page.
+    """
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 50)), 1), MAX_PER_PAGE)
+    except ValueError:
+        return jsonify({"error": "Invalid page or per_page"}), 400
+    sort = request.args.get('sort', 'title')
+    order = request.args.get('order', 'asc')
+    
+    # The listing only changes when the catalog or a job's status, title or
+    # file changes; progress is left to /api/download-status and the event stream
+    listing_version, _ = job_store.get(LISTING_KEY)
+    etag = hashlib.sha1(
+        f"{download_catalog.version()}:{listing_version}:{page}:{per_page}:{sort}:{order}".encode()
+    ).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    
     downloads = []
+    active_paths = set()
     
     # Add active downloads
-    for download_id, download_info in active_downloads.items():
+    if page == 1:
+        for download_id, download_info in job_store.list():
+            # Batches, in-flight URL entries and worker records aren't downloads
+            if "type" in download_info:
+                continue
+            downloads.append({
+                "id": download_id,
+                "title": download_info.get("title", "Unknown"),
+                "status": download_info.get("status"),
+                "file_path": download_info.get("file_path")
+            })
+            if download_info.get("file_path"):
+                active_paths.add(os.path.abspath(download_info["file_path"]))
+    
+    # Add completed downloads from the catalog that aren't listed as active
+    entries, total = download_catalog.list((page - 1) * per_page, per_page, sort, order)
+    for entry in entries:
+        if os.path.abspath(entry["file_path"]) in active_paths:
+            continue
         downloads.append({
-            "id": download_id,
-            "title": download_info.get("title", "Unknown"),
-            "status": download_info.get("status"),
-            "progress": download_info.get("progress", 0),
-            "file_path": download_info.get("file_path")
+            "id": "file_" + secure_filename(entry["filename"]),
+            "title": entry["filename"],
+            "status": "completed",
+            "progress": 100,
+            "file_path": entry["file_path"],
+            "file_size": entry["file_size"]
         })
     
-    # Add completed downloads that might not be in active_downloads
-    if os.path.exists(DOWNLOAD_DIR):
-        for filename in os.listdir(DOWNLOAD_DIR):
-            filepath = os.path.join(DOWNLOAD_DIR, filename)
-            if os.path.isfile(filepath):
-                # Check if file is already in the list
-                if not any(d.get("file_path") == filepath for d in downloads):
-                    file_size = os.path.getsize(filepath)
-                    downloads.append({
-                        "id": "file_" + secure_filename(filename),
-                        "title": filename,
-                        "status": "completed",
-                        "progress": 100,
-                        "file_path": filepath,
-                        "file_size": file_size
-                    })
-    
-    return jsonify({"downloads": downloads})
+    response = jsonify({
+        "downloads": downloads,
+        "page": page,
+        "per_page": per_page,
+        "total": total
+    })
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.route('/api/delete-download', methods=['POST'])
 def delete_download():
@@ -143,13 +1003,15 @@ def delete_download():
     if not file_path:
         return jsonify({"error": "No file path provided"}), 400
     
-    # Security check to make sure we're only deleting from downloads directory
-    if not os.path.abspath(file_path).startswith(os.path.abspath(DOWNLOAD_DIR)):
+    # Only finished downloads in the catalog can be deleted, never partial
+    # files, dotfiles or anything outside the downloads directory
+    if (not is_catalog_file(os.path.basename(file_path))
+            or download_catalog.get(file_path) is None):
         return jsonify({"error": "Invalid file path"}), 403
     
     try:
         if os.path.exists(file_path):
-            os.remove(file_path)
+            storage.default_manager.remove(file_path)
             return jsonify({"success": True, "message": "File deleted successfully"})
         else:
             return jsonify({"error": "File not found"}), 404
@@ -159,26 +1021,103 @@ def delete_download():
 @app.route('/download/<filename>')
 def download_file(filename):
     """Download a file from the download directory"""
+    filepath = safe_join(DOWNLOAD_DIR, filename)
+    if filepath is None or not os.path.isfile(filepath):
+        abort(404)
+    storage.default_manager.touch(filepath)
     try:
-        return send_from_directory(
-            DOWNLOAD_DIR, 
-            filename, 
-            as_attachment=True
-        )
-    except Exception as e:
+        return file_serving.serve_file(filepath, filename, as_attachment=True)
+    except FileNotFoundError:
         abort(404)
 
+def stream_partial_file(partial, filename):
+    """Serve a file that is still downloading, waiting for bytes that haven't arrived
+    
+    Range headers are handled as for finished files. The file has no
+    validators until it is finished, so a range with If-Range gets the
+    whole file, and with an unknown size only the whole file can be sent.
+    """
+    size = partial.manifest["size"]
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    headers = {"Accept-Ranges": "bytes" if size else "none", "Cache-Control": "no-cache"}
+    status = 200
+    parts = None
+    
+    ranges = file_serving.requested_ranges(size, None, None) if size else None
+    if ranges == []:
+        return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+    if ranges is None:
+        # To the end of the download when its size isn't known
+        ranges = [(0, size - 1 if size else None)]
+        if size:
+            headers["Content-Length"] = str(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+    else:
+        status = 206
+        parts, content_type, length = file_serving.multipart_parts(ranges, size, content_type)
+        headers["Content-Length"] = str(length)
+    
+    def follow(f, start, end):
+        """Yield bytes start to end as they arrive; returns whether all were sent"""
+        position = start
+        while end is None or position <= end:
+            watermark = partial.wait_for(position, STREAM_WAIT_TIMEOUT)
+            if partial.closed and os.path.exists(partial.filepath):
+                # Finished: everything up to the real file size is on disk
+                watermark = os.path.getsize(partial.filepath)
+            if watermark <= position:
+                # Stalled, failed or finished without more data
+                return end is None
+            
+            f.seek(position)
+            limit = watermark if end is None else min(watermark, end + 1)
+            while position < limit:
+                data = f.read(min(STREAM_CHUNK_SIZE, limit - position))
+                if not data:
+                    return False
+                position += len(data)
+                yield data
+        return True
+    
+    def generate():
+        # The .part file keeps its inode when renamed, so one handle covers the whole stream
+        path = partial.part_path if os.path.exists(partial.part_path) else partial.filepath
+        with open(path, 'rb') as f:
+            for index, (start, end) in enumerate(ranges):
+                if parts is not None:
+                    yield parts[index]
+                if not (yield from follow(f, start, end)):
+                    return
+            if parts is not None:
+                yield parts[-1]
+    
+    return Response(generate(), status=status, content_type=content_type, headers=headers,
+                    direct_passthrough=True)
+
 @app.route('/stream/<filename>')
 def stream_file(filename):
-    """Stream a file for playback"""
+    """Stream a file for playback, including files that are still downloading"""
+    filepath = safe_join(DOWNLOAD_DIR, filename)
+    if filepath is None:
+        abort(404)
+    
+    if not os.path.exists(filepath):
+        partial = video_downloader.get_live_download(filepath)
+        if partial is not None and partial.manifest is not None:
+            return stream_partial_file(partial, filename)
+    
+    if not os.path.isfile(filepath):
+        abort(404)
+    storage.default_manager.touch(filepath)
     try:
-        return send_from_directory(
-            DOWNLOAD_DIR, 
-            filename, 
-            as_attachment=False
-        )
-    except Exception as e:
+        return file_serving.serve_file(filepath, filename)
+    except FileNotFoundError:
         abort(404)
 
 if __name__ == '__main__':
+    video_downloader.setup_logging()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,573 @@
+import os
+import ssl
+import time
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+import content_store
+import metadata_cache
+import metrics
+import bandwidth
+import storage
+import video_downloader
+from video_downloader import (PartialDownload, DownloadCancelled, check_cancelled,
+                              live_downloads, live_downloads_lock, MANIFEST_FLUSH_BYTES)
+from progress import ProgressTracker
+
+logger = logging.getLogger('async_engine')
+
+# Downloads the event loop runs at the same time; the rest wait their turn
+ASYNC_MAX_DOWNLOADS = int(os.environ.get("ASYNC_MAX_DOWNLOADS", "1000"))
+
+# Threads that write downloaded chunks to disk
+ASYNC_FILE_WORKERS = int(os.environ.get("ASYNC_FILE_WORKERS", "8"))
+
+# Threads for short blocking work such as extraction and job store updates
+ASYNC_BLOCKING_WORKERS = int(os.environ.get("ASYNC_BLOCKING_WORKERS", "16"))
+
+# Threads for blocking work that lasts as long as a download: HLS, youtube-dl,
+# hashing finished files and waiting for storage space
+ASYNC_LONG_WORKERS = int(os.environ.get("ASYNC_LONG_WORKERS", "32"))
+
+ASYNC_CHUNK_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 30
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class AsyncResponse:
+    """Status, headers and a streaming body read from an asyncio connection"""
+
+    def __init__(self, url, status, headers, reader, writer, method, timeout):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.method = method
+        self.timeout = timeout
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise IOError(f"HTTP {self.status} for {self.url}")
+
+    async def iter_chunks(self, chunk_size=ASYNC_CHUNK_SIZE):
+        """Yield the body in chunks of at most chunk_size bytes"""
+        if self.method == 'HEAD' or self.status in (204, 304):
+            return
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            async for chunk in self._iter_chunked(chunk_size):
+                yield chunk
+            return
+
+        length = self.headers.get('content-length')
+        remaining = int(length) if length is not None else None
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = await self._read(self.reader.read(size))
+            if not chunk:
+                if remaining:
+                    raise IOError(f"Connection closed with {remaining} bytes left")
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    async def _iter_chunked(self, chunk_size):
+        while True:
+            size_line = await self._read(self.reader.readline())
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # Skip trailers up to the blank line
+                while (await self._read(self.reader.readline())).strip():
+                    pass
+                return
+            while size > 0:
+                chunk = await self._read(self.reader.read(min(chunk_size, size)))
+                if not chunk:
+                    raise IOError("Connection closed inside a chunk")
+                size -= len(chunk)
+                yield chunk
+            await self._read(self.reader.readline())
+
+    async def _read(self, awaitable):
+        # The timeout applies per read, so slow but steady transfers never trip it
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    def close(self):
+        self.writer.close()
+
+async def open_url(url, headers=None, method='GET', timeout=REQUEST_TIMEOUT):
+    """Send an HTTP/1.1 request over asyncio streams, following redirects"""
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80),
+            ssl=ssl.create_default_context() if secure else None), timeout)
+
+        target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        request_headers = {
+            'Host': parts.netloc,
+            'Accept-Encoding': 'identity',
+            'Connection': 'close',
+        }
+        request_headers.update(headers or {})
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in request_headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        try:
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            if not status_line:
+                raise IOError(f"Empty response from {url}")
+            status = int(status_line.split(None, 2)[1])
+            response_headers = {}
+            while True:
+                line = (await asyncio.wait_for(reader.readline(), timeout)).decode('latin-1')
+                if not line.strip():
+                    break
+                name, _, value = line.partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+
+        response = AsyncResponse(url, status, response_headers, reader, writer, method, timeout)
+        if status in REDIRECT_STATUSES and 'location' in response_headers:
+            response.close()
+            url = urljoin(url, response_headers['location'])
+            if status == 303:
+                method = 'GET'
+            continue
+        return response
+
+    raise IOError(f"Too many redirects for {url}")
+
+class AsyncEngine:
+    """Download engine that runs on one event loop in a dedicated thread
+
+    Each download is a coroutine rather than a blocked thread, so thousands
+    of slow transfers cost little more than their socket buffers. Disk writes
+    go through a small thread pool and progress callbacks run in order on a
+    helper thread, so neither stalls the loop. Work that only exists as
+    blocking code runs on two bounded pools: extraction and other short calls
+    on one, HLS, youtube-dl and storage waits on another, so downloads that
+    hold a thread for minutes never hold up extraction for new jobs.
+
+    submit() and cancel() are safe to call from any thread, e.g. Flask views.
+    """
+
+    def __init__(self, max_downloads=ASYNC_MAX_DOWNLOADS, file_workers=ASYNC_FILE_WORKERS,
+                 blocking_workers=ASYNC_BLOCKING_WORKERS, long_workers=ASYNC_LONG_WORKERS):
+        self.max_downloads = max_downloads
+        self.file_executor = ThreadPoolExecutor(file_workers, thread_name_prefix="async-file")
+        self.blocking_executor = ThreadPoolExecutor(blocking_workers,
+                                                    thread_name_prefix="async-blocking")
+        self.long_executor = ThreadPoolExecutor(long_workers, thread_name_prefix="async-long")
+        self.callback_executor = ThreadPoolExecutor(1, thread_name_prefix="async-callback")
+        # Created by start, so a process forked before then doesn't share its selector
+        self.loop = None
+        self.tasks = {}
+        self.semaphore = None
+        self.thread = None
+
+    def start(self):
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.semaphore = asyncio.Semaphore(self.max_downloads)
+            self.loop.call_soon(started.set)
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="async-engine")
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        return self
+
+    def submit(self, job_id, func, args=()):
+        """Run func(*args) as a task once a download slot is free
+
+        Returns a concurrent.futures.Future for the result.
+        """
+        async def run():
+            async with self.semaphore:
+                return await func(*args)
+
+        # Cancelling this future cancels the task on the loop
+        future = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        self.tasks[job_id] = future
+        future.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+        return future
+
+    def cancel(self, job_id):
+        """Cancel a waiting or running task; False if there is none"""
+        future = self.tasks.get(job_id)
+        return future is not None and future.cancel()
+
+    def stats(self):
+        return {
+            "max_downloads": self.max_downloads,
+            "tasks": len(self.tasks),
+        }
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+        for executor in (self.file_executor, self.blocking_executor, self.long_executor,
+                         self.callback_executor):
+            executor.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args):
+        """Run short blocking code, such as extraction, on its bounded thread pool"""
+        return await self.loop.run_in_executor(self.blocking_executor, func, *args)
+
+    async def run_long(self, func, *args):
+        """Run blocking code that may take as long as a download on its own pool"""
+        return await self.loop.run_in_executor(self.long_executor, func, *args)
+
+    async def run_file_io(self, func, *args):
+        """Run a file operation on the file pool
+
+        A cancelled caller still waits for the operation to finish, so cleanup
+        never races a write or open that is already under way.
+        """
+        future = self.loop.run_in_executor(self.file_executor, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def reserve(self, path, size, cancel_event=None):
+        """storage reserve on the long-running pool; returns the cancel event it watched
+
+        Waiting for space holds a pool thread, not the loop. A cancelled
+        caller sets the event and waits for reserve to return, so the
+        caller's release always comes after any reservation.
+        """
+        cancel_event = cancel_event or threading.Event()
+        future = self.loop.run_in_executor(self.long_executor, storage.default_manager.reserve,
+                                           path, size, cancel_event)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            await asyncio.wait([future])
+            raise
+        return cancel_event
+
+    def _callback(self, callback):
+        """Run progress callbacks off the loop, one at a time and in order"""
+        if callback is None:
+            return None
+        return lambda event: self.callback_executor.submit(callback, event)
+
+    async def probe(self, url, headers):
+        """Async counterpart of video_downloader.probe_download
+
+        A server that refuses the probe leaves the size unknown, so the
+        download runs as a single stream; connection errors still raise.
+        """
+        with metrics.timed("probe"):
+            response = await open_url(url, video_downloader.probe_headers(headers))
+        # Closing without reading skips the body of a server that ignored the range
+        response.close()
+        probe = video_downloader.parse_probe(response.status, response.headers)
+        if probe["size"] == 0:
+            logger.warning(f"Couldn't get the size of {url} (HTTP {response.status}), "
+                           f"downloading it as a single stream")
+        return probe
+
+    async def download_file(self, url, filepath, headers=None, chunk_size=ASYNC_CHUNK_SIZE,
+                            retries=None, cancel_event=None, on_digest=None,
+                            progress_callback=None, share=None):
+        """Async counterpart of video_downloader.download_file
+
+        Streams over a single connection, resuming from the .part file the
+        same way the threaded engine does, so either engine can pick up the
+        other's partial downloads.
+        """
+        if headers is None:
+            headers = {'User-Agent': video_downloader.get_random_user_agent()}
+        if retries is None:
+            retries = video_downloader.DOWNLOAD_RETRIES
+
+        partial = PartialDownload(filepath)
+        try:
+            await self.run_file_io(lambda: os.makedirs(os.path.dirname(filepath), exist_ok=True))
+            if os.path.exists(filepath) and not os.path.exists(partial.part_path):
+                logger.info(f"File already exists: {filepath}")
+                if on_digest is not None:
+                    hasher = await self.run_file_io(content_store.hash_file, filepath)
+                    on_digest(hasher.hexdigest())
+                return filepath
+        except Exception as e:
+            logger.error(f"Download failed: {str(e)}")
+            return None
+
+        with live_downloads_lock:
+            live_downloads[os.path.abspath(filepath)] = partial
+        try:
+            with bandwidth.ensure_share(share) as share:
+                return await self.download_attempts(url, partial, headers, chunk_size, retries,
+                                                    cancel_event, on_digest, progress_callback,
+                                                    share)
+        finally:
+            partial.close()
+            storage.default_manager.release(filepath)
+            with live_downloads_lock:
+                live_downloads.pop(os.path.abspath(filepath), None)
+
+    async def download_attempts(self, url, partial, headers, chunk_size, retries, cancel_event,
+                                on_digest, progress_callback, share):
+        """Run download attempts for download_file, resuming after each failure"""
+        filepath = partial.filepath
+        for attempt in range(1, retries + 1):
+            try:
+                probe = await self.probe(url, headers)
+                await self.run_file_io(partial.load, url, probe)
+                cancel_event = await self.reserve(filepath, probe["size"], cancel_event)
+                check_cancelled(cancel_event)
+                resumed = partial.completed_bytes(partial.manifest)
+                tracker = ProgressTracker(self._callback(progress_callback),
+                                          total=probe["size"], downloaded=resumed,
+                                          file_path=filepath)
+                hasher = content_store.new_hasher() if on_digest is not None else None
+                transfer_started = time.perf_counter()
+                downloaded = await self.download_stream(url, partial, headers, chunk_size,
+                                                        probe["accepts_ranges"], tracker,
+                                                        cancel_event, hasher, share)
+                transfer_time = time.perf_counter() - transfer_started
+                metrics.observe_stage("transfer", transfer_time)
+                metrics.observe_transfer(url, downloaded - resumed, transfer_time)
+                await self.run_file_io(partial.finalize, downloaded)
+                tracker.finish(downloaded=downloaded)
+                if on_digest is not None:
+                    on_digest(hasher.hexdigest())
+                logger.info(f"Download completed: {filepath}")
+                return filepath
+
+            except DownloadCancelled:
+                logger.info(f"Download cancelled: {filepath}")
+                await self.run_file_io(partial.discard)
+                return None
+            except asyncio.CancelledError:
+                logger.info(f"Download cancelled: {filepath}")
+                await self.run_file_io(partial.discard)
+                raise
+            except storage.StorageFull:
+                raise
+            except Exception as e:
+                logger.error(f"Download failed (attempt {attempt}/{retries}): {str(e)}")
+                if attempt < retries:
+                    await asyncio.sleep(2 ** attempt)
+        return None
+
+    async def download_stream(self, url, partial, headers, chunk_size, accepts_ranges, tracker,
+                              cancel_event=None, hasher=None, share=None):
+        """Async counterpart of video_downloader.download_stream"""
+        offset = partial.contiguous_prefix() if accepts_ranges else 0
+
+        request_headers = dict(headers)
+        if offset:
+            request_headers['Range'] = f"bytes={offset}-"
+            if partial.validator:
+                request_headers['If-Range'] = partial.validator
+
+        logger.info(f"Downloading {url} to {partial.part_path}"
+                    + (f" from byte {offset}" if offset else ""))
+        host = bandwidth.host_of(url)
+
+        started = time.perf_counter()
+        response = await open_url(url, request_headers)
+        metrics.observe_stage("first_byte", time.perf_counter() - started)
+        downloaded = flushed = 0
+        f = None
+        try:
+            response.raise_for_status()
+            if offset and response.status != 206:
+                logger.info("Server refused to resume, restarting from the beginning")
+                offset = 0
+            etag = response.headers.get('etag')
+            if offset and partial.manifest.get("etag") and etag and etag != partial.manifest["etag"]:
+                raise IOError(f"ETag changed during download: {etag} != {partial.manifest['etag']}")
+            await self.run_file_io(partial.keep_prefix, offset)
+
+            downloaded = flushed = offset
+            f = await self.run_file_io(open, partial.part_path, 'r+b' if offset else 'wb')
+            await self.run_file_io(self._prepare, f, offset, hasher)
+            async for chunk in response.iter_chunks(chunk_size):
+                check_cancelled(cancel_event)
+                await self.run_file_io(self._write, f, chunk, hasher)
+                downloaded += len(chunk)
+                partial.mark_available(downloaded - len(chunk), downloaded - 1)
+
+                # Persist progress now and then so a retry loses little work
+                if downloaded - flushed >= MANIFEST_FLUSH_BYTES:
+                    await self.run_file_io(partial.add_range, 0, downloaded - 1)
+                    flushed = downloaded
+
+                tracker.update(downloaded)
+                if share is not None:
+                    delay = share.reserve(len(chunk), host)
+                    if delay:
+                        await asyncio.sleep(delay)
+            await self.run_file_io(f.truncate)
+        finally:
+            response.close()
+            if f is not None:
+                await self.run_file_io(self._close, f, partial, flushed, downloaded)
+
+        return downloaded
+
+    @staticmethod
+    def _prepare(f, offset, hasher):
+        if hasher is not None and offset:
+            hasher.update(f.read(offset))
+        f.seek(offset)
+
+    @staticmethod
+    def _write(f, chunk, hasher):
+        f.write(chunk)
+        f.flush()
+        if hasher is not None:
+            hasher.update(chunk)
+
+    @staticmethod
+    def _close(f, partial, flushed, downloaded):
+        f.close()
+        if downloaded > flushed:
+            partial.add_range(0, downloaded - 1)
+
+    async def fetch_video(self, url, video_info, cancel_event, progress_callback, share=None):
+        """Async counterpart of video_downloader.fetch_video for direct MP4s"""
+        video_url = video_info.get("url")
+        store = content_store.default_store
+
+        # Reuse a finished object for this page or media URL before any network I/O
+        digest = await self.run_blocking(store.lookup_url, url) or \
+            await self.run_blocking(store.lookup_url, video_url)
+        metrics.cache_lookups.inc(cache="content_store", result="hit" if digest else "miss")
+        if digest:
+            logger.info(f"Already downloaded as object {digest[:12]}")
+            return await self.run_blocking(store.materialize, digest, video_info["output_path"])
+
+        output_path = store.claim_path(video_info["output_path"], video_url)
+        try:
+            digests = []
+            result = await self.download_file(video_url, output_path, cancel_event=cancel_event,
+                                              on_digest=digests.append,
+                                              progress_callback=progress_callback, share=share)
+            if result:
+                return await self.run_blocking(lambda: store.ingest(result, digests[-1],
+                                                                    urls=[url, video_url]))
+
+            check_cancelled(cancel_event)
+            logger.info("Regular download failed, trying youtube-dl")
+            await self.reserve(output_path, video_info.get("filesize") or 0, cancel_event)
+            check_cancelled(cancel_event)
+            result = await self.run_long(video_downloader.download_with_youtube_dl, url,
+                                         output_path, cancel_event, progress_callback, share)
+            if result:
+                # Hashes the whole file
+                return await self.run_long(lambda: store.ingest(result, urls=[url]))
+
+            logger.error("All download methods failed")
+            metadata_cache.default_cache.invalidate(url)
+            return None
+        finally:
+            storage.default_manager.release(output_path)
+            store.release_path(output_path)
+
+    async def follow_flight(self, flight, output_path, cancel_event, progress_callback):
+        """Async counterpart of video_downloader.follow_flight
+
+        Followers wait on the loop rather than a pool thread, so a video many
+        jobs ask for can't fill a pool its leader needs.
+        """
+        if progress_callback is not None:
+            flight.subscribe(progress_callback)
+        try:
+            while not flight.done.is_set():
+                check_cancelled(cancel_event)
+                await asyncio.sleep(video_downloader.FLIGHT_POLL_INTERVAL)
+        finally:
+            if progress_callback is not None:
+                flight.unsubscribe(progress_callback)
+
+        if not flight.result:
+            return None
+        store = content_store.default_store
+        digest = await self.run_blocking(store.lookup_path, flight.result)
+        if digest is None:
+            return flight.result
+        return await self.run_blocking(store.materialize, digest, output_path)
+
+    async def download_video(self, url, info=None, cancel_event=None, progress_callback=None,
+                             share=None):
+        """Async counterpart of video_downloader.download_video
+
+        Direct MP4 downloads, and waits for another job's download of the
+        same video, run on the event loop; HLS streams and the youtube-dl
+        fallback use the threaded engine on the long-running pool.
+        Cancelling the task also stops that blocking work.
+        """
+        cancel_event = cancel_event or threading.Event()
+        try:
+            video_info = info if info is not None else \
+                await self.run_blocking(video_downloader.get_video_info, url)
+            if not video_info:
+                logger.error("Failed to extract video information")
+                return None
+
+            video_url = video_info.get("url")
+            output_path = video_info.get("output_path")
+            if video_info.get("extension") != "mp4":
+                return await self.run_long(video_downloader.download_video, url, video_info,
+                                           cancel_event, progress_callback, share)
+
+            # Share one transfer with concurrent jobs for the same page or media URL
+            while True:
+                flight, leader = video_downloader.join_flight((url, video_url))
+                if leader:
+                    break
+                logger.info(f"Following a download of the same video already in progress: {url}")
+                result = await self.follow_flight(flight, output_path, cancel_event,
+                                                  progress_callback)
+                if not flight.cancelled:
+                    return result
+
+            result = None
+            try:
+                result = await self.fetch_video(url, video_info, cancel_event,
+                                                flight.relay(progress_callback)
+                                                if progress_callback else None, share)
+                return result
+            except asyncio.CancelledError:
+                # Land the flight as cancelled so followers take over instead of failing
+                cancel_event.set()
+                raise
+            finally:
+                video_downloader.land_flight(flight, result, cancel_event.is_set())
+
+        except asyncio.CancelledError:
+            # Blocking work doesn't see task cancellation, so stop it through the event
+            cancel_event.set()
+            logger.info(f"Download cancelled: {url}")
+            raise
+        except DownloadCancelled:
+            logger.info(f"Download cancelled: {url}")
+            return None
+        except storage.StorageFull as e:
+            logger.error(f"Error downloading video: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Error downloading video: {str(e)}")
+            return None
@@ -0,0 +1,317 @@
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger('bandwidth')
+
+# Bytes per second all downloads in this process may use together (0 for no cap);
+# each gunicorn worker process has its own, so the total is up to workers times this
+BANDWIDTH_LIMIT = int(os.environ.get("BANDWIDTH_LIMIT", "0"))
+
+# Bytes per second downloads from one host may use together in this process (0 for no cap)
+BANDWIDTH_HOST_LIMIT = int(os.environ.get("BANDWIDTH_HOST_LIMIT", "0"))
+
+# Seconds of transfer at the full rate a bucket can save up for bursts
+BANDWIDTH_BURST = float(os.environ.get("BANDWIDTH_BURST", "0.5"))
+
+# Seconds between recomputing each job's share of the global cap
+REBALANCE_INTERVAL = 1.0
+
+# A job that used less than its share is offered this much more than it used
+DEMAND_HEADROOM = 1.5
+
+# Longest single sleep in consume, so cancellation isn't held up
+MAX_SLEEP = 0.25
+
+# Seconds without transfers after which a host's bucket is dropped
+HOST_IDLE_TIMEOUT = 60
+
+def host_of(url):
+    return (urlparse(url).hostname or '').lower()
+
+class TokenBucket:
+    """Token bucket that may go into debt; rate in bytes per second, 0 for unlimited"""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = self.capacity()
+        self.updated = time.monotonic()
+
+    def capacity(self):
+        return self.rate * BANDWIDTH_BURST
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate, now):
+        self.refill(now)
+        if rate and not self.rate:
+            # A bucket that was unlimited starts out full
+            self.tokens = rate * BANDWIDTH_BURST
+        self.rate = rate
+        self.tokens = min(self.tokens, self.capacity())
+
+    def reserve(self, nbytes, now):
+        """Take nbytes tokens; returns the seconds until the bucket is out of debt"""
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        self.tokens -= nbytes
+        return max(-self.tokens / self.rate, 0.0)
+
+class Share:
+    """One job's claim on the shaper, passed down to its transfer loops
+
+    weight sets the job's portion of the global cap relative to other
+    active jobs; limit caps the job on its own (0 for no cap).
+    """
+
+    def __init__(self, shaper, job_id, weight, limit):
+        self.shaper = shaper
+        self.job_id = job_id
+        self.weight = weight
+        self.limit = limit
+        self.bucket = TokenBucket(limit)
+        # Bytes since the last rebalance and the rate measured at it
+        self.window_bytes = 0
+        self.demand = None
+        self.active = False
+
+    def reserve(self, nbytes, host):
+        """Account for nbytes from host; returns the seconds to wait before going on"""
+        return self.shaper.reserve(self, nbytes, host)
+
+    def consume(self, nbytes, host, cancel_event=None):
+        """Account for nbytes from host, sleeping as long as the limits require
+
+        Returns early once cancel_event is set; the caller's own
+        cancellation check then stops the transfer.
+        """
+        deadline = time.monotonic() + self.reserve(nbytes, host)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (cancel_event is not None and cancel_event.is_set()):
+                return
+            time.sleep(min(remaining, MAX_SLEEP))
+
+    def rate_limit(self, host):
+        """Lowest cap in force for this job on host right now, or 0 for none"""
+        limits = [self.shaper.rate_limit(host)]
+        with self.shaper.lock:
+            limits.append(self.bucket.rate)
+        return min((limit for limit in limits if limit), default=0)
+
+    def status(self):
+        with self.shaper.lock:
+            return {
+                "weight": self.weight,
+                "limit": self.limit,
+                "rate": self.bucket.rate,
+                "measured_rate": round(self.demand or 0),
+                "global_limit": self.shaper.limit,
+            }
+
+class Shaper:
+    """Token-bucket bandwidth limiter with global, per-host and per-job caps
+
+    Every transfer loop reserves the bytes it just read from the global
+    bucket, its host's bucket and its job's bucket, then sleeps off the
+    largest debt. With a global cap, the job buckets split it between
+    active jobs by weight; jobs that can't use their portion (a slow
+    server, a per-job limit) keep what they use and the rest is shared
+    out again every REBALANCE_INTERVAL.
+
+    Caps apply to the downloads of one process. Host buckets idle for
+    HOST_IDLE_TIMEOUT are dropped and start full when the host returns.
+    """
+
+    def __init__(self, limit=BANDWIDTH_LIMIT, host_limit=BANDWIDTH_HOST_LIMIT):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.host_limit = host_limit
+        # Per-host caps that replace host_limit
+        self.host_limits = {}
+        self.total = TokenBucket(limit)
+        self.hosts = {}
+        self.shares = set()
+        self.rebalanced = time.monotonic()
+        # Optional function called about once a second that returns settings
+        # for configure, e.g. loaded from storage shared between processes
+        self.sync = None
+        self.synced = 0.0
+
+    def join(self, job_id=None, weight=1.0, limit=0):
+        share = Share(self, job_id, weight, limit)
+        with self.lock:
+            self.shares.add(share)
+        return share
+
+    def leave(self, share):
+        with self.lock:
+            self.shares.discard(share)
+            if share.active:
+                self.rebalance(time.monotonic())
+
+    @contextmanager
+    def share(self, job_id=None, weight=1.0, limit=0):
+        share = self.join(job_id, weight, limit)
+        try:
+            yield share
+        finally:
+            self.leave(share)
+
+    def find(self, job_id):
+        with self.lock:
+            for share in self.shares:
+                if share.job_id == job_id:
+                    return share
+        return None
+
+    def adjust(self, share, weight=None, limit=None):
+        """Change a job's weight or cap while it runs"""
+        with self.lock:
+            if weight is not None:
+                share.weight = weight
+            if limit is not None:
+                share.limit = limit
+            self.rebalance(time.monotonic())
+
+    def configure(self, limit=None, host_limit=None, host_limits=None):
+        """Change the global cap, the default host cap or the per-host caps"""
+        with self.lock:
+            now = time.monotonic()
+            if limit is not None:
+                self.limit = limit
+                self.total.set_rate(limit, now)
+            if host_limit is not None:
+                self.host_limit = host_limit
+            if host_limits is not None:
+                self.host_limits = {host.lower(): rate for host, rate in host_limits.items()}
+            for host, bucket in self.hosts.items():
+                bucket.set_rate(self.host_limits.get(host, self.host_limit), now)
+            self.rebalance(now)
+
+    def rate_limit(self, host):
+        """Lowest of the global and host caps, or 0 for none"""
+        with self.lock:
+            limits = (self.limit, self.host_limits.get(host, self.host_limit))
+        return min((limit for limit in limits if limit), default=0)
+
+    def reserve(self, share, nbytes, host):
+        now = time.monotonic()
+        if self.sync is not None and now - self.synced >= REBALANCE_INTERVAL:
+            self.synced = now
+            self.run_sync()
+
+        with self.lock:
+            share.window_bytes += nbytes
+            if not share.active or now - self.rebalanced >= REBALANCE_INTERVAL:
+                share.active = True
+                self.rebalance(now)
+            bucket = self.hosts.get(host)
+            if bucket is None:
+                bucket = self.hosts[host] = TokenBucket(self.host_limits.get(host, self.host_limit))
+            return max(self.total.reserve(nbytes, now), bucket.reserve(nbytes, now),
+                       share.bucket.reserve(nbytes, now))
+
+    def run_sync(self):
+        try:
+            settings = self.sync()
+        except Exception as e:
+            logger.error(f"Couldn't load bandwidth settings: {e}")
+            return
+        if settings and (settings.get("limit"), settings.get("host_limit"),
+                         settings.get("hosts")) != (self.limit, self.host_limit, self.host_limits):
+            self.configure(settings.get("limit"), settings.get("host_limit"), settings.get("hosts"))
+
+    def rebalance(self, now):
+        """Recompute job rates; called with the lock held"""
+        elapsed = now - self.rebalanced
+        if elapsed >= REBALANCE_INTERVAL:
+            self.rebalanced = now
+            self.drop_idle_hosts(now)
+            for share in self.shares:
+                if share.active:
+                    share.demand = share.window_bytes / elapsed
+                    share.active = share.window_bytes > 0
+                if not share.active:
+                    # An idle job starts from a full portion when it resumes
+                    share.demand = None
+                share.window_bytes = 0
+
+        active = [share for share in self.shares if share.active]
+        if not self.limit:
+            for share in active:
+                share.bucket.set_rate(share.limit, now)
+            return
+
+        # Weighted max-min fair split: jobs that need less than their portion
+        # get what they need and the rest is divided between the others
+        remaining = self.limit
+        pending = active
+        while pending:
+            weights = sum(share.weight for share in pending)
+            portion = remaining / weights
+            satisfied = [share for share in pending
+                         if self.ceiling(share) < portion * share.weight]
+            if not satisfied:
+                break
+            for share in satisfied:
+                rate = self.ceiling(share)
+                share.bucket.set_rate(max(int(rate), 1), now)
+                remaining -= rate
+            pending = [share for share in pending if share not in satisfied]
+        for share in pending:
+            share.bucket.set_rate(max(int(remaining * share.weight / weights), 1), now)
+
+    def drop_idle_hosts(self, now):
+        """Forget hosts with no recent transfers; called with the lock held"""
+        for host, bucket in list(self.hosts.items()):
+            if now - bucket.updated >= HOST_IDLE_TIMEOUT:
+                bucket.refill(now)
+                # Only once it has paid off any debt, so dropping it changes nothing
+                if bucket.tokens >= bucket.capacity():
+                    del self.hosts[host]
+
+    @staticmethod
+    def ceiling(share):
+        """Most a job could use this round: its cap, or a little over what it used"""
+        ceiling = share.limit or float('inf')
+        if share.demand is not None and share.bucket.rate:
+            # Never cut a job below half its current rate in one round
+            wanted = max(share.demand * DEMAND_HEADROOM, share.bucket.rate / 2)
+            ceiling = min(ceiling, wanted)
+        return ceiling
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "host_limit": self.host_limit,
+                "hosts": dict(self.host_limits),
+                "jobs": [{
+                    "job_id": share.job_id,
+                    "weight": share.weight,
+                    "limit": share.limit,
+                    "rate": share.bucket.rate,
+                    "measured_rate": round(share.demand or 0),
+                    "active": share.active,
+                } for share in self.shares],
+            }
+
+# Shared shaper used by every download in this process
+default_shaper = Shaper()
+
+@contextmanager
+def ensure_share(share=None):
+    """share, or an anonymous share of the default shaper for the block"""
+    if share is not None:
+        yield share
+        return
+    with default_shaper.share() as share:
+        yield share
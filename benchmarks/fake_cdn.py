@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import mimetypes
+import subprocess
+import logging
+import http.server
+
+logger = logging.getLogger('fake_cdn')
+
+# Bytes written per socket write; bandwidth is paced at this granularity
+WRITE_CHUNK = 16 * 1024
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+def synthetic_mp4(size, seed=0):
+    """size bytes that start like an MP4 file, the same for the same seed"""
+    # An ftyp box followed by an mdat box holding reproducible noise
+    header = (b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2'
+              + (max(size - 24, 8)).to_bytes(4, 'big') + b'mdat')
+    body = random.Random(seed).randbytes(max(size - len(header), 0))
+    return (header + body)[:size]
+
+def encode_hls(duration=20, segment_time=2, size="640x360"):
+    """Files of a real HLS stream encoded with ffmpeg, or None without ffmpeg
+
+    Returns {name: bytes} with index.m3u8 and its .ts segments.
+    """
+    if shutil.which('ffmpeg') is None:
+        return None
+    workdir = tempfile.mkdtemp(prefix='fake-cdn-hls-')
+    try:
+        for codec in (['-c:v', 'libx264', '-preset', 'ultrafast'], ['-c:v', 'mpeg4']):
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'lavfi', '-i', f'testsrc=size={size}:rate=25',
+                   '-f', 'lavfi', '-i', 'sine=frequency=440',
+                   '-t', str(duration)] + codec + [
+                   '-c:a', 'aac', '-f', 'hls', '-hls_time', str(segment_time),
+                   '-hls_list_size', '0',
+                   '-hls_segment_filename', os.path.join(workdir, 'seg%03d.ts'),
+                   os.path.join(workdir, 'index.m3u8')]
+            if subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                break
+        else:
+            logger.warning("ffmpeg couldn't encode the HLS test stream")
+            return None
+        files = {}
+        for name in os.listdir(workdir):
+            with open(os.path.join(workdir, name), 'rb') as f:
+                files[name] = f.read()
+        return files
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+class FakeCDN:
+    """Local HTTP server that imitates a video CDN for benchmarks
+
+    Serves in-memory files with a fixed delay before each response
+    (latency), a per-connection transfer rate (bandwidth, bytes per second,
+    0 for unlimited) and optional Range support. The settings can be changed
+    between benchmark runs while the server is up.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0, ranges=True, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.files = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = CDNServer((host, port), CDNHandler)
+        self.server.cdn = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, name):
+        return f"{self.base_url}/{name}"
+
+    def add(self, name, data):
+        """Serve data at /name; returns its URL"""
+        self.files[name] = data
+        return self.url(name)
+
+    def add_mp4(self, name, size, seed=0):
+        return self.add(name, synthetic_mp4(size, seed))
+
+    def add_hls(self, prefix, **encode_options):
+        """Serve an encoded HLS stream under prefix/; returns the playlist URL or None"""
+        files = encode_hls(**encode_options)
+        if files is None:
+            return None
+        for name, data in files.items():
+            self.add(f"{prefix}/{name}", data)
+        return self.url(f"{prefix}/index.m3u8")
+
+    def configure(self, latency=None, bandwidth=None, ranges=None):
+        if latency is not None:
+            self.latency = latency
+        if bandwidth is not None:
+            self.bandwidth = bandwidth
+        if ranges is not None:
+            self.ranges = ranges
+
+    def count(self, requests=0, sent=0):
+        with self.lock:
+            self.requests += requests
+            self.bytes_sent += sent
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-cdn")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+class CDNServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-request is normal here, not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class CDNHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        cdn = self.server.cdn
+        cdn.count(requests=1)
+        if cdn.latency:
+            time.sleep(cdn.latency)
+
+        data = cdn.files.get(self.path.split('?', 1)[0].lstrip('/'))
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        size = len(data)
+        start, end = 0, size - 1
+        status = 200
+        match = RANGE_RE.match(self.headers.get('Range', '')) if cdn.ranges else None
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type',
+                         mimetypes.guess_type(self.path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', f'"{size:x}-{hash(data[:64]) & 0xffffffff:x}"')
+        if cdn.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if send_body:
+            self.send_paced(memoryview(data)[start:end + 1], cdn)
+
+    def send_paced(self, body, cdn):
+        """Write body no faster than the CDN's per-connection bandwidth"""
+        began = time.monotonic()
+        sent = 0
+        try:
+            while sent < len(body):
+                chunk = body[sent:sent + WRITE_CHUNK]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                cdn.count(sent=len(chunk))
+                if cdn.bandwidth:
+                    delay = began + sent / cdn.bandwidth - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients close early, e.g. extractors that found what they need
+            self.close_connection = True
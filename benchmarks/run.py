@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the downloader against a local fake CDN
+
+Runs download_file, convert_m3u8_to_mp4, the site extractors and the Flask
+API against FakeCDN, and times web worker startup, then writes throughput,
+p50/p99 latency, peak RSS and thread counts as JSON. Pass --compare with an earlier results file to see
+what changed between runs.
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+sys.path.insert(0, REPO_DIR)
+
+from fake_cdn import FakeCDN
+
+MB = 1024 * 1024
+
+# Seconds between RSS and thread count samples
+SAMPLE_INTERVAL = 0.05
+
+SCENARIOS = ("download", "hls", "extract", "api", "startup")
+
+# Metrics compared between runs, and whether a larger value is better
+COMPARED_METRICS = {
+    "throughput_mbps": True,
+    "ops_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+    "peak_threads": False,
+}
+
+def ignore(event):
+    pass
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values, or None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_threads():
+    """OS threads of this process, or Python threads where /proc isn't available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return threading.active_count()
+
+class ResourceSampler:
+    """Tracks peak RSS and thread count of this process while in use
+
+    Child processes such as ffmpeg and youtube-dl workers aren't included.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+        self.peak_threads = max(self.peak_threads, current_threads())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="resource-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+def summarize(latencies, total_bytes, errors, wall, sampler, cdn=None):
+    """Result record for one scenario"""
+    result = {
+        "operations": len(latencies) + errors,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "bytes": total_bytes,
+        "throughput_mbps": round(total_bytes / MB / wall, 2) if wall > 0 else None,
+        "ops_per_second": round(len(latencies) / wall, 2) if wall > 0 else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+        "peak_rss_mb": round(sampler.peak_rss / MB, 1),
+        "peak_threads": sampler.peak_threads,
+    }
+    if cdn is not None:
+        result["cdn_requests"] = cdn.requests
+        result["cdn_bytes_sent"] = cdn.bytes_sent
+    return result
+
+def measure(op, count, concurrency, cdn=None):
+    """Run op(i) for i in range(count) on concurrency threads
+
+    op returns the bytes it moved, or None on failure.
+    """
+    latencies = []
+    total_bytes = 0
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(i):
+        nonlocal total_bytes, errors
+        began = time.perf_counter()
+        try:
+            moved = op(i)
+        except Exception as e:
+            logging.getLogger('benchmarks').warning(f"Operation {i} failed: {e}")
+            moved = None
+        elapsed = time.perf_counter() - began
+        with lock:
+            if moved is None:
+                errors += 1
+            else:
+                latencies.append(elapsed)
+                total_bytes += moved
+
+    if cdn is not None:
+        cdn.reset_counters()
+    with ResourceSampler() as sampler:
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(count)))
+        wall = time.perf_counter() - began
+    return summarize(latencies, total_bytes, errors, wall, sampler, cdn)
+
+def bench_download(cdn, workdir, args):
+    """download_file with one connection, with segments, and without Range support"""
+    import video_downloader
+    size = int(args.size_mb * MB)
+    url = cdn.add_mp4("videos/bench.mp4", size)
+    results = {}
+    for name, ranges, connections in (("single", True, 1),
+                                      ("segmented", True, args.connections),
+                                      ("no_ranges", False, args.connections)):
+        cdn.configure(ranges=ranges)
+        target = os.path.join(workdir, f"download-{name}")
+
+        def op(i):
+            path = os.path.join(target, f"{i}.mp4")
+            result = video_downloader.download_file(url, path, connections=connections,
+                                                    progress_callback=ignore)
+            if not result:
+                return None
+            moved = os.path.getsize(result)
+            os.remove(result)
+            return moved if moved == size else None
+
+        results[f"download_file.{name}"] = measure(op, args.files, args.concurrency, cdn)
+        shutil.rmtree(target, ignore_errors=True)
+    cdn.configure(ranges=True)
+    return results
+
+def bench_hls(cdn, workdir, args):
+    """convert_m3u8_to_mp4 on an ffmpeg-encoded stream"""
+    import video_downloader
+    url = cdn.add_hls("hls", duration=args.hls_seconds)
+    if url is None:
+        return {"convert_m3u8_to_mp4": {"skipped": "ffmpeg not available"}}
+    target = os.path.join(workdir, "hls")
+
+    def op(i):
+        result = video_downloader.convert_m3u8_to_mp4(url, os.path.join(target, f"{i}.mp4"),
+                                                      progress_callback=ignore)
+        if not result:
+            return None
+        moved = os.path.getsize(result)
+        os.remove(result)
+        return moved
+
+    os.makedirs(target, exist_ok=True)
+    result = measure(op, args.hls_runs, args.concurrency, cdn)
+    shutil.rmtree(target, ignore_errors=True)
+    return {"convert_m3u8_to_mp4": result}
+
+def fixture_page(name, cdn, padding_kb):
+    """A saved page pointing at the CDN, padded to look like a heavy page"""
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        page = f.read().replace("{cdn}", cdn.base_url)
+    filler = '<div class="thumb-block"><a href="/video0/related">Related video</a></div>\n'
+    page += filler * (padding_kb * 1024 // len(filler))
+    return (page + "</body>\n</html>\n").encode()
+
+def bench_extract(cdn, workdir, args):
+    """Site extractors against saved pages served by the CDN"""
+    import extractors
+    import video_downloader
+    results = {}
+    for domain, fixture, expected in (("xvideos.com", "xvideos.html", "hls/index.m3u8"),
+                                      ("pornhub.com", "pornhub.html", "videos/high.mp4")):
+        extractor = extractors.registry[domain]
+        url = cdn.add(f"pages/{fixture}", fixture_page(fixture, cdn, args.page_kb))
+
+        def op(i):
+            info = extractor(url)
+            return 0 if info and info["url"] == cdn.url(expected) else None
+
+        results[f"extract.{domain}"] = measure(op, args.pages, args.concurrency, cdn)
+        results[f"extract.{domain}"]["page_bytes"] = len(cdn.files[f"pages/{fixture}"])
+    # Cached lookups are what most repeat submissions hit
+    url = cdn.url("pages/pornhub.html")
+    extractors.register(urlparse(cdn.base_url).hostname)(extractors.registry["pornhub.com"])
+    video_downloader.get_video_info(url)
+    results["extract.cached"] = measure(lambda i: 0 if video_downloader.get_video_info(url) else None,
+                                        args.pages, args.concurrency, cdn)
+    return results
+
+def bench_api(cdn, workdir, args):
+    """Flask API: downloads submitted over HTTP while readers poll the listing"""
+    import requests
+    import extractors
+    from werkzeug.serving import make_server
+    import app as app_module
+
+    # Serve extractor fixtures from the CDN's own host name
+    extractors.register(urlparse(cdn.base_url).hostname)(extractors.registry["pornhub.com"])
+    template = fixture_page("pornhub.html", cdn, args.page_kb).decode()
+    video = cdn.files.get("videos/bench.mp4") or cdn.files.setdefault(
+        "videos/bench.mp4", __import__("fake_cdn").synthetic_mp4(int(args.size_mb * MB)))
+    pages = []
+    for i in range(args.api_jobs):
+        cdn.add(f"videos/api-{i}.mp4", video)
+        page = (template.replace("videos\\/high.mp4", f"videos\\/api-{i}.mp4")
+                .replace("<title>Benchmark Fixture Video", f"<title>Benchmark Fixture Video {i}"))
+        pages.append(cdn.add(f"pages/api-{i}.html", page.encode()))
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, name="bench-api")
+    server_thread.daemon = True
+    server_thread.start()
+    api = f"http://127.0.0.1:{server.server_port}"
+
+    read_latencies = []
+    read_errors = 0
+    lock = threading.Lock()
+    done = threading.Event()
+    job_ids = []
+
+    def reader():
+        nonlocal read_errors
+        session = requests.Session()
+        paths = ["/api/downloads", "/api/stats"]
+        n = 0
+        while not done.is_set():
+            n += 1
+            path = paths[n % len(paths)]
+            if job_ids and n % 3 == 0:
+                path = f"/api/download-status/{job_ids[n % len(job_ids)]}"
+            began = time.perf_counter()
+            try:
+                ok = session.get(api + path, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - began
+            with lock:
+                if ok:
+                    read_latencies.append(elapsed)
+                else:
+                    read_errors += 1
+
+    cdn.reset_counters()
+    with ResourceSampler() as sampler:
+        began = time.perf_counter()
+        readers = [threading.Thread(target=reader, name=f"bench-reader-{i}")
+                   for i in range(args.api_clients)]
+        for thread in readers:
+            thread.start()
+
+        submitted = {}
+        session = requests.Session()
+        for page in pages:
+            response = session.post(api + "/api/download", data={"url": page}, timeout=30)
+            if response.status_code == 200:
+                job_id = response.json()["download_id"]
+                submitted[job_id] = time.perf_counter()
+                job_ids.append(job_id)
+
+        # Wait for every job to finish, recording submit-to-finish times
+        job_latencies = []
+        job_errors = len(pages) - len(submitted)
+        pending = dict(submitted)
+        deadline = time.time() + args.timeout
+        while pending and time.time() < deadline:
+            for job_id in list(pending):
+                status = session.get(f"{api}/api/download-status/{job_id}", timeout=30).json()
+                if status["status"] in ("completed", "failed", "cancelled"):
+                    if status["status"] == "completed":
+                        job_latencies.append(time.perf_counter() - pending[job_id])
+                    else:
+                        job_errors += 1
+                    del pending[job_id]
+            time.sleep(0.05)
+        job_errors += len(pending)
+        wall = time.perf_counter() - began
+
+        done.set()
+        for thread in readers:
+            thread.join()
+    server.shutdown()
+
+    size = len(video)
+    return {
+        "api.jobs": summarize(job_latencies, size * len(job_latencies), job_errors, wall,
+                              sampler, cdn),
+        "api.reads": summarize(read_latencies, 0, read_errors, wall, sampler),
+    }
+
+# Run in a fresh interpreter: times a cold import of the app and its first
+# request, then forks a worker from it the way gunicorn --preload does
+STARTUP_PROBE = """
+import os, sys, json, time
+began = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+
+def private_mb():
+    # Memory a forked worker doesn't share with its parent
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(line.split()[1]) for line in f
+                       if line.startswith(('Private_Clean', 'Private_Dirty'))) / 1024
+    except OSError:
+        return None
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def first_request():
+    started = time.perf_counter()
+    client = app.app.test_client()
+    client.get('/')
+    client.get('/api/downloads')
+    return time.perf_counter() - started
+
+result = {"import": imported - began, "rss_mb": rss_mb()}
+app.warmup()
+read, write = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(read)
+    forked = {"forked_first_request": first_request(), "forked_private_mb": private_mb()}
+    os.write(write, json.dumps(forked).encode())
+    os._exit(0)
+os.close(write)
+with os.fdopen(read) as f:
+    result.update(json.loads(f.read() or "{}"))
+os.waitpid(pid, 0)
+result["first_request"] = first_request()
+result["threads"] = len(os.listdir('/proc/self/task'))
+print(json.dumps(result))
+"""
+
+def bench_startup(cdn, workdir, args):
+    """Web worker startup: cold import, first request and a preloaded fork"""
+    env = dict(os.environ, JOB_STORE_URL="memory://")
+    runs = []
+    errors = 0
+    with ResourceSampler() as sampler:
+        began = time.perf_counter()
+        for _ in range(args.startup_runs):
+            process = subprocess.run([sys.executable, "-c", STARTUP_PROBE, REPO_DIR], cwd=workdir,
+                                     env=env, capture_output=True, text=True, timeout=120)
+            try:
+                runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            except (IndexError, ValueError):
+                logging.getLogger('benchmarks').warning(
+                    f"Startup probe failed: {process.stderr.strip()[-500:]}")
+                errors += 1
+        wall = time.perf_counter() - began
+
+    results = {}
+    for name, key in (("startup.import", "import"), ("startup.first_request", "first_request"),
+                      ("startup.forked_first_request", "forked_first_request")):
+        results[name] = summarize([run[key] for run in runs if run.get(key) is not None], 0,
+                                  errors, wall, sampler)
+        # Memory of the probe processes, not of this one
+        results[name]["peak_rss_mb"] = round(max((run["rss_mb"] for run in runs), default=0), 1)
+        results[name]["peak_threads"] = max((run["threads"] for run in runs), default=0)
+    private = [run["forked_private_mb"] for run in runs if run.get("forked_private_mb")]
+    results["startup.forked_first_request"]["private_mb"] = round(max(private), 1) if private else None
+    return results
+
+BENCHMARKS = {
+    "download": bench_download,
+    "hls": bench_hls,
+    "extract": bench_extract,
+    "api": bench_api,
+    "startup": bench_startup,
+}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """Print metric changes against a baseline; returns the regressions over threshold"""
+    regressions = []
+    print(f"\n{'scenario':32} {'metric':16} {'before':>12} {'after':>12} {'change':>8}")
+    for scenario, metrics in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if not before:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = " !" if worse > threshold else ""
+            print(f"{scenario:32} {metric:16} {old:>12} {new:>12} {change:>+7.1f}%{flag}")
+            if worse > threshold:
+                regressions.append((scenario, metric, change))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local fake CDN")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--output', help="write results JSON here (default: stdout)")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="percent change in the wrong direction that counts as a regression")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds the CDN waits before each response")
+    parser.add_argument('--bandwidth-mb', type=float, default=20.0,
+                        help="per-connection CDN bandwidth in MB/s (0 for unlimited)")
+    parser.add_argument('--size-mb', type=float, default=16.0, help="size of each test video")
+    parser.add_argument('--files', type=int, default=8, help="downloads per download scenario")
+    parser.add_argument('--connections', type=int, default=4,
+                        help="connections for segmented downloads")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="operations run at the same time")
+    parser.add_argument('--hls-seconds', type=int, default=20, help="length of the HLS stream")
+    parser.add_argument('--hls-runs', type=int, default=4, help="HLS conversions")
+    parser.add_argument('--pages', type=int, default=50, help="extractions per extractor")
+    parser.add_argument('--page-kb', type=int, default=512, help="filler after the player block")
+    parser.add_argument('--api-jobs', type=int, default=8, help="downloads submitted to the API")
+    parser.add_argument('--api-clients', type=int, default=8, help="threads polling the API")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for API jobs")
+    parser.add_argument('--startup-runs', type=int, default=10,
+                        help="fresh interpreters started by the startup scenario")
+    parser.add_argument('--quick', action='store_true', help="small sizes for a smoke run")
+    args = parser.parse_args()
+    if args.quick:
+        args.size_mb, args.files, args.hls_seconds, args.hls_runs = 2.0, 2, 4, 1
+        args.pages, args.api_jobs, args.api_clients, args.startup_runs = 5, 2, 2, 3
+    return args
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Downloads, the catalog and the job store all live in a scratch directory
+    workdir = tempfile.mkdtemp(prefix="downloader-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("JOB_STORE_URL", "memory://")
+    import video_downloader
+    video_downloader.setup_logging(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    cdn = FakeCDN(latency=args.latency, bandwidth=int(args.bandwidth_mb * MB)).start()
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "scenarios": {},
+    }
+    try:
+        for name in scenarios:
+            print(f"Running {name} benchmarks...", file=sys.stderr)
+            results["scenarios"].update(BENCHMARKS[name](cdn, workdir, args))
+    finally:
+        cdn.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold}%")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
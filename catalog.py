@@ -0,0 +1,309 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger('catalog')
+
+# Optional inotify support for picking up files written outside the app
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Databases and other state, outside the downloads directory
+STATE_DIR = os.environ.get("STATE_DIR", "./state")
+
+# SQLite file holding the catalog
+CATALOG_DB = os.environ.get("CATALOG_DB", os.path.join(STATE_DIR, "catalog.db"))
+
+# Seconds between directory rescans when inotify isn't available (0 disables)
+CATALOG_RECONCILE_INTERVAL = int(os.environ.get("CATALOG_RECONCILE_INTERVAL", "300"))
+
+SORT_COLUMNS = {
+    "title": "filename COLLATE NOCASE",
+    "size": "size",
+    "mtime": "mtime",
+}
+
+def inode_key(stat):
+    """Identifies a file's data, shared by all hard links to it"""
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+def is_catalog_file(filename):
+    """Whether a downloads-directory entry is a finished download"""
+    return not filename.startswith('.') and not filename.endswith(('.part', '.part.json'))
+
+class Catalog:
+    """Persistent index of finished files in the downloads directory
+
+    The app updates it when downloads finish or are deleted; reconcile()
+    catches changes made outside the app. A version counter, bumped on every
+    change, lets the API answer conditional requests without a rescan. Each
+    file's last access is kept for least-recently-used eviction, and a
+    running byte total, counting hard links to the same data once, gives the
+    storage quota its usage.
+    """
+
+    def __init__(self, directory, db_path=CATALOG_DB):
+        self.directory = directory
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # The database is created on first use, not when the app is imported
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _create_schema(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._open() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    filename TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    added_at REAL NOT NULL,
+                    accessed_at REAL,
+                    inode TEXT
+                );
+                CREATE INDEX IF NOT EXISTS files_size ON files (size);
+                CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('bytes', 0);
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+            if "accessed_at" not in columns:
+                # Catalogs from before access tracking
+                conn.execute("ALTER TABLE files ADD COLUMN accessed_at REAL")
+            if "inode" not in columns:
+                # Catalogs from before usage tracking; reconcile() fills it in
+                conn.execute("ALTER TABLE files ADD COLUMN inode TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_last_used "
+                         "ON files (COALESCE(accessed_at, added_at))")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_inode ON files (inode)")
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def connect(self):
+        with self.schema_lock:
+            if not self.schema_ready:
+                self._create_schema()
+                self.schema_ready = True
+        return self._open()
+
+    def _filename(self, path):
+        """Catalog key for a path, or None if it's outside the downloads directory"""
+        directory = os.path.abspath(self.directory)
+        path = os.path.abspath(path)
+        if os.path.dirname(path) != directory:
+            return None
+        return os.path.basename(path)
+
+    def add(self, path):
+        """Record a finished file"""
+        filename = self._filename(path)
+        if filename is None or not is_catalog_file(filename):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._store(conn, filename, stat.st_size, stat.st_mtime, inode_key(stat))
+            self._bump_version(conn)
+
+    def remove(self, path):
+        """Forget a deleted file; returns the bytes the usage total went down by
+
+        That is 0 while another catalogued name links to the same data.
+        """
+        filename = self._filename(path)
+        if filename is None:
+            return 0
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            freed = self._uncount(conn, filename)
+            if conn.execute("DELETE FROM files WHERE filename = ?", (filename,)).rowcount:
+                self._add_bytes(conn, -freed)
+                self._bump_version(conn)
+        return freed
+
+    def total_bytes(self):
+        """Bytes of all catalogued files, counting each inode once"""
+        with self.connect() as conn:
+            return conn.execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+
+    def get(self, path):
+        """Catalog entry for a path, or None"""
+        filename = self._filename(path)
+        if filename is None:
+            return None
+        with self.connect() as conn:
+            row = conn.execute("SELECT filename, size, mtime FROM files WHERE filename = ?",
+                               (filename,)).fetchone()
+        return self._entry(row) if row else None
+
+    def touch(self, path, when=None):
+        """Record that a file was read; doesn't change the version"""
+        filename = self._filename(path)
+        if filename is None:
+            return
+        with self.connect() as conn:
+            conn.execute("UPDATE files SET accessed_at = ? WHERE filename = ?",
+                         (when or time.time(), filename))
+
+    def least_recently_used(self, limit=100, before=None):
+        """Entries by last access (or when added, if never read), oldest first
+        
+        With before, only entries last used before that time are returned.
+        """
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT filename, size, mtime, COALESCE(accessed_at, added_at) AS last_used "
+                "FROM files WHERE last_used < ? ORDER BY last_used LIMIT ?",
+                (before if before is not None else float('inf'), limit)).fetchall()
+        return [dict(self._entry(row[:3]), last_used=row[3]) for row in rows]
+
+    def list(self, offset=0, limit=50, sort="title", order="asc"):
+        """A page of entries plus the total count"""
+        column = SORT_COLUMNS.get(sort, SORT_COLUMNS["title"])
+        direction = "DESC" if order == "desc" else "ASC"
+        with self.connect() as conn:
+            rows = conn.execute(
+                f"SELECT filename, size, mtime FROM files ORDER BY {column} {direction} "
+                f"LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return [self._entry(row) for row in rows], total
+
+    def version(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def reconcile(self):
+        """Bring the catalog in line with the directory contents"""
+        on_disk = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and is_catalog_file(entry.name):
+                        stat = entry.stat()
+                        on_disk[entry.name] = (stat.st_size, stat.st_mtime, inode_key(stat))
+        except OSError as e:
+            logger.error(f"Catalog rescan failed: {e}")
+            return
+
+        with self.lock, self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            known = {row[0]: tuple(row[1:]) for row in
+                     conn.execute("SELECT filename, size, mtime, inode FROM files")}
+            stale = [(name,) for name in known if name not in on_disk]
+            changed = [(name, size, mtime, time.time(), inode)
+                       for name, (size, mtime, inode) in on_disk.items()
+                       if known.get(name) != (size, mtime, inode)]
+            if stale or changed:
+                conn.executemany("DELETE FROM files WHERE filename = ?", stale)
+                conn.executemany("""
+                    INSERT INTO files (filename, size, mtime, added_at, inode) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (filename) DO UPDATE SET size = excluded.size,
+                        mtime = excluded.mtime, inode = excluded.inode
+                """, changed)
+                self._bump_version(conn)
+            # Recount from scratch, so the running total can't drift
+            conn.execute("""
+                UPDATE meta SET value = (
+                    SELECT COALESCE(SUM(size), 0) FROM (
+                        SELECT MAX(size) AS size FROM files
+                        GROUP BY COALESCE(inode, 'file:' || filename)))
+                WHERE key = 'bytes'
+            """)
+            if not stale and not changed:
+                return
+        logger.info(f"Catalog reconciled: {len(changed)} added or changed, {len(stale)} removed")
+
+    def start_reconciler(self, interval=CATALOG_RECONCILE_INTERVAL):
+        """Reconcile now and keep following the directory in the background"""
+        thread = threading.Thread(target=self._follow, args=(interval,), name="catalog-reconciler")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _follow(self, interval):
+        self.reconcile()
+        if inotify_simple is not None:
+            try:
+                self._watch()
+                return
+            except OSError as e:
+                logger.warning(f"inotify unavailable, falling back to rescans: {e}")
+        while interval:
+            time.sleep(interval)
+            self.reconcile()
+
+    def _watch(self):
+        flags = inotify_simple.flags
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(self.directory, flags.CLOSE_WRITE | flags.MOVED_TO |
+                          flags.MOVED_FROM | flags.DELETE | flags.CREATE)
+        while True:
+            for event in inotify.read():
+                if not event.name or not is_catalog_file(event.name):
+                    continue
+                path = os.path.join(self.directory, event.name)
+                if os.path.isfile(path):
+                    self.add(path)
+                else:
+                    self.remove(path)
+
+    @staticmethod
+    def _bump_version(conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    @staticmethod
+    def _add_bytes(conn, delta):
+        if delta:
+            conn.execute("UPDATE meta SET value = value + ? WHERE key = 'bytes'", (delta,))
+
+    @staticmethod
+    def _only_name(conn, inode):
+        """Whether at most one catalogued file links to inode"""
+        return inode is None or conn.execute("SELECT COUNT(*) FROM files WHERE inode = ?",
+                                             (inode,)).fetchone()[0] <= 1
+
+    def _uncount(self, conn, filename):
+        """Bytes the total loses when filename's entry goes"""
+        row = conn.execute("SELECT size, inode FROM files WHERE filename = ?",
+                           (filename,)).fetchone()
+        if row is None or not self._only_name(conn, row[1]):
+            return 0
+        return row[0]
+
+    def _store(self, conn, filename, size, mtime, inode):
+        """Insert or update an entry, keeping the byte total in step"""
+        delta = -self._uncount(conn, filename)
+        conn.execute("""
+            INSERT INTO files (filename, size, mtime, added_at, inode) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (filename) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                inode = excluded.inode
+        """, (filename, size, mtime, time.time(), inode))
+        if self._only_name(conn, inode):
+            delta += size
+        self._add_bytes(conn, delta)
+
+    def _entry(self, row):
+        filename, size, mtime = row
+        return {
+            "filename": filename,
+            "file_path": os.path.join(self.directory, filename),
+            "file_size": size,
+            "mtime": mtime,
+        }
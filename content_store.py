@@ -0,0 +1,210 @@
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+import threading
+import logging
+from metadata_cache import normalize_url
+
+logger = logging.getLogger('content_store')
+
+# Databases and other state, kept out of the downloads directory so they are
+# never listed, served or deleted as downloads
+STATE_DIR = os.environ.get("STATE_DIR", "./state")
+
+# Blob directory; must be on the same filesystem as the downloads directory so hard links work
+OBJECTS_DIR = os.environ.get("OBJECTS_DIR", os.path.join(STATE_DIR, "objects"))
+
+HASH_ALGORITHM = "sha256"
+
+def new_hasher():
+    return hashlib.new(HASH_ALGORITHM)
+
+def hash_file(path, hasher=None, chunk_size=1024 * 1024):
+    """Feed a file's contents to hasher and return it"""
+    hasher = hasher or new_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+def unique_path(path, reserved=()):
+    """path, or 'name (2).ext', 'name (3).ext', ... if it is taken or reserved"""
+    base, extension = os.path.splitext(path)
+    candidate = path
+    counter = 2
+    while (candidate in reserved or os.path.exists(candidate)
+           or os.path.exists(candidate + '.part')):
+        candidate = f"{base} ({counter}){extension}"
+        counter += 1
+    return candidate
+
+class ContentStore:
+    """Content-addressed blob store with an index of file names and source URLs
+
+    Each finished download is kept once under objects/<xx>/<digest>; files in
+    the downloads directory are hard links to their blob, so identical media
+    fetched from different URLs takes no extra disk.
+    """
+
+    def __init__(self, root=OBJECTS_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        # Paths handed out by claim_path whose download hasn't finished yet
+        self.claimed = set()
+        self.claim_lock = threading.Lock()
+        # The index is created on first use, not when the module is imported
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _create_schema(self):
+        os.makedirs(self.root, exist_ok=True)
+        with self._open() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS names (
+                    path TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS sources (
+                    url TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS names_digest ON names (digest);
+                CREATE INDEX IF NOT EXISTS sources_digest ON sources (digest);
+            """)
+
+    def _open(self):
+        conn = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def connect(self):
+        with self.schema_lock:
+            if not self.schema_ready:
+                self._create_schema()
+                self.schema_ready = True
+        return self._open()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lookup_url(self, url):
+        """Digest of a finished object fetched from url, or None"""
+        if not url:
+            return None
+        with self.connect() as conn:
+            row = conn.execute("SELECT digest FROM sources WHERE url = ?",
+                               (normalize_url(url),)).fetchone()
+        if row and os.path.exists(self.blob_path(row[0])):
+            return row[0]
+        return None
+
+    def lookup_path(self, path):
+        """Digest of the object a downloads-directory file links to, or None"""
+        with self.connect() as conn:
+            row = conn.execute("SELECT digest FROM names WHERE path = ?",
+                               (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def claim_path(self, path, media_url=None):
+        """A path for a new download that won't clobber a different video
+
+        Keeps path when it's free or holds a resumable partial download of
+        the same media URL; otherwise picks 'title (2).ext' and so on. The
+        path stays reserved until release_path, so concurrent downloads in
+        this process never get the same one before either has created it.
+        """
+        with self.claim_lock:
+            path = self._free_path(path, media_url)
+            self.claimed.add(path)
+            return path
+
+    def release_path(self, path):
+        with self.claim_lock:
+            self.claimed.discard(path)
+
+    def _free_path(self, path, media_url):
+        if path in self.claimed:
+            return unique_path(path, self.claimed)
+
+        if not os.path.exists(path) and not os.path.exists(path + '.part'):
+            return path
+
+        if not os.path.exists(path) and media_url:
+            try:
+                with open(path + '.part.json') as f:
+                    if json.load(f).get("url") == media_url:
+                        return path
+            except (OSError, ValueError):
+                pass
+
+        return unique_path(path, self.claimed)
+
+    def materialize(self, digest, path):
+        """Link a stored object into the downloads directory and return its path"""
+        if os.path.exists(path) and self.lookup_path(path) == digest:
+            return path
+
+        path = unique_path(path, self.claimed)
+        self._link(self.blob_path(digest), path)
+        self._record_name(path, digest)
+        logger.info(f"Reused stored object {digest[:12]} for {path}")
+        return path
+
+    def ingest(self, path, digest=None, urls=()):
+        """Move a finished download into the store, deduplicating by content"""
+        if digest is None:
+            digest = hash_file(path).hexdigest()
+
+        blob = self.blob_path(digest)
+        with self.lock:
+            if os.path.exists(blob):
+                # Identical content is already stored, keep a single copy
+                if not os.path.samefile(blob, path):
+                    os.remove(path)
+                    self._link(blob, path)
+                    logger.info(f"Deduplicated {path} against object {digest[:12]}")
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                self._link(path, blob)
+
+        self._record_name(path, digest)
+        with self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO sources (url, digest) VALUES (?, ?)",
+                             [(normalize_url(url), digest) for url in urls if url])
+        return path
+
+    def forget(self, path):
+        """Drop a deleted file from the index and remove its blob if unused"""
+        path = os.path.abspath(path)
+        with self.lock, self.connect() as conn:
+            row = conn.execute("SELECT digest FROM names WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return
+            digest = row[0]
+            conn.execute("DELETE FROM names WHERE path = ?", (path,))
+
+            remaining = conn.execute("SELECT COUNT(*) FROM names WHERE digest = ?",
+                                     (digest,)).fetchone()[0]
+            if not remaining:
+                conn.execute("DELETE FROM sources WHERE digest = ?", (digest,))
+                blob = self.blob_path(digest)
+                if os.path.exists(blob):
+                    os.remove(blob)
+
+    def _record_name(self, path, digest):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO names (path, digest) VALUES (?, ?)",
+                         (os.path.abspath(path), digest))
+
+    @staticmethod
+    def _link(source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            # Filesystems without hard links get a copy instead
+            shutil.copy2(source, target)
+
+# Shared store used by download_video
+default_store = ContentStore()
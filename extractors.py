@@ -0,0 +1,123 @@
+import os
+import codecs
+import logging
+import http_pool
+
+logger = logging.getLogger('extractors')
+
+# Bytes read per step when streaming a page
+PAGE_CHUNK_SIZE = 64 * 1024
+
+# Characters of already-scanned text searched again so matches that span
+# chunks are still found; must exceed the longest match an extractor needs
+PAGE_SCAN_OVERLAP = int(os.environ.get("PAGE_SCAN_OVERLAP", str(128 * 1024)))
+
+# Site extractor functions keyed by registered domain
+registry = {}
+
+def register(*domains):
+    """Decorator that registers a site extractor for domains and their subdomains
+
+    Extractors take the page URL and return a video info dict or None.
+    """
+    def decorator(func):
+        for domain in domains:
+            registry[domain.lower()] = func
+        return func
+    return decorator
+
+def find_extractor(host):
+    """Extractor for a host, trying the host itself and then each parent domain"""
+    labels = (host or '').lower().rstrip('.').split('.')
+    # One dict lookup per label, e.g. de.xvideos.com then xvideos.com
+    for i in range(len(labels) - 1):
+        extractor = registry.get('.'.join(labels[i:]))
+        if extractor is not None:
+            return extractor
+    return None
+
+def best_match(matches, rank):
+    """Best-ranked match from a single pass of a combined pattern
+
+    rank(match) returns a sortable key, or None to skip the match; on equal
+    keys the earliest match wins. Returns None if nothing qualifies.
+    """
+    best = best_key = None
+    for match in matches:
+        key = rank(match)
+        if key is not None and (best_key is None or key > best_key):
+            best, best_key = match, key
+    return best
+
+def ranked(matches, rank):
+    """Matches from best- to worst-ranked, for listing every quality variant
+
+    Takes the same rank function as best_match; matches on equal keys stay
+    in page order.
+    """
+    keyed = []
+    for match in matches:
+        key = rank(match)
+        if key is not None:
+            keyed.append((key, match))
+    keyed.sort(key=lambda item: item[0], reverse=True)
+    return [match for _, match in keyed]
+
+def scan_page(url, patterns, is_complete, headers=None, chunk_size=PAGE_CHUNK_SIZE,
+              overlap=PAGE_SCAN_OVERLAP, limits=None):
+    """Stream a page through named patterns, stopping once is_complete(found)
+
+    found maps each pattern name to its matches in page order. Each pattern
+    picks up where its last search left off: after its last match, or no
+    more than its longest match before the end of the text read so far
+    (limits[name], or `overlap` for patterns without one), so text isn't
+    searched again once no match can still start in it. The connection is
+    closed as soon as is_complete returns true, so the rest of a heavy page
+    is never downloaded or decoded.
+    """
+    found = {name: [] for name in patterns}
+    limits = limits or {}
+    # Page position each pattern's next search starts from
+    resume = dict.fromkeys(patterns, 0)
+    response = http_pool.get(url, headers=headers, timeout=15, stream=True)
+    try:
+        response.raise_for_status()
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        chunks = response.iter_content(chunk_size=chunk_size)
+        window = ''
+        offset = 0  # Page position of window[0]
+        received = 0
+        final = False
+        while not final:
+            chunk = next(chunks, None)
+            final = chunk is None
+            if chunk:
+                received += len(chunk)
+            window += decoder.decode(chunk or b'', final=final)
+            end = offset + len(window)
+
+            for name, pattern in patterns.items():
+                position = resume[name]
+                for match in pattern.finditer(window, position - offset):
+                    if match.end() == len(window) and not final:
+                        # Running into the end of the window, it may still grow
+                        position = offset + match.start()
+                        break
+                    found[name].append(match)
+                    position = offset + match.end()
+                else:
+                    position = max(position, end - limits.get(name, overlap))
+                resume[name] = position
+
+            if not final and is_complete(found):
+                logger.info(f"Found everything after {received} bytes, closing {url}")
+                break
+            # Drop text that no pattern will search again
+            searched = min(resume.values()) - offset
+            if searched > 0:
+                offset += searched
+                window = window[searched:]
+    finally:
+        # Closing an unfinished response drops the connection instead of draining it
+        response.close()
+    return found
@@ -0,0 +1,270 @@
+import os
+import uuid
+import mimetypes
+import threading
+import unicodedata
+import logging
+from collections import OrderedDict
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.http import parse_date
+from werkzeug.wsgi import FileWrapper
+import content_store
+
+logger = logging.getLogger('file_serving')
+
+# Hand finished files to a front proxy instead of sending them from the worker:
+# "x-accel-redirect" for nginx, "x-sendfile" for Apache or lighttpd, empty to serve here
+FILE_OFFLOAD = os.environ.get("FILE_OFFLOAD", "").lower()
+
+# nginx internal location that maps to the downloads directory
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/internal-downloads/")
+
+# Seconds clients and caches may reuse a file without revalidating it
+FILE_CACHE_MAX_AGE = int(os.environ.get("FILE_CACHE_MAX_AGE", "0"))
+
+OFFLOAD_MODES = ("x-accel-redirect", "x-sendfile")
+
+# Ranges in one request; past this (after merging) the whole file is sent
+MAX_RANGES = 16
+
+SEND_CHUNK_SIZE = 256 * 1024
+
+# Content digests of served files, keyed by (path, inode, size, mtime)
+ETAG_CACHE_SIZE = 4096
+etag_cache = OrderedDict()
+etag_cache_lock = threading.Lock()
+
+if FILE_OFFLOAD and FILE_OFFLOAD not in OFFLOAD_MODES:
+    logger.warning(f"Unknown FILE_OFFLOAD {FILE_OFFLOAD!r}, serving files from the worker")
+    FILE_OFFLOAD = ""
+
+def file_etag(path, stat):
+    """Strong ETag for a finished file
+
+    Files in the content store are tagged with their SHA-256, so the same
+    video keeps its ETag under any name and across restarts; others fall
+    back to inode, size and modification time.
+    """
+    key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with etag_cache_lock:
+        if key in etag_cache:
+            etag_cache.move_to_end(key)
+            return etag_cache[key]
+
+    etag = None
+    store = content_store.default_store
+    try:
+        digest = store.lookup_path(path)
+        # Only trust the index while the file is still a link to its blob
+        if digest and os.path.samefile(path, store.blob_path(digest)):
+            etag = f"{content_store.HASH_ALGORITHM}-{digest}"
+    except Exception as e:
+        logger.error(f"Content store lookup failed for {path}: {e}")
+    if etag is None:
+        etag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+    with etag_cache_lock:
+        etag_cache[key] = etag
+        while len(etag_cache) > ETAG_CACHE_SIZE:
+            etag_cache.popitem(last=False)
+    return etag
+
+def parse_ranges(header, size):
+    """Satisfiable ranges of a bytes Range header as sorted, merged (start, stop) pairs
+
+    Returns None for a malformed header, which is then ignored. Overlapping
+    and adjacent ranges are merged so no byte is sent twice.
+    """
+    units, _, specs = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        try:
+            if not first:
+                start, stop = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                stop = min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if start < 0 or (last and first and int(last) < start):
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag, last_modified):
+    """Whether a Range request's If-Range validator, if any, still holds
+
+    A validator of a kind the file doesn't have (None) never holds.
+    """
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        # Strong comparison only
+        return etag is not None and value == f'"{etag}"'
+    if value.startswith('W/') or last_modified is None:
+        return False
+    date = parse_date(value)
+    return date is not None and int(date.timestamp()) == int(last_modified)
+
+def requested_ranges(size, etag, last_modified):
+    """Byte ranges to send as inclusive (start, end) pairs, None for the whole file
+
+    Returns [] when none of the ranges can be satisfied. The Range header is
+    ignored if it is malformed, if If-Range doesn't match or if it asks for
+    more than MAX_RANGES pieces.
+    """
+    header = request.headers.get('Range')
+    if not header or not if_range_matches(etag, last_modified):
+        return None
+    ranges = parse_ranges(header, size)
+    if ranges is None or len(ranges) > MAX_RANGES:
+        return None
+    return [(start, stop - 1) for start, stop in ranges]
+
+def content_disposition(filename, as_attachment):
+    """Content-Disposition parameters, with an ASCII fallback for other names"""
+    kind = "attachment" if as_attachment else "inline"
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        return kind, {"filename": simple,
+                      "filename*": "UTF-8''" + quote(filename, safe="!#$&+^`|~")}
+    return kind, {"filename": filename}
+
+def send_range(path, start, end, size):
+    """Response body for one byte range
+
+    Uses the server's wsgi.file_wrapper, which gunicorn turns into
+    os.sendfile from the current offset for Content-Length bytes, so the
+    data never passes through Python. Other servers may send the wrapped
+    file to its end, so they only get it for ranges that end there.
+    """
+    environ = request.environ
+    wrapper = environ.get('wsgi.file_wrapper')
+    to_end = end == size - 1
+    if not to_end and not environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        return read_ranges(path, [(start, end)])
+
+    f = open(path, 'rb')
+    f.seek(start)
+    if wrapper is not None:
+        return wrapper(f, SEND_CHUNK_SIZE)
+    return FileWrapper(f, SEND_CHUNK_SIZE)
+
+def read_ranges(path, ranges, parts=None):
+    """Yield the bytes of ranges from path, each preceded by its part header if given"""
+    with open(path, 'rb') as f:
+        for index, (start, end) in enumerate(ranges):
+            if parts is not None:
+                yield parts[index]
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(SEND_CHUNK_SIZE, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+        if parts is not None:
+            yield parts[-1]
+
+def multipart_parts(ranges, size, mimetype):
+    """Part headers of a multipart/byteranges body, then its closing delimiter,
+    with the body's content type and length"""
+    boundary = uuid.uuid4().hex
+    parts = [(f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+              f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+             for start, end in ranges]
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    length = sum(len(part) for part in parts) + sum(end - start + 1 for start, end in ranges)
+    return parts, f"multipart/byteranges; boundary={boundary}", length
+
+def multipart_body(path, ranges, size, mimetype):
+    """A multipart/byteranges body and its content type and length"""
+    parts, content_type, length = multipart_parts(ranges, size, mimetype)
+    return read_ranges(path, ranges, parts), content_type, length
+
+def offload_headers(path, filename):
+    if FILE_OFFLOAD == "x-accel-redirect":
+        return {"X-Accel-Redirect": X_ACCEL_PREFIX.rstrip('/') + '/' + quote(filename)}
+    return {"X-Sendfile": os.path.abspath(path)}
+
+def serve_file(path, filename, as_attachment=False):
+    """Response for a finished file with validators, conditional requests and ranges
+
+    With FILE_OFFLOAD set, the body is left to the front proxy, which also
+    handles ranges. Otherwise single ranges and whole files go out through
+    wsgi.file_wrapper, and multiple ranges as multipart/byteranges.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(path, stat)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    response.headers["Cache-Control"] = f"public, max-age={FILE_CACHE_MAX_AGE}"
+    response.headers["Accept-Ranges"] = "bytes"
+    kind, options = content_disposition(filename, as_attachment)
+    response.headers.set("Content-Disposition", kind, **options)
+
+    # If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+            return response
+    elif request.if_modified_since is not None:
+        if int(stat.st_mtime) <= request.if_modified_since.timestamp():
+            response.status_code = 304
+            return response
+
+    if FILE_OFFLOAD:
+        response.headers.update(offload_headers(path, filename))
+        return response
+
+    if request.method == 'HEAD':
+        # Range applies to GET only; describe the whole file without opening it
+        response.headers["Content-Length"] = str(size)
+        return response
+
+    ranges = requested_ranges(size, etag, stat.st_mtime)
+    if ranges == []:
+        response.status_code = 416
+        response.headers["Content-Range"] = f"bytes */{size}"
+        response.headers["Content-Length"] = "0"
+        return response
+
+    if ranges is None:
+        response.response = send_range(path, 0, size - 1, size) if size else []
+        response.headers["Content-Length"] = str(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response.status_code = 206
+        response.response = send_range(path, start, end, size)
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response.headers["Content-Length"] = str(end - start + 1)
+    else:
+        body, content_type, length = multipart_body(path, ranges, size, mimetype)
+        response.status_code = 206
+        response.response = body
+        response.headers["Content-Type"] = content_type
+        response.headers["Content-Length"] = str(length)
+    return response
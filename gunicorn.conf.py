@@ -0,0 +1,20 @@
+import os
+
+# Event streams keep their request open, so each worker serves requests on a
+# pool of threads rather than one at a time
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+# Import the app once in the master and fork workers from it; set GUNICORN_PRELOAD=1
+preload_app = os.environ.get("GUNICORN_PRELOAD", "0") == "1"
+
+def when_ready(server):
+    # Runs in the master after the app is loaded, before any worker is forked
+    if preload_app:
+        import app
+        app.warmup()
+
+def post_fork(server, worker):
+    # Background threads don't survive a fork, so every worker starts its own
+    import app
+    app.start_background()
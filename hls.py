@@ -0,0 +1,241 @@
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import http_pool
+import postprocess
+import bandwidth
+from progress import ProgressTracker
+
+logger = logging.getLogger('hls')
+
+# Segments fetched at the same time
+HLS_CONNECTIONS = int(os.environ.get("HLS_CONNECTIONS", "6"))
+
+# Segments held in memory waiting for their turn to be written to ffmpeg
+HLS_REORDER_WINDOW = int(os.environ.get("HLS_REORDER_WINDOW", "16"))
+
+HLS_SEGMENT_RETRIES = 3
+
+# Bytes read at a time from a segment when its rate is limited
+SEGMENT_CHUNK_SIZE = 64 * 1024
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^",]*)')
+
+class HLSUnsupported(Exception):
+    """Raised for streams the native engine can't handle (live, encrypted)"""
+
+def parse_attributes(value):
+    """Parse an attribute list such as BANDWIDTH=1280000,RESOLUTION=1280x720"""
+    return {name: val.strip('"') for name, val in ATTRIBUTE_RE.findall(value)}
+
+def parse_playlist(text, base_url):
+    """Parse a master or media playlist into variants or segments"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != '#EXTM3U':
+        raise ValueError("Not an M3U8 playlist")
+
+    playlist = {"variants": [], "segments": [], "init": None, "key_method": "NONE",
+                "endlist": False}
+    pending_variant = None
+    pending_byterange = None
+    next_offset = 0
+
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            pending_variant = parse_attributes(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MAP:'):
+            attributes = parse_attributes(line.split(':', 1)[1])
+            playlist["init"] = {"url": urljoin(base_url, attributes["URI"]),
+                                "byterange": None}
+            if "BYTERANGE" in attributes:
+                length, _, offset = attributes["BYTERANGE"].partition('@')
+                playlist["init"]["byterange"] = (int(offset or 0), int(length))
+        elif line.startswith('#EXT-X-KEY:'):
+            method = parse_attributes(line.split(':', 1)[1]).get("METHOD", "NONE")
+            if method != "NONE":
+                playlist["key_method"] = method
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line.split(':', 1)[1].partition('@')
+            start = int(offset) if offset else next_offset
+            pending_byterange = (start, int(length))
+            next_offset = start + int(length)
+        elif line == '#EXT-X-ENDLIST':
+            playlist["endlist"] = True
+        elif not line.startswith('#'):
+            url = urljoin(base_url, line)
+            if pending_variant is not None:
+                resolution = pending_variant.get("RESOLUTION", "0x0")
+                playlist["variants"].append({
+                    "url": url,
+                    "bandwidth": int(pending_variant.get("BANDWIDTH", 0) or 0),
+                    "height": int(resolution.split('x')[-1]) if 'x' in resolution else 0,
+                })
+                pending_variant = None
+            else:
+                playlist["segments"].append({"url": url, "byterange": pending_byterange})
+                pending_byterange = None
+
+    return playlist
+
+def choose_variant(variants, max_height=None):
+    """Highest-bandwidth variant, optionally capped at a resolution"""
+    candidates = [v for v in variants if not max_height or v["height"] <= max_height]
+    return max(candidates or variants, key=lambda v: (v["height"], v["bandwidth"]))
+
+def fetch_text(url, headers):
+    response = http_pool.get(url, headers=headers, timeout=15)
+    response.raise_for_status()
+    return response.text, response.url
+
+def fetch_segment(segment, headers, retries=HLS_SEGMENT_RETRIES, share=None, cancel_event=None):
+    """Fetch one segment's bytes, retrying transient failures
+    
+    With a bandwidth share the segment is read in chunks at the rate it allows.
+    """
+    request_headers = dict(headers)
+    if segment["byterange"] is not None:
+        start, length = segment["byterange"]
+        request_headers['Range'] = f"bytes={start}-{start + length - 1}"
+
+    for attempt in range(1, retries + 1):
+        try:
+            if share is None:
+                response = http_pool.get(segment["url"], headers=request_headers, timeout=30)
+                response.raise_for_status()
+                return response.content
+            
+            host = bandwidth.host_of(segment["url"])
+            response = http_pool.get(segment["url"], headers=request_headers, stream=True,
+                                     timeout=30)
+            try:
+                response.raise_for_status()
+                chunks = []
+                for chunk in response.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    share.consume(len(chunk), host, cancel_event)
+                return b''.join(chunks)
+            finally:
+                response.close()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Segment fetch failed (attempt {attempt}/{retries}): {e}")
+            time.sleep(attempt)
+
+def load_media_playlist(m3u8_url, headers, max_height=None):
+    """Resolve a master playlist to a media playlist and parse it"""
+    text, base_url = fetch_text(m3u8_url, headers)
+    playlist = parse_playlist(text, base_url)
+
+    if playlist["variants"]:
+        variant = choose_variant(playlist["variants"], max_height)
+        logger.info(f"Selected HLS variant {variant['height']}p "
+                    f"({variant['bandwidth']} bps): {variant['url']}")
+        text, base_url = fetch_text(variant["url"], headers)
+        playlist = parse_playlist(text, base_url)
+
+    if playlist["key_method"] != "NONE":
+        raise HLSUnsupported(f"Encrypted stream ({playlist['key_method']})")
+    if not playlist["endlist"]:
+        raise HLSUnsupported("Live stream")
+    if not playlist["segments"]:
+        raise ValueError("Playlist has no segments")
+    return playlist
+
+def print_segment_progress(event):
+    sys.stdout.write(f"\rSegments: {event['segments_completed']}/{event['segments_total']} "
+                     f"({event['percent']:.1f}%) | "
+                     f"Speed: {event['speed']/1024/1024:.2f} MB/s")
+    sys.stdout.flush()
+
+def download_hls(m3u8_url, output_path, headers=None, connections=None, window=None,
+                 max_height=None, progress_callback=None, cancel_event=None, share=None):
+    """Fetch HLS segments in parallel and remux them in order with ffmpeg
+
+    Segments are fetched on a thread pool and handed to ffmpeg's stdin in
+    playlist order through a bounded reorder buffer, so memory use stays at
+    roughly `window` segments. progress_callback receives throttled progress
+    events with segments_completed/segments_total; the byte total is an
+    estimate from the average segment size so far.
+    """
+    if shutil.which('ffmpeg') is None:
+        raise HLSUnsupported("ffmpeg binary not found")
+
+    headers = headers or {}
+    connections = connections or HLS_CONNECTIONS
+    window = max(window or HLS_REORDER_WINDOW, connections)
+    tracker = ProgressTracker(progress_callback or print_segment_progress, stage="hls")
+
+    playlist = load_media_playlist(m3u8_url, headers, max_height)
+    segments = playlist["segments"]
+    if playlist["init"] is not None:
+        segments = [playlist["init"]] + segments
+    total = len(segments)
+    logger.info(f"Fetching {total} HLS segments over {connections} connections")
+
+    part_path = output_path + '.part'
+    ffmpeg_cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-i', 'pipe:0',
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',
+        '-f', 'mp4',
+        part_path
+    ]
+
+    # A stream-copy remux is light, but still takes an ffmpeg slot and runs
+    # niced and CPU-limited like any other ffmpeg process
+    processor = postprocess.default_processor
+    with processor.slot(cancel_event), tempfile.TemporaryFile() as stderr, \
+            ThreadPoolExecutor(max_workers=connections) as executor:
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=stderr,
+                                   preexec_fn=processor.preexec)
+        pending = deque()
+        next_index = 0
+        try:
+            for completed in range(1, total + 1):
+                # Keep the reorder buffer full
+                while next_index < total and len(pending) < window:
+                    pending.append(executor.submit(fetch_segment, segments[next_index], headers,
+                                                   share=share, cancel_event=cancel_event))
+                    next_index += 1
+
+                if cancel_event is not None and cancel_event.is_set():
+                    raise InterruptedError("HLS download cancelled")
+
+                data = pending.popleft().result()
+                process.stdin.write(data)
+                written = tracker.downloaded + len(data)
+                tracker.update(written, total=written * total // completed,
+                               force=(completed == total),
+                               percent=completed / total * 100,
+                               segments_completed=completed, segments_total=total)
+
+            process.stdin.close()
+            returncode = process.wait()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            process.kill()
+            process.wait()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+        if returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg exited with {returncode}: "
+                               f"{stderr.read().decode(errors='replace').strip()}")
+
+    if progress_callback is None:
+        print()  # New line after progress
+    os.replace(part_path, output_path)
+    return output_path
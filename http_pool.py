@@ -0,0 +1,102 @@
+import os
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('http_pool')
+
+# Number of hosts to keep connection pools for
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", "32"))
+
+# Maximum keep-alive connections per host
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "16"))
+
+# Wait for a free connection instead of opening more than HTTP_POOL_MAXSIZE per host
+HTTP_POOL_BLOCK = os.environ.get("HTTP_POOL_BLOCK", "1") == "1"
+
+class SessionPool:
+    """Thread-safe pool of keep-alive HTTP connections shared by all threads
+
+    Each thread gets its own requests.Session (sessions aren't safe to share
+    between threads), but every session is mounted on the same HTTPAdapter,
+    so TCP/TLS connections to a host are reused across threads.
+    """
+
+    def __init__(self, pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 pool_block=HTTP_POOL_BLOCK):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.generation = 0
+        self.adapter = None
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.configure()
+
+    def configure(self, pool_connections=None, pool_maxsize=None, pool_block=None):
+        """Replace the shared adapter with one using new pool sizes"""
+        with self.lock:
+            old_adapter = self.adapter
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if pool_block is not None:
+                self.pool_block = pool_block
+
+            self.adapter = HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize,
+                pool_block=self.pool_block,
+                max_retries=Retry(connect=2, read=0, status=0, backoff_factor=0.5)
+            )
+            self.generation += 1
+
+        if old_adapter is not None:
+            old_adapter.close()
+        logger.info(f"HTTP pool: {self.pool_connections} hosts, "
+                    f"{self.pool_maxsize} connections per host")
+
+    def get_session(self):
+        """Get the calling thread's session, bound to the shared connection pool"""
+        session = getattr(self.local, 'session', None)
+        if session is None or self.local.generation != self.generation:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+            self.local.generation = self.generation
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        """Close all pooled connections"""
+        with self.lock:
+            self.adapter.close()
+
+# Shared pool used by the downloader and extractors
+default_pool = SessionPool()
+
+def get_session():
+    """Get a session bound to the shared connection pool"""
+    return default_pool.get_session()
+
+def configure_pool(pool_connections=None, pool_maxsize=None, pool_block=None):
+    """Change the shared pool sizes"""
+    default_pool.configure(pool_connections, pool_maxsize, pool_block)
+
+def get(url, **kwargs):
+    return default_pool.get(url, **kwargs)
+
+def head(url, **kwargs):
+    return default_pool.head(url, **kwargs)
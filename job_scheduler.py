@@ -0,0 +1,161 @@
+import os
+import bisect
+import itertools
+import threading
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger('job_scheduler')
+
+# Number of downloads that run at the same time
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+
+# Maximum downloads running against one host
+DOWNLOAD_PER_HOST = int(os.environ.get("DOWNLOAD_PER_HOST", "2"))
+
+# Maximum queued downloads before new submissions are rejected
+DOWNLOAD_MAX_QUEUE = int(os.environ.get("DOWNLOAD_MAX_QUEUE", "500"))
+
+class QueueFull(Exception):
+    """Raised when the scheduler queue can't take more jobs"""
+
+class Job:
+    """A unit of work waiting for or running on a scheduler worker"""
+
+    def __init__(self, job_id, func, args, host, priority, seq):
+        self.job_id = job_id
+        self.func = func
+        self.args = args
+        self.host = host
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"
+        self.cancel_event = threading.Event()
+
+    @property
+    def sort_key(self):
+        # Higher priority first, then first in, first out
+        return (-self.priority, self.seq)
+
+class JobScheduler:
+    """Bounded worker pool with priority/FIFO queueing and per-host caps
+
+    Jobs call func(*args, cancel_event=event); long-running work should check
+    the event and stop early once it is set. Jobs can be queued before
+    start(), which runs the worker threads.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST,
+                 max_queue=DOWNLOAD_MAX_QUEUE):
+        self.workers = workers
+        self.per_host = per_host
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.queue = []
+        self.keys = []
+        self.jobs = {}
+        self.running_by_host = defaultdict(int)
+        self.counter = itertools.count()
+        self.stopping = False
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"download-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def submit(self, job_id, func, args=(), host=None, priority=0):
+        """Queue a job, raising QueueFull when the queue is at capacity"""
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                raise QueueFull(f"Download queue is full ({self.max_queue} jobs)")
+
+            job = Job(job_id, func, args, host, priority, next(self.counter))
+            index = bisect.bisect(self.keys, job.sort_key)
+            self.keys.insert(index, job.sort_key)
+            self.queue.insert(index, job)
+            self.jobs[job_id] = job
+            self.condition.notify()
+            return job
+
+    def cancel(self, job_id):
+        """Cancel a queued job or ask a running job to stop"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in ("queued", "running"):
+                return False
+
+            job.cancel_event.set()
+            if job.state == "queued":
+                self._remove_queued(job)
+                job.state = "cancelled"
+                del self.jobs[job_id]
+            return True
+
+    def queue_position(self, job_id):
+        """1-based position of a queued job, or None if it isn't queued"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != "queued":
+                return None
+            return bisect.bisect_left(self.keys, job.sort_key) + 1
+
+    def stats(self):
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "per_host": self.per_host,
+                "queued": len(self.queue),
+                "running": sum(self.running_by_host.values()),
+            }
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _remove_queued(self, job):
+        index = bisect.bisect_left(self.keys, job.sort_key)
+        del self.keys[index]
+        del self.queue[index]
+
+    def _next_job(self):
+        """Highest-priority queued job whose host is under its cap"""
+        for job in self.queue:
+            if job.host is None or self.running_by_host[job.host] < self.per_host:
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None and not self.stopping:
+                    self.condition.wait()
+                    job = self._next_job()
+                if self.stopping:
+                    return
+
+                self._remove_queued(job)
+                job.state = "running"
+                self.running_by_host[job.host] += 1
+
+            try:
+                job.func(*job.args, cancel_event=job.cancel_event)
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed: {e}")
+            finally:
+                with self.condition:
+                    job.state = "done"
+                    self.jobs.pop(job.job_id, None)
+                    self.running_by_host[job.host] -= 1
+                    if not self.running_by_host[job.host]:
+                        del self.running_by_host[job.host]
+                    # A host slot opened up, so a blocked job may now be runnable
+                    self.condition.notify_all()
@@ -0,0 +1,324 @@
+import os
+import copy
+import json
+import uuid
+import sqlite3
+import threading
+import logging
+from urllib.parse import urlparse
+
+logger = logging.getLogger('job_store')
+
+# Databases and other state, outside the downloads directory
+STATE_DIR = os.environ.get("STATE_DIR", "./state")
+
+# Where job state lives: memory://, sqlite:///path/to/jobs.db or postgresql://...
+JOB_STORE_URL = os.environ.get("JOB_STORE_URL", "sqlite:///" + os.path.join(STATE_DIR, "jobs.db"))
+
+def new_job_id():
+    """Collision-free job ID"""
+    return uuid.uuid4().hex
+
+class MemoryJobStore:
+    """Job state for a single process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.counter = 0
+
+    def create(self, job_id, state):
+        with self.lock:
+            self.counter += 1
+            self.jobs[job_id] = (self.counter, copy.deepcopy(state))
+
+    def create_if_absent(self, job_id, state):
+        """Create a job unless one with this ID exists; True if it was created"""
+        with self.lock:
+            if job_id in self.jobs:
+                return False
+            self.counter += 1
+            self.jobs[job_id] = (self.counter, copy.deepcopy(state))
+            return True
+
+    def get(self, job_id):
+        """(version, state) for a job, or (0, None) if it doesn't exist"""
+        with self.lock:
+            version, state = self.jobs.get(job_id, (0, None))
+            return version, copy.deepcopy(state)
+
+    def update(self, job_id, **fields):
+        """Merge fields into a job's state atomically and return the new state"""
+        with self.lock:
+            if job_id not in self.jobs:
+                return None
+            self.counter += 1
+            state = self.jobs[job_id][1]
+            state.update(fields)
+            self.jobs[job_id] = (self.counter, state)
+            return copy.deepcopy(state)
+
+    def delete(self, job_id):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is not None:
+                self.counter += 1
+
+    def delete_if(self, job_id, version):
+        """Delete a job only if it is unchanged since get() returned version"""
+        with self.lock:
+            if job_id not in self.jobs or self.jobs[job_id][0] != version:
+                return False
+            del self.jobs[job_id]
+            self.counter += 1
+            return True
+
+    def list(self):
+        with self.lock:
+            return [(job_id, copy.deepcopy(state)) for job_id, (_, state) in self.jobs.items()]
+
+    def version(self):
+        """Counter that changes whenever any job does"""
+        with self.lock:
+            return self.counter
+
+class SQLiteJobStore:
+    """Job state shared by every worker process on one machine"""
+
+    def __init__(self, path):
+        self.path = path
+        # The database is created on first use, not when the app is imported
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _create_schema(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._open()
+        try:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    state TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+            """)
+        finally:
+            conn.close()
+
+    def _open(self):
+        # Autocommit mode so transactions are explicit
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def connect(self):
+        with self.schema_lock:
+            if not self.schema_ready:
+                self._create_schema()
+                self.schema_ready = True
+        return self._open()
+
+    def _next_version(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def create(self, job_id, state):
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = self._next_version(conn)
+            conn.execute("INSERT INTO jobs (job_id, version, state) VALUES (?, ?, ?)",
+                         (job_id, version, json.dumps(state)))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def create_if_absent(self, job_id, state):
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = self._next_version(conn)
+            created = conn.execute("INSERT OR IGNORE INTO jobs (job_id, version, state) "
+                                   "VALUES (?, ?, ?)",
+                                   (job_id, version, json.dumps(state))).rowcount == 1
+            conn.execute("COMMIT")
+            return created
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT version, state FROM jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return (row[0], json.loads(row[1])) if row else (0, None)
+
+    def update(self, job_id, **fields):
+        conn = self.connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock before reading, so concurrent
+            # read-modify-write updates from other processes can't interleave
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            state = json.loads(row[0])
+            state.update(fields)
+            version = self._next_version(conn)
+            conn.execute("UPDATE jobs SET version = ?, state = ? WHERE job_id = ?",
+                         (version, json.dumps(state), job_id))
+            conn.execute("COMMIT")
+            return state
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def delete(self, job_id):
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,)).rowcount:
+                self._next_version(conn)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def delete_if(self, job_id, version):
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            deleted = conn.execute("DELETE FROM jobs WHERE job_id = ? AND version = ?",
+                                   (job_id, version)).rowcount == 1
+            if deleted:
+                self._next_version(conn)
+            conn.execute("COMMIT")
+            return deleted
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def list(self):
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT job_id, state FROM jobs ORDER BY rowid").fetchall()
+        finally:
+            conn.close()
+        return [(job_id, json.loads(state)) for job_id, state in rows]
+
+    def version(self):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        finally:
+            conn.close()
+
+class PostgresJobStore:
+    """Job state shared across machines through PostgreSQL"""
+
+    def __init__(self, dsn):
+        import psycopg2
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.local = threading.local()
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS download_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    version BIGINT NOT NULL,
+                    state JSONB NOT NULL
+                );
+                CREATE SEQUENCE IF NOT EXISTS download_jobs_version;
+            """)
+
+    def connect(self):
+        # One connection per thread; psycopg2 connections aren't shared safely
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self.psycopg2.connect(self.dsn)
+            self.local.conn = conn
+        return conn
+
+    def create(self, job_id, state):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("INSERT INTO download_jobs (job_id, version, state) "
+                           "VALUES (%s, nextval('download_jobs_version'), %s)",
+                           (job_id, json.dumps(state)))
+
+    def create_if_absent(self, job_id, state):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("INSERT INTO download_jobs (job_id, version, state) "
+                           "VALUES (%s, nextval('download_jobs_version'), %s) "
+                           "ON CONFLICT (job_id) DO NOTHING",
+                           (job_id, json.dumps(state)))
+            return cursor.rowcount == 1
+
+    def get(self, job_id):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT version, state FROM download_jobs WHERE job_id = %s", (job_id,))
+            row = cursor.fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    def update(self, job_id, **fields):
+        # jsonb || merges in a single statement, so the update is atomic
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("UPDATE download_jobs SET state = state || %s::jsonb, "
+                           "version = nextval('download_jobs_version') "
+                           "WHERE job_id = %s RETURNING state",
+                           (json.dumps(fields), job_id))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def delete(self, job_id):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM download_jobs WHERE job_id = %s", (job_id,))
+            # Advance the sequence so version() reflects the deletion
+            cursor.execute("SELECT nextval('download_jobs_version')")
+
+    def delete_if(self, job_id, version):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM download_jobs WHERE job_id = %s AND version = %s",
+                           (job_id, version))
+            deleted = cursor.rowcount == 1
+            if deleted:
+                cursor.execute("SELECT nextval('download_jobs_version')")
+            return deleted
+
+    def list(self):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT job_id, state FROM download_jobs ORDER BY version")
+            return cursor.fetchall()
+
+    def version(self):
+        with self.connect() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT last_value FROM download_jobs_version")
+            return cursor.fetchone()[0]
+
+def create_job_store(url=JOB_STORE_URL):
+    """Build the job store configured by a URL"""
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryJobStore()
+    if scheme == "sqlite":
+        return SQLiteJobStore(url[len("sqlite:///"):])
+    if scheme in ("postgres", "postgresql"):
+        return PostgresJobStore(url)
+    raise ValueError(f"Unsupported job store URL: {url}")
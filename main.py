@@ -1,9 +1,10 @@
 import os
-import logging
-from app import app
+import video_downloader
+
+# Configure logging before the app logs its setup
+video_downloader.setup_logging()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from app import app
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
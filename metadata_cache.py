@@ -0,0 +1,205 @@
+import os
+import copy
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from urllib.parse import urlparse, urlunparse, parse_qsl
+
+logger = logging.getLogger('metadata_cache')
+
+# Maximum entries kept in memory
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "1024"))
+
+# Default lifetime of a cached entry in seconds
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", "3600"))
+
+# Optional SQLite file so the cache survives restarts (empty to disable)
+METADATA_CACHE_DB = os.environ.get("METADATA_CACHE_DB", "")
+
+# Per-site lifetimes; these sites hand out short-lived media URLs
+SITE_TTLS = {
+    "xvideos.com": 1800,
+    "pornhub.com": 1800,
+}
+
+# Query parameters that carry a signed URL's expiry time (Unix seconds)
+EXPIRY_PARAMS = ("expire", "expires", "Expires", "e", "validto", "exp")
+
+# Drop entries this many seconds before their media URL expires
+EXPIRY_MARGIN = 60
+
+def normalize_url(url):
+    """Cache key for a page URL: lowercase scheme and host, no fragment"""
+    parsed = urlparse(url.strip())
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or "/",
+                       parsed.params, parsed.query, ""))
+
+def site_ttl(url):
+    """Lifetime for entries from the site serving url"""
+    host = urlparse(url).netloc.lower()
+    for domain, ttl in SITE_TTLS.items():
+        if host == domain or host.endswith("." + domain):
+            return ttl
+    return METADATA_CACHE_TTL
+
+def signed_url_expiry(media_url):
+    """Expiry time embedded in a signed media URL, or None"""
+    if not media_url:
+        return None
+
+    params = parse_qsl(urlparse(media_url).query)
+    # Akamai-style tokens nest the expiry, e.g. hdnea=st=...~exp=1700000000~hmac=...
+    for name, value in list(params):
+        if "~" in value or name in ("hdnea", "hdnts", "__token__"):
+            params.extend(tuple(part.split("=", 1)) for part in value.split("~") if "=" in part)
+
+    for name, value in params:
+        if name in EXPIRY_PARAMS and value.isdigit():
+            expiry = int(value)
+            # Ignore values that are clearly not Unix timestamps
+            if expiry > 10 ** 9:
+                return expiry
+    return None
+
+def entry_expiry(url, info, now=None):
+    """When an entry for url should expire, honoring signed media URL expiry"""
+    now = time.time() if now is None else now
+    expires_at = now + site_ttl(url)
+
+    # Every cached quality variant has to stay usable, not just the chosen one
+    media_urls = [info.get("url")] + [variant.get("url") for variant in info.get("variants", ())]
+    for media_url in media_urls:
+        signed_expiry = signed_url_expiry(media_url)
+        if signed_expiry is not None:
+            expires_at = min(expires_at, signed_expiry - EXPIRY_MARGIN)
+    return expires_at
+
+class SQLiteCacheBackend:
+    """On-disk cache tier shared by every worker process"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    url TEXT PRIMARY KEY,
+                    info TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        with self.connect() as conn:
+            row = conn.execute("SELECT info, expires_at FROM metadata WHERE url = ?",
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, info, expires_at):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO metadata (url, info, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(info), expires_at))
+
+    def delete(self, key):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM metadata WHERE url = ?", (key,))
+
+    def purge_expired(self, now=None):
+        now = time.time() if now is None else now
+        with self.connect() as conn:
+            conn.execute("DELETE FROM metadata WHERE expires_at <= ?", (now,))
+
+class MetadataCache:
+    """LRU cache of extracted video info keyed by page URL"""
+
+    def __init__(self, max_entries=METADATA_CACHE_SIZE, backend=None):
+        self.max_entries = max_entries
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """Cached info for url, or None if missing or expired"""
+        key = normalize_url(url)
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                info, expires_at = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(info)
+                del self.entries[key]
+
+        if self.backend is not None:
+            try:
+                entry = self.backend.get(key)
+            except Exception as e:
+                logger.error(f"Metadata cache backend error: {e}")
+                entry = None
+            if entry is not None and entry[1] > now:
+                self._remember(key, *entry)
+                with self.lock:
+                    self.hits += 1
+                return copy.deepcopy(entry[0])
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, url, info):
+        """Cache info for url until its site TTL or media URL expiry"""
+        key = normalize_url(url)
+        expires_at = entry_expiry(url, info)
+        if expires_at <= time.time():
+            return
+
+        info = copy.deepcopy(info)
+        self._remember(key, info, expires_at)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, info, expires_at)
+            except Exception as e:
+                logger.error(f"Metadata cache backend error: {e}")
+
+    def invalidate(self, url):
+        key = normalize_url(url)
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.backend is not None:
+            try:
+                self.backend.delete(key)
+            except Exception as e:
+                logger.error(f"Metadata cache backend error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _remember(self, key, info, expires_at):
+        with self.lock:
+            self.entries[key] = (info, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# Shared cache used by get_video_info
+default_cache = MetadataCache(
+    backend=SQLiteCacheBackend(METADATA_CACHE_DB) if METADATA_CACHE_DB else None
+)
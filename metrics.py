@@ -0,0 +1,304 @@
+import os
+import io
+import time
+import pstats
+import bisect
+import cProfile
+import threading
+import tracemalloc
+import logging
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger('metrics')
+
+# Distinct host label values kept per metric; the rest are reported as "other"
+METRICS_MAX_HOSTS = int(os.environ.get("METRICS_MAX_HOSTS", "100"))
+
+# Allow per-job profiling through the API's profile parameter
+JOB_PROFILING = os.environ.get("JOB_PROFILING", "0") == "1"
+
+# Databases and other state, outside the downloads directory
+STATE_DIR = os.environ.get("STATE_DIR", "./state")
+
+# Where per-job profiling reports are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(STATE_DIR, "profiles"))
+
+# Functions and allocation sites listed in a profiling report
+PROFILE_TOP = 40
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+# Seconds; spans a cache hit up to a long transcode
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+# Bytes per second, from 64 KB/s to 1 GB/s
+RATE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A metric family with a fixed set of label names"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((key, self.snapshot(value)) for key, value in self.values.items())
+        for values, value in items:
+            lines.extend(self.render_sample(values, value))
+        return lines
+
+    def snapshot(self, value):
+        return value
+
+    def render_sample(self, values, value):
+        return [f"{self.name}{format_labels(self.labels, values)} {format_value(value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Per-bucket counts, then the sum and count of observations
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self, counts):
+        return list(counts)
+
+    def render_sample(self, values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts[:len(self.buckets)] + [None]):
+            cumulative = counts[-1] if count is None else cumulative + count
+            labels = format_labels(self.labels + ('le',), values + (format_value(float(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, values)
+        lines.append(f"{self.name}_sum{labels} {format_value(float(counts[-2]))}")
+        lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+class Registry:
+    """Metrics rendered in the Prometheus text format
+
+    Collectors are functions called at scrape time that yield
+    (name, help, kind, [(labels dict, value), ...]) for values that already
+    live elsewhere, such as queue depths and cache counters.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=STAGE_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collector(self, func):
+        """Register a scrape-time collector; usable as a decorator"""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                logger.error(f"Metrics collector {collect.__name__} failed: {e}")
+                continue
+            for name, help, kind, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(list(labels), list(labels.values()))} "
+                                 f"{format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+# Shared registry behind /metrics
+default_registry = Registry()
+
+stage_seconds = default_registry.histogram(
+    "downloader_stage_seconds",
+    "Time spent in each stage of a download: extract, probe, first_byte, transfer, hls, "
+    "youtube_dl, remux and transcode",
+    ["stage"])
+transfer_rate = default_registry.histogram(
+    "downloader_transfer_bytes_per_second", "Transfer rate of finished downloads by host",
+    ["host"], buckets=RATE_BUCKETS)
+transfer_bytes = default_registry.counter(
+    "downloader_transfer_bytes_total", "Bytes downloaded by host", ["host"])
+cache_lookups = default_registry.counter(
+    "downloader_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+jobs_finished = default_registry.counter(
+    "downloader_jobs_total", "Finished download jobs by outcome", ["status"])
+
+known_hosts = set()
+known_hosts_lock = threading.Lock()
+
+def host_label(url):
+    """Host of url as a label value, capped at METRICS_MAX_HOSTS distinct hosts"""
+    host = (urlparse(url).hostname or 'unknown').lower()
+    with known_hosts_lock:
+        if host in known_hosts:
+            return host
+        if len(known_hosts) < METRICS_MAX_HOSTS:
+            known_hosts.add(host)
+            return host
+    return "other"
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+@contextmanager
+def timed(stage):
+    """Record the time spent in the block as a stage, whether or not it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+def observe_transfer(url, nbytes, seconds):
+    """Record a finished transfer's size and rate against its host"""
+    host = host_label(url)
+    transfer_bytes.inc(nbytes, host=host)
+    if seconds > 0 and nbytes:
+        transfer_rate.observe(nbytes / seconds, host=host)
+
+def render():
+    return default_registry.render()
+
+# tracemalloc is process-wide; it runs while any job asks for it
+tracemalloc_users = 0
+tracemalloc_lock = threading.Lock()
+
+# Python allows one cProfile profiler at a time, so jobs take turns
+cprofile_lock = threading.Lock()
+
+class ProfilerBusy(Exception):
+    """Raised when a job asks for cprofile while another job holds it"""
+
+def profile_path(job_id, mode):
+    return os.path.join(PROFILE_DIR, f"{job_id}.{mode}.txt")
+
+@contextmanager
+def profile_job(job_id, mode):
+    """Profile the block and write a text report to profile_path(job_id, mode)
+
+    cprofile records calls made on the current thread only, which covers
+    extraction; tracemalloc reports allocations made anywhere in the process
+    while the block runs, so concurrent jobs show up in each other's reports.
+    Only one job is profiled with cprofile at a time; others get ProfilerBusy.
+    """
+    global tracemalloc_users
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profiling mode: {mode}")
+
+    profiler = None
+    before = None
+    if mode == "cprofile":
+        if not cprofile_lock.acquire(blocking=False):
+            raise ProfilerBusy("Another download is being profiled with cprofile")
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiling tool, such as a debugger, is active
+            cprofile_lock.release()
+            raise ProfilerBusy(str(e))
+    else:
+        with tracemalloc_lock:
+            if tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc_users += 1
+        before = tracemalloc.take_snapshot()
+    try:
+        yield profile_path(job_id, mode)
+    finally:
+        report = io.StringIO()
+        if profiler is not None:
+            profiler.disable()
+            cprofile_lock.release()
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        else:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            with tracemalloc_lock:
+                tracemalloc_users -= 1
+                if tracemalloc_users == 0:
+                    tracemalloc.stop()
+            report.write(f"Traced memory: current {current} bytes, peak {peak} bytes\n\n")
+            for stat in after.compare_to(before, 'lineno')[:PROFILE_TOP]:
+                report.write(f"{stat}\n")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(profile_path(job_id, mode), 'w') as f:
+                f.write(report.getvalue())
+        except OSError as e:
+            logger.error(f"Couldn't write profile for {job_id}: {e}")
@@ -0,0 +1,200 @@
+import os
+import time
+import tempfile
+import threading
+import subprocess
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import metrics
+from progress import ProgressTracker, follow_ffmpeg_progress
+
+# Process limits are only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('postprocess')
+
+# ffmpeg processes that run at the same time
+FFMPEG_WORKERS = int(os.environ.get("FFMPEG_WORKERS", str(os.cpu_count() or 2)))
+
+# Niceness added to ffmpeg processes so downloads and requests stay responsive
+FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", "10"))
+
+# CPU seconds one ffmpeg process may use (0 disables)
+FFMPEG_CPU_LIMIT = int(os.environ.get("FFMPEG_CPU_LIMIT", "7200"))
+
+# Wall-clock seconds before a stuck ffmpeg process is killed (0 disables)
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", "3600"))
+
+# Remembered remux/transcode decisions
+DECISION_CACHE_SIZE = 1024
+
+WATCH_INTERVAL = 0.5
+
+def limit_resources(nice=FFMPEG_NICE, cpu_limit=FFMPEG_CPU_LIMIT):
+    """preexec_fn that lowers a child's priority and caps its CPU time"""
+    def preexec():
+        if nice:
+            os.nice(nice)
+        if resource is not None and cpu_limit:
+            # SIGXCPU at the soft limit, SIGKILL shortly after
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+    return preexec if os.name == 'posix' else None
+
+class PostProcessor:
+    """Bounded executor for CPU-bound ffmpeg work
+
+    At most `workers` ffmpeg processes run at once; callers wait for a slot,
+    so download threads stay free for network work and the box isn't
+    oversubscribed. Processes run niced with a CPU-time limit, are killed on
+    timeout or cancellation, and are always reaped.
+
+    convert() remuxes when it can and transcodes when it must, remembering
+    which one worked per source key so retries skip the failed attempt.
+    """
+
+    def __init__(self, workers=FFMPEG_WORKERS, nice=FFMPEG_NICE, cpu_limit=FFMPEG_CPU_LIMIT,
+                 timeout=FFMPEG_TIMEOUT):
+        self.workers = workers
+        self.preexec = limit_resources(nice, cpu_limit)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.decisions = OrderedDict()
+
+    @contextmanager
+    def slot(self, cancel_event=None):
+        """Hold one of the ffmpeg slots for a process started by the caller
+
+        Raises InterruptedError if cancel_event is set while waiting.
+        """
+        with self.lock:
+            self.queued += 1
+        try:
+            while not self.slots.acquire(timeout=WATCH_INTERVAL):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise InterruptedError("Cancelled while waiting for ffmpeg")
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+        with self.lock:
+            self.running += 1
+        try:
+            yield
+            with self.lock:
+                self.completed += 1
+        except BaseException:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.slots.release()
+
+    def run(self, cmd, progress_callback=None, cancel_event=None, timeout=None,
+            stage="ffmpeg"):
+        """Run an ffmpeg command that writes -progress reports to stdout
+
+        Raises subprocess.CalledProcessError on failure, subprocess.TimeoutExpired
+        on timeout and InterruptedError when cancel_event is set.
+        """
+        with self.slot(cancel_event), metrics.timed(stage):
+            self._run(cmd, progress_callback, cancel_event,
+                      self.timeout if timeout is None else timeout, stage)
+
+    def _run(self, cmd, progress_callback, cancel_event, timeout, stage):
+        tracker = ProgressTracker(progress_callback, stage=stage)
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                                       preexec_fn=self.preexec)
+            outcome = {}
+
+            def watch():
+                # Kill the process on timeout or cancellation; the reader sees EOF
+                deadline = time.time() + timeout if timeout else None
+                while process.poll() is None:
+                    if cancel_event is not None and cancel_event.is_set():
+                        outcome["cancelled"] = True
+                    elif deadline is not None and time.time() > deadline:
+                        outcome["timed_out"] = True
+                    else:
+                        time.sleep(WATCH_INTERVAL)
+                        continue
+                    process.kill()
+                    return
+
+            watcher = threading.Thread(target=watch, name="ffmpeg-watch")
+            watcher.daemon = True
+            watcher.start()
+            try:
+                follow_ffmpeg_progress(process.stdout, tracker, log_fd=stderr.fileno())
+            finally:
+                # Always reap the process so none are left as zombies
+                if process.poll() is None:
+                    process.kill()
+                returncode = process.wait()
+                watcher.join()
+
+            if outcome.get("cancelled"):
+                raise InterruptedError("ffmpeg cancelled")
+            if outcome.get("timed_out"):
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            if returncode != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(returncode, cmd,
+                                                    stderr=stderr.read().decode(errors='replace'))
+        if progress_callback is None:
+            print()  # New line after progress
+
+    def decision(self, key):
+        """Remembered "remux" or "transcode" for a source key, or None"""
+        with self.lock:
+            mode = self.decisions.get(key)
+            if mode is not None:
+                self.decisions.move_to_end(key)
+            return mode
+
+    def remember(self, key, mode):
+        with self.lock:
+            self.decisions[key] = mode
+            self.decisions.move_to_end(key)
+            while len(self.decisions) > DECISION_CACHE_SIZE:
+                self.decisions.popitem(last=False)
+
+    def convert(self, key, build_command, progress_callback=None, cancel_event=None):
+        """Remux, or transcode if remuxing fails, with the command from build_command(mode)"""
+        mode = self.decision(key) or "remux"
+        try:
+            self.run(build_command(mode), progress_callback, cancel_event, stage=mode)
+        except subprocess.CalledProcessError as e:
+            if mode != "remux":
+                raise
+            logger.info(f"Remux failed for {key}, transcoding instead: "
+                        f"{(e.stderr or '').strip()[-200:]}")
+            mode = "transcode"
+            self.run(build_command(mode), progress_callback, cancel_event, stage=mode)
+        self.remember(key, mode)
+        return mode
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "remembered_decisions": len(self.decisions),
+            }
+
+# Shared executor for ffmpeg work
+default_processor = PostProcessor()
@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import time
+import threading
+
+# Minimum seconds between progress events for one download
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.5"))
+
+# Weight of the newest sample in the smoothed transfer rate
+RATE_SMOOTHING = 0.3
+
+# Input duration in ffmpeg's log, e.g. "Duration: 00:04:13.52"
+FFMPEG_DURATION = re.compile(rb'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+# Bytes at the start of ffmpeg's log searched for the input duration
+FFMPEG_BANNER_SIZE = 65536
+
+def print_progress(event):
+    """Display a progress event on stdout"""
+    total = event["total_bytes"]
+    sys.stdout.write(f"\rProgress: {event['percent']:.1f}% | "
+                     f"{event['downloaded_bytes']/1024/1024:.2f} MB / {total/1024/1024:.2f} MB | "
+                     f"Speed: {event['speed']/1024/1024:.2f} MB/s")
+    sys.stdout.flush()
+
+class ProgressTracker:
+    """Turns raw byte counts into throttled progress events
+
+    Events are dicts with downloaded_bytes, total_bytes, percent, speed
+    (bytes/s) and eta (seconds, or None), plus the fields given to the
+    constructor and any extra fields passed to update(). The callback runs at
+    most once per interval, except for forced updates such as the final one.
+    """
+
+    def __init__(self, callback=None, total=0, downloaded=0, interval=PROGRESS_INTERVAL,
+                 stage=None, **fields):
+        self.callback = callback or print_progress
+        self.total = total
+        self.downloaded = downloaded
+        self.interval = interval
+        self.stage = stage
+        self.fields = fields
+        self.speed = 0.0
+        self.lock = threading.Lock()
+        self.last_emit = 0.0
+        self.last_sample_time = time.time()
+        self.last_sample_bytes = downloaded
+
+    def add(self, length, **extra):
+        """Count length more bytes, e.g. one chunk written by any thread"""
+        with self.lock:
+            self.downloaded += length
+            event = self._event_if_due(False, extra)
+        if event is not None:
+            self.callback(event)
+
+    def update(self, downloaded=None, total=None, force=False, **extra):
+        """Set absolute progress, e.g. from a youtube-dl or ffmpeg report"""
+        with self.lock:
+            if downloaded is not None:
+                self.downloaded = downloaded
+            if total:
+                self.total = total
+            event = self._event_if_due(force, extra)
+        if event is not None:
+            self.callback(event)
+
+    def finish(self, **extra):
+        """Emit a final event, bypassing the throttle"""
+        self.update(force=True, **extra)
+
+    def _event_if_due(self, force, extra):
+        now = time.time()
+        if not force and now - self.last_emit < self.interval:
+            return None
+
+        # Smooth the rate over samples taken at emission time
+        elapsed = now - self.last_sample_time
+        if elapsed > 0:
+            sample = (self.downloaded - self.last_sample_bytes) / elapsed
+            self.speed = sample if not self.speed else (
+                RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.speed)
+        self.last_sample_time = now
+        self.last_sample_bytes = self.downloaded
+        self.last_emit = now
+
+        remaining = self.total - self.downloaded if self.total else None
+        event = {
+            "downloaded_bytes": self.downloaded,
+            "total_bytes": self.total,
+            "percent": min(self.downloaded / self.total * 100, 100.0) if self.total else 0.0,
+            "speed": self.speed,
+            "eta": remaining / self.speed if remaining is not None and self.speed > 0 else None,
+        }
+        if self.stage:
+            event["stage"] = self.stage
+        event.update(self.fields)
+        event.update(extra)
+        return event
+
+def youtube_dl_hook(tracker):
+    """youtube-dl progress hook that feeds a ProgressTracker"""
+    def hook(d):
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if d.get('status') == 'downloading':
+            tracker.update(d.get('downloaded_bytes', 0), total)
+        elif d.get('status') == 'finished':
+            tracker.finish(downloaded=d.get('downloaded_bytes') or total, total=total)
+    return hook
+
+def ffmpeg_duration(log_fd):
+    """Input duration in seconds from the start of an ffmpeg log file, or None
+
+    Reads with pread so the offset ffmpeg is writing at doesn't move.
+    """
+    match = FFMPEG_DURATION.search(os.pread(log_fd, FFMPEG_BANNER_SIZE, 0))
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def follow_ffmpeg_progress(stream, tracker, duration=None, log_fd=None):
+    """Read ffmpeg -progress key=value output and feed a ProgressTracker
+
+    ffmpeg reports output bytes and media time; with a known duration (in
+    seconds) the percentage follows media time instead of bytes, and the
+    total size and ETA are projected from the share of media written. With
+    log_fd, the file ffmpeg logs to, the duration is taken from its input
+    banner (live streams have none).
+    """
+    report = {}
+    for raw_line in stream:
+        key, _, value = raw_line.decode(errors='replace').strip().partition('=')
+        report[key] = value
+        if key != 'progress':
+            continue
+
+        total_size = report.get('total_size', '')
+        size = int(total_size) if total_size.isdigit() else 0
+        out_time_us = report.get('out_time_us') or report.get('out_time_ms') or '0'
+        media_time = int(out_time_us) / 1000000 if out_time_us.isdigit() else 0
+        if not duration and log_fd is not None:
+            duration = ffmpeg_duration(log_fd)
+        extra = {"media_time": media_time}
+        total = None
+        if duration:
+            extra["percent"] = min(media_time / duration * 100, 100.0)
+            if media_time > 0:
+                total = max(int(size * duration / media_time), size)
+        tracker.update(size, total=total, force=(value == 'end'), **extra)
+        report = {}
+
+class ProgressBroker:
+    """Latest state per job plus a way to wait for changes (for SSE)"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.states = {}
+
+    def publish(self, job_id, state):
+        with self.condition:
+            version = self.states.get(job_id, (0, None))[0] + 1
+            self.states[job_id] = (version, state)
+            self.condition.notify_all()
+
+    def wait(self, job_id, last_version=0, timeout=15):
+        """Wait for a state newer than last_version; returns (version, state)
+
+        Returns (last_version, None) on timeout, and (0, None) once a job
+        seen before has been discarded.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                version, state = self.states.get(job_id, (0, None))
+                if version > last_version or (last_version and job_id not in self.states):
+                    return version, state
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return last_version, None
+                self.condition.wait(remaining)
+
+    def job_ids(self):
+        with self.condition:
+            return list(self.states)
+
+    def discard(self, job_id):
+        """Forget a job, waking anyone waiting on it"""
+        with self.condition:
+            if self.states.pop(job_id, None) is not None:
+                self.condition.notify_all()
@@ -1,6 +1,7 @@
 // Global variables for tracking downloads
 let activeDownloads = {};
 let pollInterval = null;
+let downloadsListEtag = null;
 
 document.addEventListener('DOMContentLoaded', function() {
     // Initialize the page
@@ -48,6 +49,9 @@ function initDownloadForm() {
                          aria-valuemin="0" aria-valuemax="100"></div>
                 </div>
                 <p class="mt-2 text-muted status-text">Initializing download...</p>
+                <button type="button" class="btn btn-sm btn-outline-danger cancel-btn d-none">
+                    <i class="fas fa-times"></i> Cancel
+                </button>
             </div>
         `;
         
@@ -70,10 +74,18 @@ function initDownloadForm() {
                     element: statusCard,
                     url: url
                 };
+                subscribeToDownload(downloadId);
                 
                 // Update status element with download ID
                 statusCard.dataset.downloadId = downloadId;
                 
+                // Allow cancelling while the download is queued or running
+                const cancelButton = statusCard.querySelector('.cancel-btn');
+                cancelButton.classList.remove('d-none');
+                cancelButton.addEventListener('click', function() {
+                    cancelDownload(downloadId);
+                });
+                
                 // Reset form for new input
                 urlInput.value = '';
                 
@@ -112,10 +124,65 @@ function startStatusPolling() {
 }
 
 function updateAllDownloadStatus() {
-    // Check status for all active downloads
+    // Check status for active downloads that don't have a live event stream
     for (const downloadId in activeDownloads) {
-        updateDownloadStatus(downloadId);
+        if (!activeDownloads[downloadId].events) {
+            updateDownloadStatus(downloadId);
+        }
+    }
+}
+
+function subscribeToDownload(downloadId) {
+    // Fall back to polling in browsers without Server-Sent Events
+    if (!window.EventSource) return;
+    
+    const downloadInfo = activeDownloads[downloadId];
+    const events = new EventSource(`/api/download-events/${downloadId}`);
+    downloadInfo.events = events;
+    
+    events.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        renderDownloadStatus(downloadId, data);
+        if (data.status === 'completed' || data.status === 'failed' || data.status === 'cancelled') {
+            events.close();
+        }
+    };
+    
+    events.addEventListener('reconnect', function() {
+        // The server ends long-lived streams; open a new one
+        events.close();
+        if (activeDownloads[downloadId]) {
+            subscribeToDownload(downloadId);
+        }
+    });
+    
+    events.onerror = function() {
+        // Let the polling loop take over if the stream drops
+        events.close();
+        if (activeDownloads[downloadId]) {
+            activeDownloads[downloadId].events = null;
+        }
+    };
+}
+
+function formatTransfer(data) {
+    // Describe download progress, e.g. "12.3 MB of 80.0 MB at 2.10 MB/s, 32s left"
+    if (!data.downloaded_bytes) {
+        return 'Downloading video...';
+    }
+    
+    const mb = bytes => (bytes / 1024 / 1024).toFixed(1);
+    let text = `${mb(data.downloaded_bytes)} MB`;
+    if (data.total_bytes) {
+        text += ` of ${mb(data.total_bytes)} MB`;
+    }
+    if (data.speed) {
+        text += ` at ${(data.speed / 1024 / 1024).toFixed(2)} MB/s`;
+    }
+    if (data.eta !== null && data.eta !== undefined) {
+        text += `, ${Math.round(data.eta)}s left`;
     }
+    return text;
 }
 
 function updateDownloadStatus(downloadId) {
@@ -133,82 +200,7 @@ function updateDownloadStatus(downloadId) {
             }
             return response.json();
         })
-        .then(data => {
-            // Update status card
-            const statusTitle = statusCard.querySelector('.card-title');
-            const statusText = statusCard.querySelector('.status-text');
-            const progressBar = statusCard.querySelector('.progress-bar');
-            const cardText = statusCard.querySelector('.card-text');
-            
-            // Update title and text based on status
-            if (data.title && cardText) {
-                cardText.textContent = data.title;
-            }
-            
-            switch (data.status) {
-                case 'initializing':
-                    statusTitle.textContent = 'Initializing';
-                    statusText.textContent = 'Setting up download...';
-                    progressBar.style.width = '5%';
-                    progressBar.setAttribute('aria-valuenow', '5');
-                    break;
-                    
-                case 'extracting_info':
-                    statusTitle.textContent = 'Extracting Info';
-                    statusText.textContent = 'Getting video information...';
-                    progressBar.style.width = '10%';
-                    progressBar.setAttribute('aria-valuenow', '10');
-                    break;
-                    
-                case 'downloading':
-                    statusTitle.textContent = 'Downloading';
-                    statusText.textContent = `Downloading video...`;
-                    // Set progress if available
-                    const progress = data.progress || 0;
-                    progressBar.style.width = `${progress}%`;
-                    progressBar.setAttribute('aria-valuenow', progress);
-                    break;
-                    
-                case 'completed':
-                    statusTitle.textContent = 'Completed';
-                    statusText.textContent = 'Download complete!';
-                    progressBar.style.width = '100%';
-                    progressBar.setAttribute('aria-valuenow', '100');
-                    progressBar.classList.remove('progress-bar-animated', 'progress-bar-striped');
-                    progressBar.classList.add('bg-success');
-                    
-                    // Add download button if file path is available
-                    if (data.file_path) {
-                        const filename = data.file_path.split('/').pop();
-                        const downloadButton = document.createElement('a');
-                        downloadButton.href = `/download/${encodeURIComponent(filename)}`;
-                        downloadButton.className = 'btn btn-success mt-2';
-                        downloadButton.innerHTML = '<i class="fas fa-download"></i> Download File';
-                        
-                        // Check if button already exists
-                        if (!statusCard.querySelector('.btn-success')) {
-                            statusCard.querySelector('.card-body').appendChild(downloadButton);
-                        }
-                    }
-                    break;
-                    
-                case 'failed':
-                    statusTitle.textContent = 'Failed';
-                    statusText.textContent = data.error || 'Download failed';
-                    progressBar.style.width = '100%';
-                    progressBar.setAttribute('aria-valuenow', '100');
-                    progressBar.classList.remove('progress-bar-animated', 'progress-bar-striped');
-                    progressBar.classList.add('bg-danger');
-                    break;
-            }
-            
-            // Remove from active downloads if completed or failed
-            if (data.status === 'completed' || data.status === 'failed') {
-                setTimeout(() => {
-                    delete activeDownloads[downloadId];
-                }, 10000); // Keep in list for 10 seconds after completion
-            }
-        })
+        .then(data => renderDownloadStatus(downloadId, data))
         .catch(error => {
             console.error('Error fetching download status:', error);
             
@@ -222,13 +214,137 @@ function updateDownloadStatus(downloadId) {
         });
 }
 
+function renderDownloadStatus(downloadId, data) {
+    // Get status element
+    const downloadInfo = activeDownloads[downloadId];
+    if (!downloadInfo || !downloadInfo.element) return;
+    
+    const statusCard = downloadInfo.element;
+    
+    // Update status card
+    const statusTitle = statusCard.querySelector('.card-title');
+    const statusText = statusCard.querySelector('.status-text');
+    const progressBar = statusCard.querySelector('.progress-bar');
+    const cardText = statusCard.querySelector('.card-text');
+    
+    // Update title and text based on status
+    if (data.title && cardText) {
+        cardText.textContent = data.title;
+    }
+    
+    switch (data.status) {
+        case 'queued':
+            statusTitle.textContent = 'Queued';
+            statusText.textContent = data.queue_position
+                ? `Waiting in queue (position ${data.queue_position})...`
+                : 'Waiting in queue...';
+            progressBar.style.width = '0%';
+            progressBar.setAttribute('aria-valuenow', '0');
+            break;
+            
+        case 'initializing':
+            statusTitle.textContent = 'Initializing';
+            statusText.textContent = 'Setting up download...';
+            progressBar.style.width = '5%';
+            progressBar.setAttribute('aria-valuenow', '5');
+            break;
+            
+        case 'extracting_info':
+            statusTitle.textContent = 'Extracting Info';
+            statusText.textContent = 'Getting video information...';
+            progressBar.style.width = '10%';
+            progressBar.setAttribute('aria-valuenow', '10');
+            break;
+            
+        case 'downloading':
+            statusTitle.textContent = 'Downloading';
+            statusText.textContent = formatTransfer(data);
+            // Set progress if available
+            const progress = data.progress || 0;
+            progressBar.style.width = `${progress}%`;
+            progressBar.setAttribute('aria-valuenow', progress);
+            
+            // MP4 downloads can be played before they finish
+            if (data.file_path && data.file_path.endsWith('.mp4') && !statusCard.querySelector('.play-btn')) {
+                const filename = data.file_path.split('/').pop();
+                const playButton = document.createElement('a');
+                playButton.href = `/stream/${encodeURIComponent(filename)}`;
+                playButton.target = '_blank';
+                playButton.className = 'btn btn-sm btn-primary mt-2 me-2 play-btn';
+                playButton.innerHTML = '<i class="fas fa-play"></i> Play while downloading';
+                statusCard.querySelector('.card-body').appendChild(playButton);
+            }
+            break;
+            
+        case 'completed':
+            statusTitle.textContent = 'Completed';
+            statusText.textContent = 'Download complete!';
+            progressBar.style.width = '100%';
+            progressBar.setAttribute('aria-valuenow', '100');
+            progressBar.classList.remove('progress-bar-animated', 'progress-bar-striped');
+            progressBar.classList.add('bg-success');
+            
+            // Add download button if file path is available
+            if (data.file_path) {
+                const filename = data.file_path.split('/').pop();
+                const downloadButton = document.createElement('a');
+                downloadButton.href = `/download/${encodeURIComponent(filename)}`;
+                downloadButton.className = 'btn btn-success mt-2';
+                downloadButton.innerHTML = '<i class="fas fa-download"></i> Download File';
+                
+                // Check if button already exists
+                if (!statusCard.querySelector('.btn-success')) {
+                    statusCard.querySelector('.card-body').appendChild(downloadButton);
+                }
+            }
+            break;
+            
+        case 'failed':
+            statusTitle.textContent = 'Failed';
+            statusText.textContent = data.error || 'Download failed';
+            progressBar.style.width = '100%';
+            progressBar.setAttribute('aria-valuenow', '100');
+            progressBar.classList.remove('progress-bar-animated', 'progress-bar-striped');
+            progressBar.classList.add('bg-danger');
+            break;
+            
+        case 'cancelled':
+            statusTitle.textContent = 'Cancelled';
+            statusText.textContent = 'Download cancelled';
+            progressBar.classList.remove('progress-bar-animated', 'progress-bar-striped');
+            progressBar.classList.add('bg-secondary');
+            break;
+    }
+    
+    // Remove from active downloads if completed, failed or cancelled
+    if (data.status === 'completed' || data.status === 'failed' || data.status === 'cancelled') {
+        const cancelButton = statusCard.querySelector('.cancel-btn');
+        if (cancelButton) {
+            cancelButton.classList.add('d-none');
+        }
+        setTimeout(() => {
+            delete activeDownloads[downloadId];
+        }, 10000); // Keep in list for 10 seconds after completion
+    }
+}
+
 function refreshDownloadsList() {
     const downloadsList = document.getElementById('downloadsList');
     if (!downloadsList) return;
     
     fetch('/api/downloads')
-        .then(response => response.json())
+        .then(response => {
+            // Skip re-rendering when the list hasn't changed
+            const etag = response.headers.get('ETag');
+            if (etag && etag === downloadsListEtag && downloadsList.querySelector('table')) {
+                return null;
+            }
+            downloadsListEtag = etag;
+            return response.json();
+        })
         .then(data => {
+            if (!data) return;
+            
             // Clear current list, preserving the title
             downloadsList.innerHTML = '';
             
@@ -292,6 +408,14 @@ function refreshDownloadsList() {
                         statusClass = 'warning';
                         statusLabel = 'Initializing';
                         break;
+                    case 'queued':
+                        statusClass = 'secondary';
+                        statusLabel = 'Queued';
+                        break;
+                    case 'cancelled':
+                        statusClass = 'dark';
+                        statusLabel = 'Cancelled';
+                        break;
                 }
                 
                 // Create actions based on status
@@ -344,6 +468,25 @@ function refreshDownloadsList() {
         });
 }
 
+function cancelDownload(downloadId) {
+    fetch(`/api/cancel-download/${downloadId}`, {
+        method: 'POST'
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showAlert('Download cancelled', 'info');
+            updateDownloadStatus(downloadId);
+        } else {
+            showAlert(data.error || 'Failed to cancel download', 'danger');
+        }
+    })
+    .catch(error => {
+        console.error('Error cancelling download:', error);
+        showAlert('An error occurred while cancelling the download', 'danger');
+    });
+}
+
 function deleteDownload(filepath) {
     const formData = new FormData();
     formData.append('file_path', filepath);
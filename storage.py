@@ -0,0 +1,385 @@
+import os
+import json
+import time
+import shutil
+import threading
+import logging
+import content_store
+
+logger = logging.getLogger('storage')
+
+# Directory the quota applies to; state such as databases lives elsewhere
+DOWNLOAD_DIR = "./downloads"
+
+# Bytes the downloads directory may hold (0 for no quota)
+STORAGE_QUOTA = int(os.environ.get("STORAGE_QUOTA", "0"))
+
+# Bytes eviction brings usage down to once it has to run (0 for 90% of the quota)
+STORAGE_LOW_WATER = int(os.environ.get("STORAGE_LOW_WATER", "0"))
+
+# Bytes to leave free on the filesystem whether or not there is a quota
+STORAGE_MIN_FREE = int(os.environ.get("STORAGE_MIN_FREE", "0"))
+
+# What a download that doesn't fit does: "wait" for space or "reject" it
+STORAGE_FULL_POLICY = os.environ.get("STORAGE_FULL_POLICY", "wait").lower()
+
+# Seconds a download waits for space before it fails
+STORAGE_WAIT_TIMEOUT = int(os.environ.get("STORAGE_WAIT_TIMEOUT", "3600"))
+
+# Seconds after its last access a file can't be evicted, so playback isn't cut off
+STORAGE_EVICT_GRACE = int(os.environ.get("STORAGE_EVICT_GRACE", "300"))
+
+# Seconds between background usage checks
+STORAGE_CHECK_INTERVAL = int(os.environ.get("STORAGE_CHECK_INTERVAL", "60"))
+
+# Seconds between catalog writes for repeated reads of the same file
+TOUCH_INTERVAL = 60
+
+# Seconds between rescans while a download waits for space
+WAIT_POLL_INTERVAL = 5
+
+# Longest single wait, so cancellation isn't held up
+MAX_SLEEP = 0.25
+
+# Catalog entries fetched per eviction round
+EVICT_BATCH = 100
+
+if STORAGE_FULL_POLICY not in ("wait", "reject"):
+    logger.warning(f"Unknown STORAGE_FULL_POLICY {STORAGE_FULL_POLICY!r}, waiting for space")
+    STORAGE_FULL_POLICY = "wait"
+
+class StorageFull(Exception):
+    """A download doesn't fit in the storage quota or on the disk"""
+
+def disk_bytes(stat):
+    """Bytes a file takes up; sparse .part files count only what has been written"""
+    return min(stat.st_size, stat.st_blocks * 512)
+
+def existing_directory(path):
+    """path, or its nearest parent that exists, for free-space checks"""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+class Usage:
+    """Storage use of the downloads directory at one moment"""
+
+    def __init__(self, used, allocated, expected, disk):
+        # Bytes of finished files, each inode once, plus partial downloads
+        self.used = used
+        # Bytes on disk for each download in progress, by path
+        self.allocated = allocated
+        # Expected size of downloads in progress, by path
+        self.expected = expected
+        self.disk = disk
+
+    def remaining(self, path, size):
+        """Bytes a download of size to path has yet to write"""
+        return max(size - self.allocated.get(path, 0), 0)
+
+    def pending(self, exclude=None):
+        """Bytes downloads in progress have yet to write"""
+        return sum(self.remaining(path, size) for path, size in self.expected.items()
+                   if path != exclude)
+
+class StorageManager:
+    """Byte quota and free-space checks for the downloads directory
+
+    Downloads reserve their expected size (the probed Content-Length)
+    before they start. A reservation that doesn't fit evicts the least
+    recently used finished files down to the low-water mark; if that isn't
+    enough it waits for space or is rejected with StorageFull. A background
+    thread evicts the same way when usage goes over the quota anyway, e.g.
+    because a download had no Content-Length.
+
+    Finished files count through the catalog's running total, which every
+    worker process shares, so a reservation never walks the directory tree;
+    only the partial downloads at its top level are looked at. Partial
+    downloads of other worker processes count through their .part.json
+    manifests.
+    """
+
+    def __init__(self, directory=DOWNLOAD_DIR, quota=STORAGE_QUOTA, low_water=STORAGE_LOW_WATER,
+                 min_free=STORAGE_MIN_FREE):
+        self.directory = directory
+        self.quota = quota
+        self.low_water = low_water or int(quota * 0.9)
+        self.min_free = min_free
+        self.store = content_store.default_store
+        # Catalog giving the least recently used files; without one nothing is evicted
+        self.catalog = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Expected sizes of this process's downloads, by absolute path
+        self.reservations = {}
+        # Bytes still needed by downloads waiting for space, by absolute path
+        self.waiting = {}
+        self.touched = {}
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.rejected = 0
+
+    def scan(self):
+        usage = self.scan_files()
+        with self.lock:
+            return self.count_reservations(usage)
+
+    def scan_files(self):
+        """Usage from the catalog and partial downloads, without current reservations"""
+        used = self.catalog.total_bytes() if self.catalog is not None else 0
+        allocated = {}
+        expected = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.part.json'):
+                        size = self._manifest_size(entry.path)
+                        if size:
+                            expected[os.path.abspath(entry.path)[:-len('.part.json')]] = size
+                    elif entry.name.endswith('.part'):
+                        try:
+                            nbytes = disk_bytes(entry.stat(follow_symlinks=False))
+                        except OSError:
+                            continue
+                        used += nbytes
+                        allocated[os.path.abspath(entry.path)[:-len('.part')]] = nbytes
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Storage scan failed: {e}")
+        with self.lock:
+            reserved = list(self.reservations)
+        for path in reserved:
+            # Finished but not catalogued yet, or written in place like HLS output
+            try:
+                nbytes = disk_bytes(os.stat(path))
+            except OSError:
+                continue
+            allocated[path] = allocated.get(path, 0) + nbytes
+            if self.catalog is None or self.catalog.get(path) is None:
+                used += nbytes
+        return Usage(used, allocated, expected,
+                     shutil.disk_usage(existing_directory(self.directory)))
+
+    @staticmethod
+    def _manifest_size(path):
+        try:
+            with open(path) as f:
+                return json.load(f).get("size") or 0
+        except (OSError, ValueError):
+            return 0
+
+    def shortfall(self, usage, path=None, size=0):
+        """Bytes to free before a download of size to path fits, 0 if it fits now"""
+        pending = usage.pending(exclude=path) + usage.remaining(path, size)
+        shortfall = max(self.min_free - (usage.disk.free - pending), 0)
+        if self.quota:
+            shortfall = max(shortfall, usage.used + pending - self.quota)
+        return shortfall
+
+    def reserve(self, path, size, cancel_event=None):
+        """Hold size bytes for a download to path until release(path)
+
+        Evicts files if the download doesn't fit, then waits for space or
+        raises StorageFull according to STORAGE_FULL_POLICY. A size of 0
+        (unknown) only checks that the directory isn't already full. Returns
+        early once cancel_event is set; the caller's own cancellation check
+        then stops the download.
+        """
+        path = os.path.abspath(path)
+        deadline = time.monotonic() + STORAGE_WAIT_TIMEOUT
+        with self.lock:
+            try:
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    usage = self.scan_locked()
+                    needed = usage.remaining(path, size)
+                    # Don't evict anything for a download that could never fit
+                    limit = min(self.quota or usage.disk.total, usage.disk.total - self.min_free)
+                    if needed > limit:
+                        self.rejected += 1
+                        raise StorageFull(f"{os.path.basename(path)} needs {needed} bytes, "
+                                          f"more than the {limit} bytes of storage available")
+                    if self.shortfall(usage, path, size) and self.catalog is not None:
+                        # Free enough for this download and get back under the low-water mark
+                        target = self.shortfall(usage, path, size)
+                        if self.quota:
+                            target = max(target, usage.used + usage.pending(path) + needed
+                                         - self.low_water)
+                        self.evict_locked(target, usage)
+                        usage = self.scan_locked()
+                    shortfall = self.shortfall(usage, path, size)
+                    if not shortfall:
+                        self.reservations[path] = size
+                        return
+
+                    if STORAGE_FULL_POLICY == "reject" or time.monotonic() >= deadline:
+                        self.rejected += 1
+                        raise StorageFull(f"Not enough storage for {os.path.basename(path)}: "
+                                          f"needs {needed} bytes, {shortfall} more than is free")
+                    if path not in self.waiting:
+                        logger.warning(f"Waiting for {shortfall} bytes of storage to download "
+                                       f"{os.path.basename(path)}")
+                    self.waiting[path] = needed
+                    self.wait_locked(cancel_event)
+            finally:
+                self.waiting.pop(path, None)
+
+    def wait_locked(self, cancel_event):
+        """Wait for a release or eviction, cancellation or WAIT_POLL_INTERVAL"""
+        deadline = time.monotonic() + WAIT_POLL_INTERVAL
+        while time.monotonic() < deadline:
+            if self.changed.wait(MAX_SLEEP):
+                return
+            if cancel_event is not None and cancel_event.is_set():
+                return
+
+    def release(self, path):
+        """Drop a download's reservation once it finished, failed or was cancelled"""
+        with self.lock:
+            if self.reservations.pop(os.path.abspath(path), None) is not None:
+                self.changed.notify_all()
+
+    def scan_locked(self):
+        """scan() for callers holding the lock
+
+        The lock is dropped while the directory is read; reservations made
+        meanwhile are counted once it's taken back, so two downloads can't
+        both be given the same headroom.
+        """
+        self.lock.release()
+        try:
+            usage = self.scan_files()
+        finally:
+            self.lock.acquire()
+        return self.count_reservations(usage)
+
+    def count_reservations(self, usage):
+        """Add this process's reservations, as they are now, to usage; needs the lock"""
+        usage.expected.update(self.reservations)
+        return usage
+
+    def touch(self, path):
+        """Record an access to a finished file, at most once per TOUCH_INTERVAL"""
+        if self.catalog is None:
+            return
+        path = os.path.abspath(path)
+        now = time.time()
+        with self.lock:
+            if now - self.touched.get(path, 0) < TOUCH_INTERVAL:
+                return
+            self.touched[path] = now
+        try:
+            self.catalog.touch(path, now)
+        except Exception as e:
+            logger.error(f"Couldn't record access to {path}: {e}")
+
+    def remove(self, path):
+        """Delete a finished file, dropping it from the content store and catalog
+
+        Returns the bytes usage went down by: 0 while another download still
+        links to the same stored object.
+        """
+        os.remove(path)
+        self.store.forget(path)
+        freed = self.catalog.remove(path) if self.catalog is not None else 0
+        with self.lock:
+            self.touched.pop(os.path.abspath(path), None)
+            self.changed.notify_all()
+        return freed
+
+    def evict(self, target):
+        """Delete least recently used files until about target bytes are freed"""
+        with self.lock:
+            return self.evict_locked(target, self.scan_locked())
+
+    def evict_locked(self, target, usage):
+        """evict() for callers holding the lock; returns the bytes freed"""
+        freed = 0
+        skipped = set()
+        protected = set(usage.expected) | {os.path.abspath(path) for path in self.store.claimed}
+        cutoff = time.time() - STORAGE_EVICT_GRACE
+        while freed < target:
+            entries = [entry for entry in self.catalog.least_recently_used(
+                EVICT_BATCH + len(skipped), before=cutoff) if entry["filename"] not in skipped]
+            if not entries:
+                break
+            for entry in entries:
+                if freed >= target:
+                    break
+                skipped.add(entry["filename"])
+                path = os.path.abspath(entry["file_path"])
+                if path in protected or os.path.exists(path + '.part'):
+                    continue
+                try:
+                    self.lock.release()
+                    try:
+                        removed = self.remove(path)
+                    finally:
+                        self.lock.acquire()
+                except FileNotFoundError:
+                    # Deleted by someone else; the catalog catches up on its own
+                    continue
+                except OSError as e:
+                    logger.error(f"Couldn't evict {path}: {e}")
+                    continue
+                freed += removed
+                self.evicted_files += 1
+                self.evicted_bytes += removed
+                logger.info(f"Evicted {entry['filename']} (last used "
+                            f"{time.time() - entry['last_used']:.0f}s ago)")
+        return freed
+
+    def check(self):
+        """Evict down to the low-water mark if usage is over the quota or the disk is short"""
+        with self.lock:
+            usage = self.scan_locked()
+            shortfall = self.shortfall(usage)
+            if not shortfall or self.catalog is None:
+                return
+            if self.quota:
+                shortfall = max(shortfall, usage.used + usage.pending() - self.low_water)
+            logger.info(f"Storage over its limits, evicting {shortfall} bytes")
+            self.evict_locked(shortfall, usage)
+
+    def start_evictor(self, interval=STORAGE_CHECK_INTERVAL):
+        """Check usage in the background every interval seconds"""
+        thread = threading.Thread(target=self._run_evictor, args=(interval,),
+                                  name="storage-evictor")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run_evictor(self, interval):
+        while interval:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Storage check failed: {e}")
+            time.sleep(interval)
+
+    def stats(self):
+        usage = self.scan()
+        with self.lock:
+            return {
+                "quota": self.quota,
+                "low_water": self.low_water,
+                "min_free": self.min_free,
+                "policy": STORAGE_FULL_POLICY,
+                "used": usage.used,
+                "pending": usage.pending(),
+                "disk_free": usage.disk.free,
+                "disk_total": usage.disk.total,
+                "reservations": [{"path": path, "size": size}
+                                 for path, size in self.reservations.items()],
+                "waiting": [{"path": path, "bytes": needed}
+                            for path, needed in self.waiting.items()],
+                "evicted_files": self.evicted_files,
+                "evicted_bytes": self.evicted_bytes,
+                "rejected": self.rejected,
+            }
+
+# Shared manager used by every download in this process
+default_manager = StorageManager()
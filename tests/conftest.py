@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import threading
+import http.server
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep databases and other state files out of the repository
+WORK_DIR = tempfile.mkdtemp(prefix="video-downloader-tests-")
+os.environ.setdefault("JOB_STORE_URL", "memory://")
+os.environ.setdefault("OBJECTS_DIR", os.path.join(WORK_DIR, "objects"))
+os.environ.setdefault("CATALOG_DB", os.path.join(WORK_DIR, "catalog.db"))
+os.environ.setdefault("PROFILE_DIR", os.path.join(WORK_DIR, "profiles"))
+
+@pytest.fixture(scope="session", autouse=True)
+def work_dir():
+    """Run from a scratch directory, since downloads go to ./downloads"""
+    cwd = os.getcwd()
+    os.chdir(WORK_DIR)
+    os.makedirs("downloads", exist_ok=True)
+    yield WORK_DIR
+    os.chdir(cwd)
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """Serves server.body at any path, with the quirks set on the server"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.server.head_status != 200:
+            # An error page, like S3 answering HEAD on a presigned GET URL
+            error = b"<Error><Code>SignatureDoesNotMatch</Code></Error>" * 5
+            self.send_response(self.server.head_status)
+            self.send_header("Content-Length", str(len(error)))
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+
+    def do_GET(self):
+        body = self.server.body
+        self.server.requests.append(self.headers.get("Range"))
+        header = self.headers.get("Range")
+        if header and header != "bytes=0-0" and self.server.errors:
+            # A flaky CDN failing segment requests, but not the probe
+            self.server.errors -= 1
+            self.send_error(503)
+            return
+        if header and self.server.ranges:
+            first, _, last = header.split("=", 1)[1].partition("-")
+            start, end = int(first), int(last) if last else len(body) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if self.server.etag:
+            self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def file_server():
+    """A local HTTP server for one file; set head_status, ranges, etag, errors and body on it"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    server.daemon_threads = True
+    server.body = os.urandom(300000)
+    server.head_status = 200
+    server.ranges = True
+    server.etag = None
+    server.errors = 0
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/video.mp4"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
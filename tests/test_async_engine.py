@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import pytest
+import video_downloader
+from async_engine import AsyncEngine
+
+@pytest.fixture
+def engine():
+    engine = AsyncEngine(blocking_workers=1, long_workers=1).start()
+    yield engine
+    engine.stop()
+
+def test_long_work_leaves_extraction_free(engine):
+    gate = threading.Event()
+    long_job = engine.submit("long", engine.run_long, args=(gate.wait, 10))
+    try:
+        extraction = engine.submit("extract", engine.run_blocking, args=(lambda: "info",))
+        assert extraction.result(5) == "info"
+    finally:
+        gate.set()
+    assert long_job.result(5)
+
+def test_followers_wait_without_pool_threads(engine):
+    flight, leader = video_downloader.join_flight(["https://example.com/shared.mp4"])
+    assert leader
+    followers = [engine.submit(f"follower-{index}", engine.follow_flight,
+                               args=(flight, f"shared-{index}.mp4", None, None))
+                 for index in range(4)]
+    # Both pools still take work while every follower waits
+    assert engine.submit("extract", engine.run_blocking, args=(lambda: 1,)).result(5) == 1
+    assert engine.submit("long", engine.run_long, args=(lambda: 2,)).result(5) == 2
+    video_downloader.land_flight(flight, None)
+    assert [follower.result(5) for follower in followers] == [None] * 4
+
+def test_follower_takes_over_from_cancelled_leader(engine, monkeypatch, tmp_path):
+    calls = []
+    async def fetch_video(url, video_info, cancel_event, progress_callback, share=None):
+        calls.append(url)
+        if len(calls) == 1:
+            await asyncio.sleep(30)
+        return "taken-over"
+    monkeypatch.setattr(engine, "fetch_video", fetch_video)
+    following = threading.Event()
+    follow_flight = engine.follow_flight
+    async def follow(*args):
+        following.set()
+        return await follow_flight(*args)
+    monkeypatch.setattr(engine, "follow_flight", follow)
+
+    info = {"url": "https://cdn.example.com/cancelled-leader.mp4", "extension": "mp4",
+            "output_path": str(tmp_path / "video.mp4")}
+    leader = engine.submit("leader", engine.download_video, args=("https://example.com/a", info))
+    follower = engine.submit("follower", engine.download_video,
+                             args=("https://example.com/b", info))
+    assert following.wait(5)
+    assert engine.cancel("leader")
+    assert follower.result(5) == "taken-over"
+    assert leader.cancelled()
@@ -0,0 +1,108 @@
+import threading
+import time
+import pytest
+import bandwidth
+
+def test_unlimited_bucket_never_waits():
+    bucket = bandwidth.TokenBucket(0)
+    assert bucket.reserve(10 ** 9, time.monotonic()) == 0.0
+
+def test_bucket_debt_and_refill():
+    bucket = bandwidth.TokenBucket(1000)
+    now = bucket.updated
+    # Starts with BANDWIDTH_BURST seconds of tokens
+    assert bucket.reserve(1000 * bandwidth.BANDWIDTH_BURST + 2000, now) == pytest.approx(2.0)
+    assert bucket.reserve(0, now + 2.0) == pytest.approx(0.0)
+    # Never saves up more than its capacity
+    bucket.refill(now + 100)
+    assert bucket.tokens == bucket.capacity()
+
+def rates(shaper, *shares):
+    with shaper.lock:
+        return [share.bucket.rate for share in shares]
+
+def start(shaper, share, host="example.com"):
+    """Make a share active, as its first transfer would"""
+    shaper.reserve(share, 1, host)
+
+def test_global_cap_split_by_weight():
+    shaper = bandwidth.Shaper(limit=3000)
+    light, heavy = shaper.join(weight=1), shaper.join(weight=2)
+    start(shaper, light)
+    start(shaper, heavy)
+    assert rates(shaper, light, heavy) == [1000, 2000]
+
+def test_job_cap_leaves_rest_to_others():
+    shaper = bandwidth.Shaper(limit=3000)
+    capped, other = shaper.join(limit=500), shaper.join()
+    start(shaper, capped)
+    start(shaper, other)
+    assert rates(shaper, capped, other) == [500, 2500]
+
+def test_idle_job_gives_up_its_portion():
+    shaper = bandwidth.Shaper(limit=3000)
+    busy, idle = shaper.join(), shaper.join()
+    start(shaper, busy)
+    start(shaper, idle)
+    with shaper.lock:
+        busy.window_bytes = 5000
+        idle.window_bytes = 0
+        shaper.rebalance(shaper.rebalanced + bandwidth.REBALANCE_INTERVAL)
+    assert not idle.active
+    assert rates(shaper, busy) == [3000]
+
+def test_slow_job_keeps_what_it_uses():
+    shaper = bandwidth.Shaper(limit=3000)
+    slow, fast = shaper.join(), shaper.join()
+    start(shaper, slow)
+    start(shaper, fast)
+    with shaper.lock:
+        # A slow server gave one job a fifth of its 1500 bytes/s portion
+        slow.window_bytes, fast.window_bytes = 300, 1500
+        shaper.rebalance(shaper.rebalanced + bandwidth.REBALANCE_INTERVAL)
+    slow_rate, fast_rate = rates(shaper, slow, fast)
+    assert slow_rate == 750  # Never cut below half its rate in one round
+    assert fast_rate == 2250
+
+def test_host_cap_applies_across_jobs():
+    shaper = bandwidth.Shaper(host_limit=0)
+    shaper.configure(host_limits={"slow.example": 1000})
+    first, second = shaper.join(), shaper.join()
+    burst = 1000 * bandwidth.BANDWIDTH_BURST
+    assert shaper.reserve(first, burst, "slow.example") == pytest.approx(0, abs=0.01)
+    assert shaper.reserve(second, 1000, "slow.example") == pytest.approx(1.0, abs=0.01)
+    assert shaper.reserve(second, 10 ** 6, "fast.example") == 0.0
+
+def test_idle_hosts_are_dropped():
+    shaper = bandwidth.Shaper(host_limit=1000)
+    share = shaper.join()
+    now = time.monotonic()
+    # Enough to keep the bucket in debt for twice the idle timeout
+    shaper.reserve(share, 1000 * 2 * bandwidth.HOST_IDLE_TIMEOUT, "busy.example")
+    shaper.reserve(share, 10, "quiet.example")
+    with shaper.lock:
+        shaper.drop_idle_hosts(now + bandwidth.HOST_IDLE_TIMEOUT + 1)
+        assert set(shaper.hosts) == {"busy.example"}
+        shaper.drop_idle_hosts(now + 3 * bandwidth.HOST_IDLE_TIMEOUT)
+        assert shaper.hosts == {}
+
+def test_concurrent_jobs_share_the_cap():
+    limit = 200000
+    shaper = bandwidth.Shaper(limit=limit)
+    moved = [0, 0]
+    stop = time.monotonic() + 1.0
+
+    def transfer(index):
+        with shaper.share() as share:
+            while time.monotonic() < stop:
+                share.consume(4096, "example.com")
+                moved[index] += 4096
+
+    threads = [threading.Thread(target=transfer, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One second at the cap plus the initial burst, give or take a chunk per job
+    assert sum(moved) <= limit * (1 + bandwidth.BANDWIDTH_BURST) + 2 * 4096
+    assert min(moved) > sum(moved) / 4
@@ -0,0 +1,76 @@
+import os
+import time
+import pytest
+import app
+import video_downloader
+from job_scheduler import QueueFull
+
+PLAYLIST = "https://example.com/playlist"
+
+@pytest.fixture
+def client(monkeypatch):
+    """Batches whose jobs are stored but never run"""
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    monkeypatch.setattr(video_downloader, "expand_url", lambda url: (
+        ["https://example.com/a", "https://EXAMPLE.com/b#t=10"] if url == PLAYLIST else [url]))
+    monkeypatch.setattr(app.batch_prefetcher, "submit", lambda *args: None)
+
+    def start_download(url, priority=0, batch_id=None):
+        if "full" in url:
+            raise QueueFull("Download queue is full")
+        download_id = app.new_job_id()
+        app.job_store.create(download_id, {"status": "queued", "url": url, "batch_id": batch_id,
+                                           "title": None, "error": None})
+        return download_id, False
+    monkeypatch.setattr(app, "start_download", start_download)
+    return app.app.test_client()
+
+def submit(client, urls=None, **kwargs):
+    """Post a batch and wait for it to be expanded; returns its status"""
+    if urls is not None:
+        kwargs["json"] = {"urls": urls}
+    response = client.post("/api/batch", **kwargs)
+    assert response.status_code == 200
+    batch_id = response.get_json()["batch_id"]
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        status = client.get(f"/api/batch/{batch_id}").get_json()
+        if status["status"] != "expanding":
+            return status
+        time.sleep(0.01)
+    raise AssertionError("Batch wasn't expanded")
+
+def test_batch_drops_duplicates(client):
+    status = submit(client, [PLAYLIST, "https://example.com/b", "https://example.com/c"])
+    assert [job["url"] for job in status["downloads"]] == [
+        "https://example.com/a", "https://EXAMPLE.com/b#t=10", "https://example.com/c"]
+    assert status["duplicates"] == 1
+    assert status["status"] == "queued"
+
+def test_batch_partial_failure(client):
+    status = submit(client, ["https://example.com/ok", "https://example.com/full",
+                             "https://example.com/bad"])
+    assert status["rejected"] == 1
+    ok, bad = [job["id"] for job in status["downloads"]]
+    app.update_download(ok, status="completed")
+    app.update_download(bad, status="failed", error="Download failed")
+    status = client.get(f"/api/batch/{status['batch_id']}").get_json()
+    assert status["status"] == "completed"
+    assert status["counts"] == {"completed": 1, "failed": 1}
+    assert status["progress"] == 100
+
+@pytest.mark.parametrize("urls", [[], ["  "], "https://example.com/a"])
+def test_batch_rejects_bad_input(client, urls):
+    assert client.post("/api/batch", json={"urls": urls}).status_code == 400
+
+def test_batch_size_limit(client, monkeypatch):
+    monkeypatch.setattr(app, "MAX_BATCH_URLS", 3)
+    urls = [f"https://example.com/{n}" for n in range(4)]
+    response = client.post("/api/batch", json={"urls": urls})
+    assert response.status_code == 400
+    assert submit(client, urls[:3])["total"] == 3
+
+def test_form_urls_one_per_line(client):
+    status = submit(client, data={"urls": "https://example.com/x\n\nhttps://example.com/y"})
+    assert [job["url"] for job in status["downloads"]] == ["https://example.com/x",
+                                                           "https://example.com/y"]
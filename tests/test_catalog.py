@@ -0,0 +1,110 @@
+import os
+import pytest
+import app
+import storage
+from catalog import Catalog
+
+@pytest.fixture
+def catalog(tmp_path):
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    return Catalog(str(directory), str(tmp_path / "catalog.db"))
+
+def write(catalog, name, size, mtime=None):
+    path = os.path.join(catalog.directory, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+def test_list_sorts_and_pages(catalog):
+    for name, size, mtime in [("b.mp4", 30, 3), ("A.mp4", 10, 2), ("c.mp4", 20, 1)]:
+        catalog.add(write(catalog, name, size, mtime))
+    catalog.add(write(catalog, "clip.mp4.part", 5))
+
+    entries, total = catalog.list()
+    assert total == 3
+    assert [entry["filename"] for entry in entries] == ["A.mp4", "b.mp4", "c.mp4"]
+    entries, _ = catalog.list(offset=1, limit=1, sort="size", order="desc")
+    assert [entry["filename"] for entry in entries] == ["c.mp4"]
+    entries, _ = catalog.list(sort="mtime")
+    assert [entry["file_size"] for entry in entries] == [20, 10, 30]
+
+def test_changes_bump_version_and_total(catalog):
+    path = write(catalog, "a.mp4", 10)
+    version = catalog.version()
+    catalog.add(path)
+    assert catalog.version() == version + 1
+    assert catalog.total_bytes() == 10
+
+    write(catalog, "a.mp4", 25)
+    catalog.add(path)
+    assert catalog.total_bytes() == 25
+    catalog.touch(path)
+    assert catalog.version() == version + 2
+
+    assert catalog.remove(path) == 25
+    assert catalog.total_bytes() == 0
+    assert catalog.version() == version + 3
+    assert catalog.remove(path) == 0
+
+def test_least_recently_used_follows_access(catalog):
+    for name in ("a.mp4", "b.mp4", "c.mp4"):
+        catalog.add(write(catalog, name, 1))
+    catalog.touch(os.path.join(catalog.directory, "a.mp4"), 100)
+    catalog.touch(os.path.join(catalog.directory, "b.mp4"), 50)
+    entries = catalog.least_recently_used()
+    # c.mp4 was never read, so it counts as used when it was added
+    assert [entry["filename"] for entry in entries] == ["b.mp4", "a.mp4", "c.mp4"]
+    assert [entry["filename"] for entry in catalog.least_recently_used(before=75)] == ["b.mp4"]
+
+def test_reconcile_follows_directory(catalog):
+    catalog.add(write(catalog, "gone.mp4", 5))
+    os.remove(os.path.join(catalog.directory, "gone.mp4"))
+    write(catalog, "new.mp4", 7)
+    catalog.reconcile()
+    entries, total = catalog.list()
+    assert [entry["filename"] for entry in entries] == ["new.mp4"]
+    assert catalog.total_bytes() == 7
+
+@pytest.fixture
+def client(monkeypatch, catalog):
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    monkeypatch.setattr(app, "DOWNLOAD_DIR", catalog.directory)
+    monkeypatch.setattr(app, "download_catalog", catalog)
+    manager = storage.StorageManager(catalog.directory)
+    manager.catalog = catalog
+    monkeypatch.setattr(storage, "default_manager", manager)
+    return app.app.test_client()
+
+def test_listing_pages_catalog(client, catalog):
+    for name in ("a.mp4", "b.mp4", "c.mp4"):
+        catalog.add(write(catalog, name, 3))
+    listing = client.get("/api/downloads?page=2&per_page=2").get_json()
+    assert listing["total"] == 3
+    assert [entry["title"] for entry in listing["downloads"]] == ["c.mp4"]
+    assert listing["downloads"][0]["file_size"] == 3
+    assert client.get("/api/downloads?per_page=0").get_json()["per_page"] == 1
+    assert client.get("/api/downloads?page=x").status_code == 400
+
+def test_listing_etag_changes_with_catalog(client, catalog):
+    catalog.add(write(catalog, "a.mp4", 3))
+    response = client.get("/api/downloads")
+    etag = response.headers["ETag"]
+    assert client.get("/api/downloads", headers={"If-None-Match": etag}).status_code == 304
+    # Another page or sort order is a different listing
+    assert client.get("/api/downloads?sort=size",
+                      headers={"If-None-Match": etag}).status_code == 200
+
+    catalog.add(write(catalog, "b.mp4", 3))
+    response = client.get("/api/downloads", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_serving_a_file_records_access(client, catalog):
+    path = write(catalog, "a.mp4", 3)
+    catalog.add(path)
+    catalog.touch(path, 1)
+    assert client.get("/download/a.mp4").status_code == 200
+    assert catalog.least_recently_used()[0]["last_used"] > 1
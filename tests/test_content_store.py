@@ -0,0 +1,22 @@
+import os
+import video_downloader
+
+def test_hls_videos_with_same_title_keep_both_files(monkeypatch):
+    def convert(m3u8_url, output_path, *args):
+        with open(output_path, "w") as f:
+            f.write(m3u8_url)
+        return output_path
+    monkeypatch.setattr(video_downloader, "convert_m3u8_to_mp4", convert)
+
+    results = []
+    for name in ("first", "second"):
+        info = {"title": "Same title", "url": f"https://cdn.example.com/{name}.m3u8",
+                "extension": "m3u8",
+                "output_path": os.path.join(video_downloader.DOWNLOAD_DIR, "Same title.m3u8")}
+        results.append(video_downloader.fetch_video(f"https://example.com/{name}", info))
+
+    assert [os.path.basename(path) for path in results] == ["Same title.mp4",
+                                                            "Same title (2).mp4"]
+    for name, path in zip(("first", "second"), results):
+        with open(path) as f:
+            assert f.read() == f"https://cdn.example.com/{name}.m3u8"
@@ -0,0 +1,31 @@
+import os
+import pytest
+import app
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    return app.app.test_client()
+
+def write(path, data=b"video"):
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def test_deletes_catalog_entry(client):
+    path = write(os.path.join(app.DOWNLOAD_DIR, "clip.mp4"))
+    app.download_catalog.add(path)
+    response = client.post("/api/delete-download", data={"file_path": path})
+    assert response.status_code == 200
+    assert not os.path.exists(path)
+    assert app.download_catalog.get(path) is None
+
+@pytest.mark.parametrize("name", [".catalog.db", "clip.mp4.part", "uncatalogued.mp4",
+                                  "../downloads-other/clip.mp4"])
+def test_rejects_files_outside_catalog(client, name):
+    path = os.path.join(app.DOWNLOAD_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write(path)
+    response = client.post("/api/delete-download", data={"file_path": path})
+    assert response.status_code == 403
+    assert os.path.exists(path)
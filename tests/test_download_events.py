@@ -0,0 +1,44 @@
+import os
+import time
+import threading
+import app
+import job_store
+from progress import ProgressBroker
+
+def test_stream_asks_client_to_reconnect(monkeypatch):
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    monkeypatch.setattr(app, "SSE_MAX_SECONDS", 0)
+    monkeypatch.setattr(app, "JOB_POLL_INTERVAL", 0.01)
+    download_id = job_store.new_job_id()
+    app.job_store.create(download_id, {"status": "downloading", "url": "events"})
+    response = app.app.test_client().get(f"/api/download-events/{download_id}")
+    body = response.get_data(as_text=True)
+    assert body.startswith("data: ")
+    assert body.endswith("event: reconnect\ndata: {}\n\n")
+
+def test_finished_job_leaves_broker(monkeypatch):
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    download_id = job_store.new_job_id()
+    app.job_store.create(download_id, {"status": "queued", "url": "events-finished"})
+    app.update_download(download_id, status="downloading")
+    version = app.progress_broker.wait(download_id, 0, timeout=0)[0]
+    assert version
+
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(
+        app.progress_broker.wait(download_id, version, timeout=5)))
+    waiter.start()
+    time.sleep(0.05)
+    app.update_download(download_id, status="completed")
+    waiter.join()
+    # Woken by the final state, which isn't kept once published
+    assert woken and woken[0][0] in (version + 1, 0)
+    assert download_id not in app.progress_broker.states
+
+def test_wait_returns_when_job_discarded():
+    broker = ProgressBroker()
+    broker.publish("job", "downloading")
+    threading.Timer(0.05, broker.discard, args=("job",)).start()
+    started = time.time()
+    assert broker.wait("job", 1, timeout=5) == (0, None)
+    assert time.time() - started < 1
@@ -0,0 +1,72 @@
+import os
+import hashlib
+import video_downloader
+import app
+
+# Past the size at which download_file splits the transfer into segments
+LARGE_SIZE = 2 * video_downloader.MIN_SEGMENT_SIZE + 12345
+
+def download(file_server, tmp_path, **kwargs):
+    digests = []
+    target = str(tmp_path / "video.mp4")
+    result = video_downloader.download_file(file_server.url, target, retries=1,
+                                            on_digest=digests.append,
+                                            progress_callback=lambda event: None, **kwargs)
+    assert result == target
+    with open(target, "rb") as f:
+        assert f.read() == file_server.body
+    assert digests == [hashlib.sha256(file_server.body).hexdigest()]
+    assert not os.path.exists(target + ".part.json")
+    return [header for header in file_server.requests if header != "bytes=0-0"]
+
+def test_large_file_downloads_in_segments(file_server, tmp_path):
+    file_server.body = os.urandom(LARGE_SIZE)
+    requests = download(file_server, tmp_path, connections=4)
+    # No segment is smaller than MIN_SEGMENT_SIZE
+    assert len(requests) == 3
+    assert all(header and header.startswith("bytes=") for header in requests)
+    # The segments cover the file exactly once
+    covered = sorted(tuple(int(n) for n in header[6:].split("-")) for header in requests)
+    assert covered[0][0] == 0 and covered[-1][1] == LARGE_SIZE - 1
+    assert all(left[1] + 1 == right[0] for left, right in zip(covered, covered[1:]))
+
+def test_server_ignoring_range_gets_one_stream(file_server, tmp_path):
+    file_server.body = os.urandom(LARGE_SIZE)
+    file_server.ranges = False
+    # The probe got a 200, so the file is fetched in one plain request
+    assert download(file_server, tmp_path, connections=4) == [None]
+
+def test_failed_segment_falls_back_to_one_stream(file_server, tmp_path):
+    file_server.body = os.urandom(LARGE_SIZE)
+    file_server.errors = 1
+    requests = download(file_server, tmp_path, connections=4)
+    # One segment failed; the rest of the file came over a single resumed stream
+    # One segment failed; the rest of the file came over a single stream
+    # resumed from the end of the bytes downloaded without a gap
+    segments, fallback = requests[:-1], requests[-1]
+    assert len(segments) == 3 and all(header.startswith("bytes=") for header in segments)
+    assert fallback is None or fallback.endswith("-")
+
+def test_job_extracts_video_info_once(file_server, monkeypatch):
+    page = f"https://example.com/watch/{os.getpid()}-{id(file_server)}"
+    calls = []
+
+    def extract(url):
+        calls.append(url)
+        return {"title": "Extracted once", "url": file_server.url, "extension": "mp4",
+                "output_path": os.path.join(app.DOWNLOAD_DIR, f"extracted-{id(calls)}.mp4")}
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    monkeypatch.setattr(video_downloader, "extract_video_info", extract)
+    # Without the cache, a second get_video_info call would extract again
+    monkeypatch.setattr(video_downloader.metadata_cache, "default_cache",
+                        video_downloader.metadata_cache.MetadataCache(max_entries=0))
+    download_id = app.new_job_id()
+    app.job_store.create(download_id, {"status": "queued", "url": page})
+
+    app.process_download(download_id, page)
+
+    _, state = app.job_store.get(download_id)
+    assert state["status"] == "completed"
+    with open(state["file_path"], "rb") as f:
+        assert f.read() == file_server.body
+    assert calls == [page]
@@ -0,0 +1,127 @@
+import os
+import re
+import pytest
+import extractors
+import video_downloader
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "benchmarks", "fixtures")
+
+class CountingPattern:
+    """A pattern that records how many characters each search covers"""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.searched = []
+
+    def finditer(self, string, pos=0):
+        self.searched.append(len(string) - pos)
+        return self.pattern.finditer(string, pos)
+
+def spans(matches):
+    return [(match.group(0), match.groupdict()) for match in matches]
+
+@pytest.mark.parametrize("site, patterns, limits", [
+    ("xvideos", video_downloader.XVIDEOS_PATTERNS, video_downloader.XVIDEOS_LIMITS),
+    ("pornhub", video_downloader.PORNHUB_PATTERNS, video_downloader.PORNHUB_LIMITS),
+])
+@pytest.mark.parametrize("chunk_size", [97, 4096])
+def test_scan_matches_whole_page(file_server, site, patterns, limits, chunk_size):
+    with open(os.path.join(FIXTURES, f"{site}.html"), "rb") as f:
+        file_server.body = f.read()
+    page = file_server.body.decode()
+    found = extractors.scan_page(file_server.url, patterns, lambda found: False,
+                                 chunk_size=chunk_size, limits=limits)
+    for name, pattern in patterns.items():
+        assert spans(found[name]) == spans(pattern.finditer(page))
+
+def test_scan_searches_only_new_text_and_tail(file_server):
+    file_server.body = b"x" * 200000 + b"<title>Late</title>"
+    pattern = CountingPattern(video_downloader.TITLE_RE)
+    found = extractors.scan_page(file_server.url, {"title": pattern}, lambda found: False,
+                                 chunk_size=1000, limits={"title": 100})
+    assert [match.group(1) for match in found["title"]] == ["Late"]
+    assert max(pattern.searched) <= 1000 + 100
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(extractors, "registry", {})
+    return extractors.registry
+
+def test_register_and_find_by_host(registry):
+    @extractors.register("Example.com", "example.org")
+    def example(url):
+        return None
+    assert registry == {"example.com": example, "example.org": example}
+    for host in ("example.com", "EXAMPLE.org", "www.example.com", "de.m.example.com",
+                 "example.com."):
+        assert extractors.find_extractor(host) is example
+    for host in ("notexample.com", "example.com.evil.net", "com", "", None):
+        assert extractors.find_extractor(host) is None
+
+def test_site_extractors_registered():
+    assert extractors.find_extractor("www.xvideos.com") is video_downloader.get_xvideos_info
+    assert extractors.find_extractor("pornhub.com") is video_downloader.get_pornhub_info
+
+def test_best_match_prefers_rank_then_earliest():
+    matches = re.finditer(r"(?P<n>\d)", "2 3 1 3")
+    best = extractors.best_match(matches, lambda m: None if m.group("n") == "1"
+                                 else int(m.group("n")))
+    assert best.group("n") == "3" and best.start() == 2
+
+def test_match_across_chunk_boundaries(file_server):
+    file_server.body = "<p>x</p><title>Café – ünïcode</title>".encode() * 2
+    found = extractors.scan_page(file_server.url, {"title": video_downloader.TITLE_RE},
+                                 lambda found: False, chunk_size=3)
+    assert [match.group(1) for match in found["title"]] == ["Café – ünïcode"] * 2
+
+def test_scan_stops_reading_once_complete(file_server, monkeypatch):
+    file_server.body = b"<title>Early</title>" + b"x" * (4 * 1024 * 1024)
+    received = []
+    get = extractors.http_pool.get
+    def counting_get(*args, **kwargs):
+        response = get(*args, **kwargs)
+        iter_content = response.iter_content
+        def counted(chunk_size):
+            for chunk in iter_content(chunk_size=chunk_size):
+                received.append(len(chunk))
+                yield chunk
+        response.iter_content = counted
+        return response
+    monkeypatch.setattr(extractors.http_pool, "get", counting_get)
+
+    found = extractors.scan_page(file_server.url, {"title": video_downloader.TITLE_RE},
+                                 lambda found: bool(found["title"]), chunk_size=1000)
+    assert found["title"][0].group(1) == "Early"
+    assert sum(received) <= 1000
+
+def test_ranked_orders_by_rank_then_page_order():
+    matches = re.finditer(r"(?P<n>\d)", "2 3 1 3")
+    order = extractors.ranked(matches, lambda m: None if m.group("n") == "1"
+                              else int(m.group("n")))
+    assert [(m.group("n"), m.start()) for m in order] == [("3", 2), ("3", 6), ("2", 0)]
+
+@pytest.mark.parametrize("site, extract, qualities", [
+    ("xvideos", video_downloader.get_xvideos_info, ["HLS", "UrlHigh", "UrlLow"]),
+    ("pornhub", video_downloader.get_pornhub_info, ["720p", "480p", "240p"]),
+])
+def test_extractors_list_quality_variants(file_server, site, extract, qualities):
+    with open(os.path.join(FIXTURES, f"{site}.html"), "rb") as f:
+        file_server.body = f.read()
+    info = extract(file_server.url)
+    assert [variant["quality"] for variant in info["variants"]] == qualities
+    # The best variant is the one downloaded
+    assert info["url"] == info["variants"][0]["url"]
+    assert info["extension"] == info["variants"][0]["extension"]
+
+def test_youtube_dl_variants_best_first():
+    info = {"formats": [
+        {"format_id": "18", "height": 360, "ext": "mp4", "url": "https://cdn/360"},
+        {"format_id": "hls-1", "format_note": "hls", "ext": "mp4", "url": "https://cdn/hls"},
+        {"format_id": "22", "height": 720, "ext": "mp4", "url": "https://cdn/720"},
+        {"format_id": "22-copy", "height": 720, "ext": "mp4", "url": "https://cdn/720"},
+    ]}
+    assert [(variant["quality"], variant["url"])
+            for variant in video_downloader.youtube_dl_variants(info)] == [
+        ("720p", "https://cdn/720"), ("hls", "https://cdn/hls"), ("360p", "https://cdn/360")]
+    assert video_downloader.youtube_dl_variants({}) == []
@@ -0,0 +1,41 @@
+import io
+import shutil
+import subprocess
+import tempfile
+import pytest
+import postprocess
+import progress
+
+def test_duration_from_ffmpeg_log():
+    with tempfile.TemporaryFile() as log:
+        log.write(b"Input #0, hls, from 'index.m3u8':\n  Duration: 00:04:13.52, start: 0.0\n")
+        log.flush()
+        assert progress.ffmpeg_duration(log.fileno()) == pytest.approx(253.52)
+        # The offset ffmpeg writes at is left at the end of its output
+        assert log.tell() == log.seek(0, io.SEEK_END)
+
+def test_live_stream_has_no_duration():
+    with tempfile.TemporaryFile() as log:
+        log.write(b"  Duration: N/A, start: 0.0, bitrate: N/A\n")
+        log.flush()
+        assert progress.ffmpeg_duration(log.fileno()) is None
+
+def test_progress_projects_total_from_media_time():
+    events = []
+    tracker = progress.ProgressTracker(events.append, interval=0)
+    report = b"total_size=1000\nout_time_us=10000000\nprogress=continue\n"
+    progress.follow_ffmpeg_progress(io.BytesIO(report).readlines(), tracker, duration=40)
+    assert events[-1]["percent"] == 25.0
+    assert events[-1]["total_bytes"] == 4000
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_ffmpeg_run_reports_percent(tmp_path):
+    source, target = str(tmp_path / "tone.wav"), str(tmp_path / "tone.mkv")
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi",
+                    "-i", "sine=frequency=440:duration=5", source], check=True)
+    events = []
+    processor = postprocess.PostProcessor(workers=1)
+    processor.run(["ffmpeg", "-y", "-progress", "pipe:1", "-nostats", "-i", source, target],
+                  events.append)
+    assert events[-1]["percent"] == pytest.approx(100.0, abs=1)
+    assert events[-1]["total_bytes"] > 0
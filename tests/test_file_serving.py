@@ -0,0 +1,142 @@
+import os
+import pytest
+from flask import Flask
+from werkzeug.http import http_date
+import app
+import file_serving
+import video_downloader
+
+@pytest.mark.parametrize("header, ranges", [
+    ("bytes=0-99", [(0, 100)]),
+    ("bytes=900-", [(900, 1000)]),
+    ("bytes=-100", [(900, 1000)]),
+    ("bytes=-5000", [(0, 1000)]),
+    ("bytes=500-5000", [(500, 1000)]),
+    ("bytes=0-9, 5-19, 20-29", [(0, 30)]),
+    ("bytes=50-59,0-9", [(0, 10), (50, 60)]),
+    ("bytes=1000-", []),
+])
+def test_parse_ranges(header, ranges):
+    assert file_serving.parse_ranges(header, 1000) == ranges
+
+@pytest.mark.parametrize("header", ["items=0-9", "bytes=9-0", "bytes=a-b", "bytes=-", "bytes=5"])
+def test_parse_ranges_rejects_malformed(header):
+    assert file_serving.parse_ranges(header, 1000) is None
+
+@pytest.fixture
+def served(tmp_path):
+    """A test client serving a 1000-byte file at /file"""
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(bytes(range(256)) * 3 + bytes(232))
+    app = Flask(__name__)
+    app.add_url_rule("/file", "file", lambda: file_serving.serve_file(str(path), "clip.mp4"))
+    client = app.test_client()
+    client.body = path.read_bytes()
+    client.etag = client.get("/file").headers["ETag"]
+    client.mtime = os.stat(path).st_mtime
+    return client
+
+def test_single_range(served):
+    response = served.get("/file", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/1000"
+    assert response.get_data() == served.body[10:20]
+
+def test_multiple_ranges(served):
+    response = served.get("/file", headers={"Range": "bytes=0-1,998-"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    body = response.get_data()
+    assert b"Content-Range: bytes 0-1/1000" in body
+    assert b"Content-Range: bytes 998-999/1000" in body
+
+def test_unsatisfiable_range(served):
+    response = served.get("/file", headers={"Range": "bytes=5000-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */1000"
+
+def test_too_many_ranges_sends_whole_file(served):
+    header = "bytes=" + ",".join(f"{n * 10}-{n * 10}" for n in range(file_serving.MAX_RANGES + 1))
+    response = served.get("/file", headers={"Range": header})
+    assert response.status_code == 200
+    assert response.get_data() == served.body
+
+@pytest.mark.parametrize("if_range, partial", [
+    ("etag", True),
+    ('"stale"', False),
+    ("W/etag", False),
+    ("date", True),
+    ("Thu, 01 Jan 1970 00:00:00 GMT", False),
+])
+def test_if_range(served, if_range, partial):
+    value = {"etag": served.etag, "W/etag": "W/" + served.etag,
+             "date": http_date(served.mtime)}.get(if_range, if_range)
+    response = served.get("/file", headers={"Range": "bytes=0-9", "If-Range": value})
+    assert response.status_code == (206 if partial else 200)
+    assert len(response.get_data()) == (10 if partial else 1000)
+
+def test_if_none_match(served):
+    assert served.get("/file", headers={"If-None-Match": served.etag}).status_code == 304
+
+@pytest.fixture
+def streaming(monkeypatch):
+    """A test client streaming a 1000-byte download still in progress at /stream/live.mp4"""
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    path = os.path.join(app.DOWNLOAD_DIR, "live.mp4")
+    body = bytes(range(256)) * 3 + bytes(232)
+    with open(path + ".part", "wb") as f:
+        f.write(body)
+    partial = video_downloader.PartialDownload(path)
+    partial.manifest = {"size": len(body), "ranges": [[0, len(body) - 1]]}
+    partial.mark_available(0, len(body) - 1)
+    monkeypatch.setattr(video_downloader, "get_live_download", lambda filepath: partial)
+    client = app.app.test_client()
+    client.body = body
+    client.partial = partial
+    yield client
+    os.remove(path + ".part")
+
+def test_in_progress_single_range(streaming):
+    response = streaming.get("/stream/live.mp4", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/1000"
+    assert response.get_data() == streaming.body[10:20]
+
+def test_in_progress_multiple_ranges(streaming):
+    response = streaming.get("/stream/live.mp4", headers={"Range": "bytes=0-1,998-"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    body = response.get_data()
+    assert len(body) == int(response.headers["Content-Length"])
+    assert b"Content-Range: bytes 0-1/1000\r\n\r\n" + streaming.body[:2] in body
+    assert b"Content-Range: bytes 998-999/1000\r\n\r\n" + streaming.body[998:] in body
+
+@pytest.mark.parametrize("header, status", [
+    ("bytes=-0", 416),
+    ("bytes=5000-", 416),
+    ("bytes=9-0", 200),
+    ("items=0-9", 200),
+])
+def test_in_progress_bad_ranges(streaming, header, status):
+    response = streaming.get("/stream/live.mp4", headers={"Range": header})
+    assert response.status_code == status
+    if status == 200:
+        assert response.get_data() == streaming.body
+    else:
+        assert response.headers["Content-Range"] == "bytes */1000"
+
+@pytest.mark.parametrize("if_range", ['"v1"', "Thu, 01 Jan 1970 00:00:00 GMT"])
+def test_in_progress_if_range_sends_whole_file(streaming, if_range):
+    # A file still downloading has no validators for If-Range to match
+    response = streaming.get("/stream/live.mp4",
+                             headers={"Range": "bytes=0-9", "If-Range": if_range})
+    assert response.status_code == 200
+    assert response.get_data() == streaming.body
+
+def test_in_progress_unknown_size_ignores_range(streaming):
+    streaming.partial.manifest["size"] = 0
+    streaming.partial.close()
+    response = streaming.get("/stream/live.mp4", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "none"
+    assert response.get_data() == streaming.body
@@ -0,0 +1,147 @@
+import subprocess
+import threading
+import time
+import http.server
+import pytest
+import hls
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+mid/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1920x1080
+https://other.example.com/high/index.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0"
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@720
+video.mp4
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000
+video.mp4
+#EXT-X-DISCONTINUITY
+#EXTINF:4.0,
+ad/0.ts
+#EXT-X-ENDLIST
+"""
+
+def test_parse_master_playlist():
+    playlist = hls.parse_playlist(MASTER, "https://cdn.example.com/v/master.m3u8")
+    assert [(v["height"], v["bandwidth"]) for v in playlist["variants"]] == [
+        (360, 800000), (720, 2500000), (1080, 5000000)]
+    assert playlist["variants"][1]["url"] == "https://cdn.example.com/v/mid/index.m3u8"
+    assert playlist["variants"][2]["url"] == "https://other.example.com/high/index.m3u8"
+    assert playlist["segments"] == []
+
+def test_choose_variant():
+    variants = hls.parse_playlist(MASTER, "https://cdn.example.com/")["variants"]
+    assert hls.choose_variant(variants)["height"] == 1080
+    assert hls.choose_variant(variants, max_height=720)["height"] == 720
+    # Nothing small enough: the cap is ignored rather than failing
+    assert hls.choose_variant(variants, max_height=240)["height"] == 1080
+
+def test_parse_media_playlist_byteranges_and_discontinuity():
+    playlist = hls.parse_playlist(MEDIA, "https://cdn.example.com/v/index.m3u8")
+    assert playlist["init"] == {"url": "https://cdn.example.com/v/init.mp4", "byterange": (0, 720)}
+    # A byte range without an offset continues where the previous one ended
+    assert playlist["segments"] == [
+        {"url": "https://cdn.example.com/v/video.mp4", "byterange": (720, 1000)},
+        {"url": "https://cdn.example.com/v/video.mp4", "byterange": (1720, 1000)},
+        {"url": "https://cdn.example.com/v/ad/0.ts", "byterange": None},
+    ]
+    assert playlist["endlist"] and playlist["key_method"] == "NONE"
+
+def test_parse_rejects_other_text():
+    with pytest.raises(ValueError):
+        hls.parse_playlist("<html></html>", "https://cdn.example.com/")
+
+def test_parse_attributes_with_quoted_commas():
+    assert hls.parse_attributes('BANDWIDTH=1,CODECS="avc1,mp4a",RESOLUTION=2x3') == {
+        "BANDWIDTH": "1", "CODECS": "avc1,mp4a", "RESOLUTION": "2x3"}
+
+class CDNHandler(http.server.BaseHTTPRequestHandler):
+    """Serves server.files by path, delaying each by server.delays"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        time.sleep(self.server.delays.get(self.path, 0))
+        header = self.headers.get("Range")
+        if header:
+            first, _, last = header.split("=", 1)[1].partition("-")
+            body = body[int(first):int(last) + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.completed.append(self.path)
+
+@pytest.fixture
+def cdn():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CDNHandler)
+    server.daemon_threads = True
+    server.files = {}
+    server.delays = {}
+    server.completed = []
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def cat_for_ffmpeg(monkeypatch):
+    """Stand in for ffmpeg with cat, so the output is exactly the bytes piped to it"""
+    popen = subprocess.Popen
+    monkeypatch.setattr(hls.shutil, "which", lambda name: "/bin/" + name)
+    monkeypatch.setattr(hls.subprocess, "Popen",
+                        lambda cmd, **kwargs: popen(["sh", "-c", 'cat > "$0"', cmd[-1]],
+                                                    **kwargs))
+
+def test_segments_written_in_playlist_order(cdn, cat_for_ffmpeg, tmp_path, capsys):
+    count = 8
+    segments = [bytes([index]) * (1000 + index) for index in range(count)]
+    cdn.files["/master.m3u8"] = ("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1,RESOLUTION=2x360\n"
+                                 "media.m3u8\n").encode()
+    cdn.files["/media.m3u8"] = ("#EXTM3U\n" + "".join(f"#EXTINF:1,\nseg{index}.ts\n"
+                                                      for index in range(count))
+                                + "#EXT-X-ENDLIST\n").encode()
+    for index, data in enumerate(segments):
+        cdn.files[f"/seg{index}.ts"] = data
+        # Earlier segments take longest, so they finish last
+        cdn.delays[f"/seg{index}.ts"] = (count - index) * 0.05
+
+    events = []
+    output = hls.download_hls(cdn.url + "/master.m3u8", str(tmp_path / "out.mp4"),
+                              connections=count, window=count,
+                              progress_callback=events.append)
+
+    with open(output, "rb") as f:
+        assert f.read() == b"".join(segments)
+    fetched = [path for path in cdn.completed if path.startswith("/seg")]
+    assert fetched != sorted(fetched)
+    assert events[-1]["segments_completed"] == count
+    # Progress went to the callback, not stdout
+    assert capsys.readouterr().out == ""
+
+def test_encrypted_and_live_streams_unsupported(cdn):
+    cdn.files["/encrypted.m3u8"] = (b'#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="k"\n'
+                                    b'#EXTINF:1,\n0.ts\n#EXT-X-ENDLIST\n')
+    cdn.files["/live.m3u8"] = b"#EXTM3U\n#EXTINF:1,\n0.ts\n"
+    for name in ("encrypted", "live"):
+        with pytest.raises(hls.HLSUnsupported):
+            hls.load_media_playlist(f"{cdn.url}/{name}.m3u8", {})
@@ -0,0 +1,63 @@
+import threading
+import http.server
+import pytest
+from http_pool import SessionPool
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every GET over a kept-alive connection, recording the client port"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.daemon_threads = True
+    server.ports = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def fetch_in_thread(pool, url):
+    thread = threading.Thread(target=lambda: pool.get(url).content)
+    thread.start()
+    thread.join()
+
+def test_threads_share_connections(server):
+    pool = SessionPool(pool_connections=1, pool_maxsize=1)
+    for _ in range(3):
+        fetch_in_thread(pool, server.url)
+    # Each thread has its own session, but they all used one connection
+    assert len(server.ports) == 3
+    assert len(set(server.ports)) == 1
+
+def test_sessions_are_per_thread():
+    pool = SessionPool()
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(pool.get_session()))
+    thread.start()
+    thread.join()
+    assert pool.get_session() is pool.get_session()
+    assert sessions[0] is not pool.get_session()
+
+def test_configure_replaces_connections(server):
+    pool = SessionPool(pool_connections=1, pool_maxsize=1)
+    pool.get(server.url).content
+    session = pool.get_session()
+    pool.configure(pool_maxsize=2)
+    assert pool.get_session() is not session
+    pool.get(server.url).content
+    # The old adapter's connection was closed with it
+    assert len(set(server.ports)) == 2
@@ -0,0 +1,106 @@
+import threading
+import pytest
+import job_scheduler
+
+def record(order, job_id):
+    def run(cancel_event):
+        order.append(job_id)
+    return run
+
+def wait_idle(scheduler, timeout=5):
+    with scheduler.condition:
+        assert scheduler.condition.wait_for(lambda: not scheduler.jobs, timeout)
+
+def test_higher_priority_runs_first():
+    scheduler = job_scheduler.JobScheduler(workers=1, per_host=1)
+    order = []
+    scheduler.submit("low", record(order, "low"), priority=0)
+    scheduler.submit("high", record(order, "high"), priority=5)
+    scheduler.submit("low2", record(order, "low2"), priority=0)
+    assert scheduler.queue_position("high") == 1
+    assert scheduler.queue_position("low2") == 3
+    scheduler.start()
+    wait_idle(scheduler)
+    scheduler.shutdown()
+    # Equal priorities keep submission order
+    assert order == ["high", "low", "low2"]
+
+def test_per_host_cap_lets_other_hosts_through():
+    scheduler = job_scheduler.JobScheduler(workers=3, per_host=1)
+    release = threading.Event()
+    started = []
+    lock = threading.Lock()
+    running = {}
+    peak = {}
+
+    def job(job_id, host, cancel_event):
+        with lock:
+            started.append(job_id)
+            running[host] = running.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), running[host])
+        release.wait(5)
+        with lock:
+            running[host] -= 1
+
+    for job_id, host in (("a1", "a.com"), ("a2", "a.com"), ("b1", "b.com")):
+        scheduler.submit(job_id, job, args=(job_id, host), host=host)
+    scheduler.start()
+
+    with scheduler.condition:
+        assert scheduler.condition.wait_for(
+            lambda: scheduler.stats()["running"] == 2, 5)
+    # a2 waits for a1 even though a worker is idle, while b1 goes ahead
+    assert sorted(started) == ["a1", "b1"]
+    assert scheduler.queue_position("a2") == 1
+
+    release.set()
+    wait_idle(scheduler)
+    scheduler.shutdown()
+    assert sorted(started) == ["a1", "a2", "b1"]
+    assert peak == {"a.com": 1, "b.com": 1}
+
+def test_cancel_queued_job():
+    scheduler = job_scheduler.JobScheduler(workers=1)
+    order = []
+    scheduler.submit("keep", record(order, "keep"))
+    job = scheduler.submit("drop", record(order, "drop"))
+    assert scheduler.cancel("drop")
+    assert job.state == "cancelled" and job.cancel_event.is_set()
+    assert scheduler.queue_position("drop") is None
+    scheduler.start()
+    wait_idle(scheduler)
+    scheduler.shutdown()
+    assert order == ["keep"]
+
+def test_queue_full():
+    scheduler = job_scheduler.JobScheduler(workers=1, max_queue=2)
+    scheduler.submit("one", record([], "one"))
+    scheduler.submit("two", record([], "two"))
+    with pytest.raises(job_scheduler.QueueFull):
+        scheduler.submit("three", record([], "three"))
+
+def test_cancel_running_job_and_survive_failures():
+    scheduler = job_scheduler.JobScheduler(workers=1)
+    started = threading.Event()
+    order = []
+
+    def long_job(cancel_event):
+        started.set()
+        assert cancel_event.wait(5)
+        order.append("cancelled")
+
+    def failing_job(cancel_event):
+        raise RuntimeError("extractor crashed")
+
+    scheduler.submit("long", long_job)
+    scheduler.submit("fails", failing_job)
+    scheduler.submit("after", record(order, "after"))
+    scheduler.start()
+    assert started.wait(5)
+    # A running job is only asked to stop, and stays tracked until it does
+    assert scheduler.cancel("long")
+    wait_idle(scheduler)
+    scheduler.shutdown()
+    # The failed job didn't take its worker down with it
+    assert order == ["cancelled", "after"]
+    assert not scheduler.cancel("long")
@@ -0,0 +1,100 @@
+import pytest
+import app
+import job_store
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return job_store.MemoryJobStore()
+    return job_store.create_job_store(f"sqlite:///{tmp_path / 'jobs.db'}")
+
+def test_delete_if_matches_version(store):
+    store.create("key", {"job_id": "a"})
+    version, _ = store.get("key")
+    assert store.delete_if("key", version)
+    assert store.get("key") == (0, None)
+
+def test_delete_if_keeps_replaced_record(store):
+    store.create("key", {"job_id": "a"})
+    version, _ = store.get("key")
+    store.delete("key")
+    store.create("key", {"job_id": "b"})
+    assert not store.delete_if("key", version)
+    assert store.get("key")[1]["job_id"] == "b"
+
+def queue_orphan(url, owner):
+    """Store an unfinished job and its in-flight entry as a dead worker would"""
+    download_id = job_store.new_job_id()
+    app.job_store.create(download_id, {"status": "downloading", "url": url, "owner": owner})
+    app.job_store.create(app.inflight_key(url), {"type": "inflight", "job_id": download_id})
+    return download_id
+
+def test_attach_takes_over_orphaned_job():
+    url = "https://example.com/orphan.mp4"
+    orphan_id = queue_orphan(url, "worker:gone")
+    assert app.attach_inflight(url, "new") == "new"
+    _, state = app.job_store.get(orphan_id)
+    assert state["status"] == "failed"
+    app.release_inflight(url, "new")
+
+def test_attach_joins_job_of_live_worker():
+    url = "https://example.com/live.mp4"
+    live_id = queue_orphan(url, app.current_worker())
+    assert app.attach_inflight(url, "new") == live_id
+    app.update_download(live_id, status="completed")
+    assert app.job_store.get(app.inflight_key(url)) == (0, None)
+
+def test_sweep_fails_orphans_and_expires_finished_jobs(monkeypatch):
+    monkeypatch.setattr(app, "JOB_RETENTION", 3600)
+    orphan_id = queue_orphan("https://example.com/swept.mp4", "worker:gone")
+    old_id, recent_id = job_store.new_job_id(), job_store.new_job_id()
+    app.job_store.create(old_id, {"status": "completed", "url": "old", "finished_at": 1})
+    app.job_store.create(recent_id, {"status": "failed", "url": "recent"})
+    app.update_download(recent_id, status="failed")
+    app.sweep_jobs()
+    assert app.job_store.get(orphan_id)[1]["status"] == "failed"
+    assert app.job_store.get(old_id) == (0, None)
+    assert app.job_store.get(recent_id)[1] is not None
+
+def test_sweep_keeps_newest_finished_jobs(monkeypatch):
+    monkeypatch.setattr(app, "JOB_RETENTION_COUNT", 2)
+    for download_id, _ in app.job_store.list():
+        app.job_store.delete(download_id)
+    job_ids = [job_store.new_job_id() for _ in range(3)]
+    for finished_at, download_id in enumerate(job_ids):
+        app.job_store.create(download_id, {"status": "completed", "url": download_id,
+                                           "finished_at": 2e9 + finished_at})
+    batch_id = job_store.new_job_id()
+    app.job_store.create(batch_id, {"type": "batch", "status": "queued", "job_ids": job_ids[:1]})
+    app.sweep_jobs()
+    assert [app.job_store.get(download_id)[1] is not None for download_id in job_ids] == \
+        [False, True, True]
+    assert app.job_store.get(batch_id) == (0, None)
+
+def test_sweep_discards_broker_state(monkeypatch):
+    monkeypatch.setattr(app, "JOB_RETENTION", 3600)
+    old_id, live_id = job_store.new_job_id(), job_store.new_job_id()
+    app.job_store.create(old_id, {"status": "completed", "url": "old", "finished_at": 1})
+    app.job_store.create(live_id, {"status": "downloading", "url": "live",
+                                   "owner": app.current_worker()})
+    # Published after the job finished, e.g. a late field update
+    app.progress_broker.publish(old_id, "completed")
+    app.progress_broker.publish(live_id, "downloading")
+    app.progress_broker.publish("deleted-elsewhere", "completed")
+    app.sweep_jobs()
+    remaining = app.progress_broker.job_ids()
+    assert live_id in remaining
+    assert old_id not in remaining and "deleted-elsewhere" not in remaining
+    app.progress_broker.discard(live_id)
+
+def test_listing_etag_ignores_progress(monkeypatch):
+    monkeypatch.setattr(app, "background_pid", app.os.getpid())
+    client = app.app.test_client()
+    download_id = job_store.new_job_id()
+    app.job_store.create(download_id, {"status": "downloading", "url": "etag", "title": None})
+    app.touch_listing()
+    etag = client.get("/api/downloads").headers["ETag"]
+    app.update_download(download_id, progress=50.0, downloaded_bytes=100)
+    assert client.get("/api/downloads", headers={"If-None-Match": etag}).status_code == 304
+    app.update_download(download_id, status="completed")
+    assert client.get("/api/downloads", headers={"If-None-Match": etag}).status_code == 200
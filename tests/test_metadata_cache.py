@@ -0,0 +1,101 @@
+import pytest
+import metadata_cache
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.time() for expiry checks"""
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(metadata_cache.time, "time", lambda: now[0])
+    return now
+
+def test_normalize_url():
+    assert (metadata_cache.normalize_url(" HTTPS://Example.COM/Video?id=1#t=30 ")
+            == "https://example.com/Video?id=1")
+    assert metadata_cache.normalize_url("http://example.com") == "http://example.com/"
+
+def test_entry_expires_after_site_ttl(clock):
+    cache = metadata_cache.MetadataCache()
+    cache.put("https://www.xvideos.com/video1", {"title": "one"})
+    clock[0] += metadata_cache.SITE_TTLS["xvideos.com"] - 1
+    assert cache.get("https://www.xvideos.com/video1") == {"title": "one"}
+    clock[0] += 1
+    assert cache.get("https://www.xvideos.com/video1") is None
+    assert cache.stats() == {"entries": 0, "hits": 1, "misses": 1}
+
+def test_default_ttl_for_other_sites(clock):
+    assert metadata_cache.site_ttl("https://example.com/a") == metadata_cache.METADATA_CACHE_TTL
+    assert metadata_cache.site_ttl("https://pornhub.com/a") == metadata_cache.SITE_TTLS["pornhub.com"]
+
+def test_signed_media_url_shortens_ttl(clock):
+    cache = metadata_cache.MetadataCache()
+    expiry = int(clock[0]) + 600
+    info = {"url": f"https://cdn.example.com/v.mp4?expires={expiry}"}
+    cache.put("https://example.com/a", info)
+    clock[0] = expiry - metadata_cache.EXPIRY_MARGIN - 1
+    assert cache.get("https://example.com/a") == info
+    clock[0] += 1
+    assert cache.get("https://example.com/a") is None
+
+    # Akamai-style tokens nest the expiry inside another parameter
+    token = f"https://cdn.example.com/v.mp4?hdnea=st=1~exp={expiry}~hmac=ab"
+    assert metadata_cache.signed_url_expiry(token) == expiry
+
+def test_signed_variant_url_shortens_ttl(clock):
+    cache = metadata_cache.MetadataCache()
+    expiry = int(clock[0]) + 600
+    info = {"url": "https://cdn.example.com/720.mp4", "variants": [
+        {"quality": "720p", "url": "https://cdn.example.com/720.mp4"},
+        {"quality": "480p", "url": f"https://cdn.example.com/480.mp4?expires={expiry}"},
+    ]}
+    cache.put("https://example.com/a", info)
+    clock[0] = expiry - metadata_cache.EXPIRY_MARGIN
+    assert cache.get("https://example.com/a") is None
+
+def test_already_expired_entry_not_cached(clock):
+    cache = metadata_cache.MetadataCache()
+    info = {"url": f"https://cdn.example.com/v.mp4?expires={int(clock[0]) + 10}"}
+    cache.put("https://example.com/a", info)
+    assert cache.stats()["entries"] == 0
+
+def test_lru_eviction(clock):
+    cache = metadata_cache.MetadataCache(max_entries=2)
+    cache.put("https://example.com/a", {"title": "a"})
+    cache.put("https://example.com/b", {"title": "b"})
+    # Reading a makes b the least recently used
+    assert cache.get("https://example.com/a") is not None
+    cache.put("https://example.com/c", {"title": "c"})
+    assert cache.get("https://example.com/b") is None
+    assert cache.get("https://example.com/a") == {"title": "a"}
+    assert cache.get("https://example.com/c") == {"title": "c"}
+
+def test_returns_copies():
+    cache = metadata_cache.MetadataCache()
+    info = {"formats": [{"id": 1}]}
+    cache.put("https://example.com/a", info)
+    info["formats"].append({"id": 2})
+    cached = cache.get("https://example.com/a")
+    cached["formats"].clear()
+    assert cache.get("https://example.com/a") == {"formats": [{"id": 1}]}
+
+def test_sqlite_backend_survives_restart(tmp_path, clock):
+    path = str(tmp_path / "cache" / "metadata.db")
+    cache = metadata_cache.MetadataCache(backend=metadata_cache.SQLiteCacheBackend(path))
+    info = {"title": "a", "url": "https://cdn.example.com/720.mp4", "variants": [
+        {"quality": "720p", "url": "https://cdn.example.com/720.mp4", "extension": "mp4"},
+        {"quality": "480p", "url": "https://cdn.example.com/480.mp4", "extension": "mp4"},
+    ]}
+    cache.put("https://example.com/a", info)
+
+    fresh = metadata_cache.MetadataCache(backend=metadata_cache.SQLiteCacheBackend(path))
+    assert fresh.get("https://example.com/a") == info
+
+    fresh.invalidate("https://example.com/a")
+    assert cache.backend.get(metadata_cache.normalize_url("https://example.com/a")) is None
+
+def test_sqlite_backend_ignores_expired_rows(tmp_path, clock):
+    backend = metadata_cache.SQLiteCacheBackend(str(tmp_path / "metadata.db"))
+    backend.put("https://example.com/a", {"title": "a"}, clock[0] - 1)
+    cache = metadata_cache.MetadataCache(backend=backend)
+    assert cache.get("https://example.com/a") is None
+    backend.purge_expired(clock[0])
+    assert backend.get("https://example.com/a") is None
@@ -0,0 +1,79 @@
+import os
+import pytest
+import app
+import metrics
+
+def test_second_cprofile_job_is_rejected():
+    with metrics.profile_job("first", "cprofile") as report:
+        with pytest.raises(metrics.ProfilerBusy):
+            with metrics.profile_job("second", "cprofile"):
+                pass
+    assert os.path.exists(report)
+    # Released once the first job is done
+    with metrics.profile_job("third", "cprofile"):
+        pass
+
+def test_busy_profiler_fails_job_and_releases_url(monkeypatch):
+    monkeypatch.setattr(app, "background_pid", os.getpid())
+    url = "https://example.com/profiled"
+    download_id = app.new_job_id()
+    app.job_store.create(download_id, {"status": "queued", "url": url, "profile": "cprofile"})
+    assert app.attach_inflight(url, download_id) == download_id
+
+    with metrics.profile_job("other", "cprofile"):
+        app.process_download(download_id, url)
+
+    _, state = app.job_store.get(download_id)
+    assert state["status"] == "failed"
+    assert app.job_store.get(app.inflight_key(url))[1] is None
+
+def test_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    histogram = registry.histogram("test_seconds", "Test", ["stage"], buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value, stage="probe")
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP test_seconds Test", "# TYPE test_seconds histogram"]
+    assert lines[2:] == [
+        'test_seconds_bucket{stage="probe",le="1.0"} 2',
+        'test_seconds_bucket{stage="probe",le="5.0"} 3',
+        'test_seconds_bucket{stage="probe",le="+Inf"} 4',
+        'test_seconds_sum{stage="probe"} 14.5',
+        'test_seconds_count{stage="probe"} 4',
+    ]
+
+def test_labels_are_checked_and_escaped():
+    registry = metrics.Registry()
+    counter = registry.counter("test_total", "Test", ["host"])
+    with pytest.raises(ValueError):
+        counter.inc(port=80)
+    counter.inc(2, host='a\\b\n"c"')
+    assert 'test_total{host="a\\\\b\\n\\"c\\""} 2' in registry.render().splitlines()
+
+def test_failing_collector_is_skipped(caplog):
+    registry = metrics.Registry()
+    registry.gauge("test_gauge", "Test").set(3)
+
+    @registry.collector
+    def broken():
+        raise RuntimeError("queue unavailable")
+        yield
+
+    @registry.collector
+    def queue():
+        yield "test_queue", "Queue depth", "gauge", [({"queue": "io"}, 7)]
+
+    lines = registry.render().splitlines()
+    assert "test_gauge 3" in lines
+    assert 'test_queue{queue="io"} 7' in lines
+    assert "broken failed: queue unavailable" in caplog.text
+
+def test_hosts_beyond_limit_are_reported_as_other(monkeypatch):
+    monkeypatch.setattr(metrics, "known_hosts", set())
+    monkeypatch.setattr(metrics, "METRICS_MAX_HOSTS", 2)
+    assert metrics.host_label("https://A.example.com/x") == "a.example.com"
+    assert metrics.host_label("https://b.example.com/x") == "b.example.com"
+    assert metrics.host_label("https://c.example.com/x") == "other"
+    # Hosts seen before the limit was reached keep their own label
+    assert metrics.host_label("https://a.example.com/y") == "a.example.com"
+    assert metrics.host_label("not a url") == "other"
@@ -0,0 +1,86 @@
+import json
+import os
+import pytest
+import video_downloader
+from video_downloader import PartialDownload
+
+PROBE = {"size": 1000, "etag": '"v1"', "last_modified": None, "accepts_ranges": True}
+
+def start_partial(path, data, manifest):
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    with open(path + ".part.json", "w") as f:
+        json.dump(manifest, f)
+    return PartialDownload(path)
+
+def manifest(ranges, **fields):
+    return dict({"url": "https://example.com/v.mp4", "size": 1000, "etag": '"v1"',
+                 "last_modified": None, "ranges": ranges}, **fields)
+
+def test_resumes_matching_manifest(tmp_path):
+    partial = start_partial(str(tmp_path / "v.mp4"), bytes(1000),
+                            manifest([[0, 99], [500, 599]]))
+    partial.load("https://example.com/v.mp4", PROBE)
+    assert partial.missing_ranges() == [(100, 499), (600, 999)]
+    assert partial.validator == '"v1"'
+
+@pytest.mark.parametrize("changes", [{"etag": '"v2"'}, {"size": 2000}, {"etag": None}])
+def test_discards_manifest_of_changed_file(tmp_path, changes):
+    path = str(tmp_path / "v.mp4")
+    partial = start_partial(path, bytes(100), manifest([[0, 99]], **changes))
+    partial.load("https://example.com/v.mp4", PROBE)
+    assert partial.missing_ranges() == [(0, 999)]
+    assert not os.path.exists(path + ".part")
+
+def test_discards_unreadable_manifest(tmp_path):
+    path = str(tmp_path / "v.mp4")
+    partial = start_partial(path, bytes(100), manifest([[0, 99]]))
+    with open(path + ".part.json", "w") as f:
+        f.write("{not json")
+    partial.load("https://example.com/v.mp4", PROBE)
+    assert partial.manifest["ranges"] == []
+
+def test_add_range_merges_and_persists(tmp_path):
+    path = str(tmp_path / "v.mp4")
+    partial = PartialDownload(path)
+    partial.load("https://example.com/v.mp4", PROBE)
+    partial.add_range(100, 199)
+    partial.add_range(0, 99)
+    with open(path + ".part.json") as f:
+        assert json.load(f)["ranges"] == [[0, 199]]
+    assert partial.watermark() == 200
+
+def test_finalize_rejects_incomplete_file(tmp_path):
+    path = str(tmp_path / "v.mp4")
+    partial = start_partial(path, bytes(1000), manifest([[0, 899]]))
+    partial.load("https://example.com/v.mp4", PROBE)
+    with pytest.raises(IOError, match="Missing byte ranges"):
+        partial.finalize()
+    partial.add_range(900, 999)
+    partial.finalize()
+    assert os.path.getsize(path) == 1000
+    assert not os.path.exists(path + ".part.json")
+
+def test_download_resumes_from_part_file(file_server, tmp_path):
+    file_server.etag = '"v1"'
+    size = len(file_server.body)
+    path = str(tmp_path / "video.mp4")
+    start_partial(path, file_server.body[:100000] + bytes(size - 100000),
+                  manifest([[0, 99999]], url=file_server.url, size=size))
+    result = video_downloader.download_file(file_server.url, path, retries=1,
+                                            progress_callback=lambda event: None)
+    assert result == path
+    with open(path, "rb") as f:
+        assert f.read() == file_server.body
+    transfers = [header for header in file_server.requests if header != "bytes=0-0"]
+    assert transfers and all(int(header[6:].split("-")[0]) >= 100000 for header in transfers)
+
+def test_download_restarts_when_file_changed(file_server, tmp_path):
+    file_server.etag = '"v2"'
+    size = len(file_server.body)
+    path = str(tmp_path / "video.mp4")
+    start_partial(path, bytes(size), manifest([[0, 99999]], url=file_server.url, size=size))
+    video_downloader.download_file(file_server.url, path, retries=1,
+                                   progress_callback=lambda event: None)
+    with open(path, "rb") as f:
+        assert f.read() == file_server.body
@@ -0,0 +1,48 @@
+import shutil
+import threading
+import pytest
+import hls
+import postprocess
+import video_downloader
+
+@pytest.fixture
+def processor(monkeypatch):
+    processor = postprocess.PostProcessor(workers=1)
+    monkeypatch.setattr(postprocess, "default_processor", processor)
+    return processor
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_hls_remux_waits_for_ffmpeg_slot(processor, monkeypatch, tmp_path):
+    playlist = {"segments": [{"url": "http://cdn.invalid/0.ts", "byterange": None}],
+                "init": None}
+    monkeypatch.setattr(hls, "load_media_playlist", lambda *args: playlist)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with processor.slot():
+        # The only slot is taken, so the cancelled download never starts ffmpeg
+        with pytest.raises(InterruptedError):
+            hls.download_hls("http://cdn.invalid/index.m3u8", str(tmp_path / "out.mp4"),
+                             progress_callback=lambda event: None, cancel_event=cancel_event)
+        assert processor.stats()["queued"] == 0
+    assert processor.stats()["running"] == 0
+
+def test_convert_falls_back_and_remembers(processor):
+    commands = []
+    def build(mode):
+        commands.append(mode)
+        return ["false"] if mode == "remux" else ["true"]
+    assert processor.convert("stream-a", build, lambda event: None) == "transcode"
+    assert processor.convert("stream-a", build, lambda event: None) == "transcode"
+    assert commands == ["remux", "transcode", "transcode"]
+
+def test_remux_decision_is_per_stream(processor, monkeypatch, tmp_path):
+    def unsupported(*args, **kwargs):
+        raise hls.HLSUnsupported("test")
+    monkeypatch.setattr(hls, "download_hls", unsupported)
+    keys = []
+    monkeypatch.setattr(processor, "convert", lambda key, *args: keys.append(key) or "remux")
+    for name in ("one", "two"):
+        video_downloader.convert_m3u8_to_mp4(f"https://cdn.example.com/{name}/index.m3u8",
+                                             str(tmp_path / f"{name}.m3u8"))
+    # Two streams from the same CDN don't share a decision
+    assert len(set(keys)) == 2
@@ -0,0 +1,53 @@
+import functools
+import os
+import pytest
+import video_downloader
+
+@pytest.mark.parametrize("head_status", [403, 405])
+def test_probe_ignores_rejected_head(file_server, head_status):
+    file_server.head_status = head_status
+    probe = video_downloader.probe_download(file_server.url)
+    assert probe["size"] == len(file_server.body)
+    assert probe["accepts_ranges"]
+
+def test_probe_without_range_support(file_server):
+    file_server.ranges = False
+    probe = video_downloader.probe_download(file_server.url)
+    assert probe["size"] == len(file_server.body)
+    assert not probe["accepts_ranges"]
+
+def test_parse_probe_error_status_leaves_size_unknown():
+    probe = video_downloader.parse_probe(403, {"Content-Length": "243"})
+    assert probe["size"] == 0
+    assert not probe["accepts_ranges"]
+
+def test_parse_probe_unknown_total():
+    probe = video_downloader.parse_probe(206, {"Content-Range": "bytes 0-0/*"})
+    assert probe["size"] == 0
+    assert not probe["accepts_ranges"]
+
+@pytest.mark.parametrize("head_status", [403, 405])
+def test_download_when_head_is_rejected(file_server, tmp_path, head_status):
+    file_server.head_status = head_status
+    target = str(tmp_path / "video.mp4")
+    result = video_downloader.download_file(file_server.url, target, retries=1,
+                                            progress_callback=lambda event: None)
+    assert result == target
+    with open(target, 'rb') as f:
+        assert f.read() == file_server.body
+    assert not os.path.exists(target + '.part.json')
+
+@pytest.mark.parametrize("head_status", [403, 405])
+def test_async_download_when_head_is_rejected(file_server, tmp_path, head_status):
+    from async_engine import AsyncEngine
+    file_server.head_status = head_status
+    engine = AsyncEngine().start()
+    target = str(tmp_path / "video.mp4")
+    try:
+        download = functools.partial(engine.download_file, retries=1)
+        result = engine.submit("job", download, args=(file_server.url, target)).result(30)
+    finally:
+        engine.stop()
+    assert result == target
+    with open(target, 'rb') as f:
+        assert f.read() == file_server.body
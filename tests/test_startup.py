@@ -0,0 +1,41 @@
+import os
+import sys
+import subprocess
+import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_CHECK = """
+import sys, threading
+import app
+assert threading.active_count() == 1, threading.enumerate()
+heavy = [name for name in ("youtube_dl", "ffmpeg") if name in sys.modules]
+assert not heavy, heavy
+app.warmup()
+assert threading.active_count() == 1, threading.enumerate()
+"""
+
+def test_import_starts_nothing_and_skips_heavy_backends():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, "-c", IMPORT_CHECK], env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+def test_background_starts_once_per_process(monkeypatch):
+    started = []
+    monkeypatch.setattr(app, "background_pid", None)
+    monkeypatch.setattr(app.scheduler, "start", lambda: started.append(os.getpid()))
+    monkeypatch.setattr(app, "async_engine", None)
+    monkeypatch.setattr(app.download_catalog, "start_reconciler", lambda: None)
+    monkeypatch.setattr(app.storage.default_manager, "start_evictor", lambda: None)
+    monkeypatch.setattr(app, "current_worker", lambda: None)
+    monkeypatch.setattr(app, "run_worker_heartbeat", lambda: None)
+    monkeypatch.setattr(app, "run_job_sweeper", lambda: None)
+    monkeypatch.setattr(app, "YTDL_PREWARM", False)
+    app.start_background()
+    app.start_background()
+    assert started == [os.getpid()]
+    # A worker forked from a process that already started them starts its own
+    monkeypatch.setattr(app, "background_pid", -1)
+    app.start_background()
+    assert started == [os.getpid(), os.getpid()]
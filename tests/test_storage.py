@@ -0,0 +1,94 @@
+import os
+import threading
+import pytest
+import storage
+import video_downloader
+from catalog import Catalog
+from content_store import ContentStore
+
+@pytest.fixture
+def manager(tmp_path):
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    manager = storage.StorageManager(str(directory), quota=10000, low_water=5000)
+    manager.store = ContentStore(str(tmp_path / "state" / "objects"))
+    manager.catalog = Catalog(str(directory), str(tmp_path / "state" / "catalog.db"))
+    return manager
+
+def write(manager, name, size):
+    path = os.path.join(manager.directory, name)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+def test_hard_links_count_once(manager):
+    first = write(manager, "a.mp4", 3000)
+    manager.store.ingest(first)
+    second = manager.store.materialize(manager.store.lookup_path(first),
+                                       os.path.join(manager.directory, "b.mp4"))
+    manager.catalog.add(first)
+    manager.catalog.add(second)
+    assert manager.scan().used == 3000
+    # The data stays while the other name links to it
+    assert manager.remove(first) == 0
+    assert manager.remove(second) == 3000
+    assert manager.scan().used == 0
+
+def test_counts_partial_downloads_not_state(manager):
+    manager.catalog.add(write(manager, "done.mp4", 1000))
+    write(manager, "video.mp4.part", 2000)
+    write(manager, ".catalog.db", 4000)
+    usage = manager.scan()
+    assert usage.used == 3000
+    assert usage.allocated == {os.path.join(manager.directory, "video.mp4"): 2000}
+
+def test_reconcile_repairs_total(manager):
+    path = write(manager, "outside.mp4", 1500)
+    os.link(path, os.path.join(manager.directory, "outside-link.mp4"))
+    manager.catalog.reconcile()
+    assert manager.catalog.total_bytes() == 1500
+
+def test_eviction_frees_what_it_reports(manager):
+    for index in range(4):
+        manager.catalog.add(write(manager, f"old-{index}.mp4", 2000))
+    manager.catalog.touch(os.path.join(manager.directory, "old-0.mp4"), 1)
+    manager.reserve(os.path.join(manager.directory, "new.mp4"), 4000)
+    usage = manager.scan()
+    assert usage.used + usage.pending() <= manager.quota
+    assert manager.evicted_bytes == 8000 - manager.catalog.total_bytes()
+
+def test_missing_directory(tmp_path):
+    manager = storage.StorageManager(str(tmp_path / "missing"))
+    assert manager.scan().used == 0
+
+def test_reservations_made_during_scan_count(manager, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_FULL_POLICY", "reject")
+    manager.catalog = None
+    scan_files = manager.scan_files
+    raced = []
+    def racing_scan():
+        # Another download reserves while this one reads the directory
+        if not raced:
+            raced.append(True)
+            thread = threading.Thread(target=manager.reserve,
+                                      args=(os.path.join(manager.directory, "b.mp4"), 6000))
+            thread.start()
+            thread.join()
+        return scan_files()
+    monkeypatch.setattr(manager, "scan_files", racing_scan)
+    with pytest.raises(storage.StorageFull):
+        manager.reserve(os.path.join(manager.directory, "a.mp4"), 6000)
+    assert list(manager.reservations.values()) == [6000]
+
+def test_hls_reserves_the_mp4_it_writes(monkeypatch):
+    reserved = []
+    def convert(m3u8_url, output_path, *args):
+        reserved.extend(storage.default_manager.reservations)
+        return None
+    monkeypatch.setattr(video_downloader, "convert_m3u8_to_mp4", convert)
+    monkeypatch.setattr(video_downloader, "download_with_youtube_dl", lambda *args: None)
+    info = {"title": "Stream", "url": "https://cdn.example.com/stream.m3u8", "extension": "m3u8",
+            "output_path": os.path.join(video_downloader.DOWNLOAD_DIR, "Stream.m3u8")}
+    video_downloader.fetch_video("https://example.com/stream", info)
+    assert reserved == [os.path.abspath(os.path.join(video_downloader.DOWNLOAD_DIR, "Stream.mp4"))]
+    assert not storage.default_manager.reservations
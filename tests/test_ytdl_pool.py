@@ -0,0 +1,99 @@
+import sys
+import threading
+import textwrap
+import pytest
+import ytdl_pool
+
+# Speaks the worker protocol; the URL says how to handle the job
+STUB_WORKER = textwrap.dedent("""
+    import os, sys, json, time
+
+    def send(message):
+        sys.stdout.write(json.dumps(message) + "\\n")
+        sys.stdout.flush()
+
+    send({"event": "ready"})
+    for line in sys.stdin:
+        request = json.loads(line)
+        url = request.get("url")
+        if request["op"] == "ping":
+            send({"event": "pong"})
+        elif url == "crash":
+            sys.exit(1)
+        elif url == "hang":
+            time.sleep(60)
+        elif url == "fail":
+            send({"event": "error", "message": "Unsupported URL"})
+        else:
+            if request["op"] == "download":
+                send({"event": "progress", "data": {"status": "downloading",
+                                                    "downloaded_bytes": 5}})
+            send({"event": "result", "info": {"title": url, "pid": os.getpid(),
+                                              "options": request["options"]}})
+""")
+
+@pytest.fixture
+def make_pool(tmp_path):
+    script = tmp_path / "stub_worker.py"
+    script.write_text(STUB_WORKER)
+    pools = []
+    def make_pool(**kwargs):
+        pool = ytdl_pool.YoutubeDLPool(size=1, command=[sys.executable, str(script)], **kwargs)
+        pools.append(pool)
+        return pool
+    yield make_pool
+    for pool in pools:
+        pool.shutdown()
+
+def test_jobs_reuse_a_warm_worker(make_pool):
+    pool = make_pool()
+    first = pool.extract("a", {"format": "best"})
+    assert first["title"] == "a" and first["options"] == {"format": "best"}
+    assert pool.extract("b")["pid"] == first["pid"]
+    assert pool.stats() == {"workers": 1, "running": 1, "free": 1}
+
+def test_progress_reaches_hook(make_pool):
+    events = []
+    info = make_pool().download("a", progress_hook=events.append)
+    assert info["title"] == "a"
+    assert events == [{"status": "downloading", "downloaded_bytes": 5}]
+
+def test_job_error_keeps_worker(make_pool):
+    pool = make_pool()
+    pid = pool.extract("a")["pid"]
+    with pytest.raises(ytdl_pool.WorkerError, match="Unsupported URL"):
+        pool.extract("fail")
+    assert pool.extract("b")["pid"] == pid
+
+def test_crashed_worker_is_replaced(make_pool):
+    pool = make_pool()
+    pid = pool.extract("a")["pid"]
+    with pytest.raises(ytdl_pool.WorkerError, match="exited"):
+        pool.extract("crash")
+    assert pool.extract("b")["pid"] != pid
+
+def test_stalled_worker_is_killed(make_pool):
+    pool = make_pool(stall_timeout=1)
+    with pytest.raises(ytdl_pool.WorkerError, match="stalled"):
+        pool.extract("hang")
+    assert pool.extract("a")["title"] == "a"
+
+def test_cancel_kills_job(make_pool):
+    pool = make_pool()
+    cancel_event = threading.Event()
+    threading.Timer(0.2, cancel_event.set).start()
+    with pytest.raises(ytdl_pool.JobCancelled):
+        pool.download("hang", cancel_event=cancel_event)
+    assert pool.extract("a")["title"] == "a"
+
+def test_worker_recycled_after_max_jobs(make_pool):
+    pool = make_pool(max_jobs=2)
+    pids = [pool.extract(url)["pid"] for url in ("a", "b", "c")]
+    assert pids[0] == pids[1] != pids[2]
+
+def test_idle_worker_is_pinged(make_pool, monkeypatch):
+    monkeypatch.setattr(ytdl_pool, "YTDL_HEALTH_CHECK_INTERVAL", 0)
+    pool = make_pool()
+    pid = pool.extract("a")["pid"]
+    # Answers the ping, so it is kept
+    assert pool.extract("b")["pid"] == pid
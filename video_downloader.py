@@ -2,35 +2,74 @@
 import os
 import re
 import sys
-import requests
 import random
 import time
-import subprocess
+import queue
+import argparse
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import logging
+import http_pool
+import metadata_cache
+import content_store
+import hls
+import extractors
+import ytdl_pool
+import postprocess
+import metrics
+import bandwidth
+import storage
+from job_scheduler import DOWNLOAD_WORKERS
+from progress import ProgressTracker, youtube_dl_hook, PROGRESS_INTERVAL
 
-# Import youtube-dl for video extraction
-try:
-    import youtube_dl
-except ImportError:
-    youtube_dl = None
-
-# Import ffmpeg if available
-try:
-    import ffmpeg
-    ffmpeg_available = True
-except ImportError:
-    ffmpeg_available = False
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('video_downloader')
 
+# Log level set up by entry points (the web app, the command line, benchmarks)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# ffmpeg-python, imported on first use; False until then
+ffmpeg = False
+ffmpeg_lock = threading.Lock()
+
+def setup_logging(level=None):
+    """Configure root logging; only entry points call this, never imported modules"""
+    logging.basicConfig(level=level or LOG_LEVEL, format=LOG_FORMAT)
+
+def load_ffmpeg():
+    """The ffmpeg-python module, or None if it isn't installed"""
+    global ffmpeg
+    with ffmpeg_lock:
+        if ffmpeg is False:
+            try:
+                import ffmpeg as module
+            except ImportError:
+                module = None
+            ffmpeg = module
+    return ffmpeg
+
 # Download directory
 DOWNLOAD_DIR = "./downloads"
 
+# Parallel range download settings
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Seconds between manifest reads when following another process's download
+WATERMARK_POLL_INTERVAL = 0.5
+
+# Seconds between cancellation checks while following another job's download
+FLIGHT_POLL_INTERVAL = 0.5
+
+# Videos extracted ahead of the download workers in batch mode
+BATCH_EXTRACT_AHEAD = int(os.environ.get("BATCH_EXTRACT_AHEAD", "8"))
+
+# Resume settings
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", "3"))
+MANIFEST_FLUSH_BYTES = 4 * 1024 * 1024
+
 # User agents
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -39,6 +78,14 @@ USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 11.5; rv:90.0) Gecko/20100101 Firefox/90.0"
 ]
 
+class DownloadCancelled(Exception):
+    """Raised inside a download when its cancel event is set"""
+
+def check_cancelled(cancel_event):
+    """Stop the current download if it has been cancelled"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise DownloadCancelled("Download cancelled")
+
 def get_random_user_agent():
     """Get a random user agent from the list"""
     return random.choice(USER_AGENTS)
@@ -47,216 +94,743 @@ def clean_filename(filename):
     """Clean filename from invalid characters"""
     return re.sub(r'[\\/*?:"<>|]', "_", filename)
 
-def get_file_size(url, headers=None):
-    """Get file size from Content-Length header"""
+def content_range_size(value):
+    """Total size from a 'bytes 0-0/1234' Content-Range, or 0 if it isn't given"""
+    total = (value or '').rpartition('/')[2].strip()
+    return int(total) if total.isdigit() else 0
+
+def parse_probe(status, headers):
+    """Size, range support and validators from the answer to a probe request
+    
+    A 206 to 'Range: bytes=0-0' gives the size in Content-Range and shows
+    ranges work; a 200 means the server ignored the range. Any other status
+    (a server or signed URL that only allows some methods, an error page)
+    leaves the size unknown, so the download runs as a single stream.
+    """
+    probe = {"size": 0, "accepts_ranges": False, "etag": None, "last_modified": None}
+    headers = {name.lower(): value for name, value in headers.items()}
+    if status == 206:
+        probe["size"] = content_range_size(headers.get('content-range'))
+        probe["accepts_ranges"] = probe["size"] > 0
+    elif status == 200:
+        probe["size"] = int(headers.get('content-length') or 0)
+    else:
+        return probe
+    probe["etag"] = headers.get('etag')
+    probe["last_modified"] = headers.get('last-modified')
+    return probe
+
+def probe_headers(headers):
+    """Request headers for a probe: the first byte, unencoded so sizes are real"""
+    return dict(headers, **{'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'})
+
+def probe_download(url, headers=None):
+    """Get file size, byte range support and validators
+    
+    Probes with a one-byte GET rather than HEAD: presigned URLs and some
+    CDNs reject HEAD, and the size of an error body isn't the file's.
+    """
+    probe = {"size": 0, "accepts_ranges": False, "etag": None, "last_modified": None}
     try:
         if headers is None:
             headers = {'User-Agent': get_random_user_agent()}
         
-        response = requests.head(url, headers=headers, timeout=10)
-        if 'Content-Length' in response.headers:
-            return int(response.headers['Content-Length'])
-        return 0
+        with metrics.timed("probe"):
+            response = http_pool.get(url, headers=probe_headers(headers), timeout=10,
+                                     allow_redirects=True, stream=True)
+        # Don't read the body of a server that ignored the range
+        response.close()
+        probe = parse_probe(response.status_code, response.headers)
+        if probe["size"] == 0:
+            logger.warning(f"Couldn't get the size of {url} (HTTP {response.status_code}), "
+                           f"downloading it as a single stream")
     except Exception as e:
-        logger.error(f"Error getting file size: {e}")
-        return 0
+        logger.error(f"Error probing download: {e}")
+    return probe
 
-def download_file(url, filepath, headers=None, chunk_size=8192):
-    """Download file with progress tracking"""
-    if headers is None:
-        headers = {'User-Agent': get_random_user_agent()}
+def get_file_size(url, headers=None):
+    """Get file size from Content-Length header"""
+    return probe_download(url, headers)["size"]
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent inclusive byte ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class PartialDownload:
+    """A .part file with a sidecar manifest of completed byte ranges
     
-    try:
-        # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    Besides the persisted manifest, the downloader marks bytes as available
+    as soon as they are written, so readers can follow the contiguous-prefix
+    watermark while the download is still running.
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.part_path = filepath + '.part'
+        self.manifest_path = filepath + '.part.json'
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.available = []
+        self.available_condition = threading.Condition()
+        self.closed = False
+        self.live = True
+    
+    @classmethod
+    def follow(cls, filepath):
+        """Watch a download running in another process through its manifest"""
+        partial = cls(filepath)
+        partial.live = False
+        if not partial.reload():
+            return None
+        return partial
+    
+    def reload(self):
+        """Re-read the manifest of a download owned by another process"""
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            # The manifest disappears once the download is renamed into place
+            self.closed = True
+            return False
+        with self.available_condition:
+            self.available = merge_ranges(self.available + self.manifest["ranges"])
+        return True
+    
+    def load(self, url, probe):
+        """Load the manifest, discarding partial data the server no longer matches"""
+        manifest = None
+        if os.path.exists(self.part_path) and os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable manifest {self.manifest_path}: {e}")
         
-        # Check if file exists
-        if os.path.exists(filepath):
-            logger.info(f"File already exists: {filepath}")
-            return filepath
+        if manifest is not None and not self.matches(manifest, probe):
+            logger.info(f"Remote file changed, discarding partial download: {self.part_path}")
+            manifest = None
+        
+        if manifest is None:
+            self.discard()
+            manifest = {
+                "url": url,
+                "size": probe["size"],
+                "etag": probe["etag"],
+                "last_modified": probe["last_modified"],
+                "ranges": []
+            }
+        else:
+            logger.info(f"Resuming partial download: {self.completed_bytes(manifest)} "
+                        f"of {manifest['size']} bytes on disk")
         
-        # Get file size
-        file_size = get_file_size(url, headers)
+        self.manifest = manifest
+        with self.available_condition:
+            self.available = [list(r) for r in manifest["ranges"]]
+            self.closed = False
+        return manifest
+    
+    @staticmethod
+    def matches(manifest, probe):
+        """Check whether a saved manifest still describes the remote file"""
+        if manifest.get("size") != probe["size"]:
+            return False
+        if manifest.get("etag") and probe["etag"]:
+            return manifest["etag"] == probe["etag"]
+        if manifest.get("last_modified") and probe["last_modified"]:
+            return manifest["last_modified"] == probe["last_modified"]
+        # Without validators we can't tell whether the partial data is still good
+        return False
+    
+    @staticmethod
+    def completed_bytes(manifest):
+        return sum(end - start + 1 for start, end in manifest["ranges"])
+    
+    @property
+    def validator(self):
+        """Value for If-Range so a changed file is never stitched onto old bytes"""
+        etag = self.manifest.get("etag")
+        # If-Range only accepts strong validators
+        if etag and not etag.startswith('W/'):
+            return etag
+        return self.manifest.get("last_modified")
+    
+    def add_range(self, start, end):
+        """Record a completed byte range and persist the manifest"""
+        with self.lock:
+            self.manifest["ranges"] = merge_ranges(self.manifest["ranges"] + [[start, end]])
+            self.save()
+        self.mark_available(start, end)
+    
+    def keep_prefix(self, length):
+        """Forget completed ranges past the first length bytes"""
+        with self.lock:
+            self.manifest["ranges"] = [[0, length - 1]] if length else []
+            self.save()
+        with self.available_condition:
+            self.available = [list(r) for r in self.manifest["ranges"]]
+    
+    def mark_available(self, start, end):
+        """Note that bytes start..end are on disk and wake waiting readers"""
+        with self.available_condition:
+            self.available = merge_ranges(self.available + [[start, end]])
+            self.available_condition.notify_all()
+    
+    def watermark(self):
+        """Length of the contiguous prefix written so far"""
+        with self.available_condition:
+            if self.available and self.available[0][0] == 0:
+                return self.available[0][1] + 1
+            return 0
+    
+    def wait_for(self, offset, timeout):
+        """Wait until bytes past offset are available; returns the watermark
+        
+        Returns early once the download has ended, whether or not it succeeded.
+        """
+        deadline = time.time() + timeout
+        while True:
+            watermark = self.watermark()
+            remaining = deadline - time.time()
+            if watermark > offset or self.closed or remaining <= 0:
+                return watermark
+            if self.live:
+                with self.available_condition:
+                    self.available_condition.wait(remaining)
+            else:
+                time.sleep(min(WATERMARK_POLL_INTERVAL, remaining))
+                self.reload()
+    
+    def close(self):
+        """Mark the download as ended and wake waiting readers"""
+        with self.available_condition:
+            self.closed = True
+            self.available_condition.notify_all()
+    
+    def save(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_path, self.manifest_path)
+    
+    def contiguous_prefix(self):
+        """Number of bytes available from the start of the file"""
+        ranges = self.manifest["ranges"]
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1] + 1
+        return 0
+    
+    def missing_ranges(self):
+        """Inclusive byte ranges that still need to be downloaded"""
+        missing = []
+        position = 0
+        for start, end in self.manifest["ranges"]:
+            if start > position:
+                missing.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.manifest["size"]:
+            missing.append((position, self.manifest["size"] - 1))
+        return missing
+    
+    def finalize(self, size=None):
+        """Verify the partial file and rename it into place"""
+        expected = self.manifest["size"] or size
+        actual = os.path.getsize(self.part_path)
+        if expected and actual != expected:
+            raise IOError(f"Size mismatch for {self.part_path}: got {actual}, expected {expected}")
+        if self.manifest["size"] and self.missing_ranges():
+            raise IOError(f"Missing byte ranges in {self.part_path}: {self.missing_ranges()}")
         
-        # Start download
-        logger.info(f"Downloading {url} to {filepath}")
-        logger.info(f"File size: {file_size/1024/1024:.2f} MB")
+        os.replace(self.part_path, self.filepath)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+    
+    def discard(self):
+        for path in (self.part_path, self.manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+# Downloads in progress in this process, keyed by absolute file path
+live_downloads = {}
+live_downloads_lock = threading.Lock()
+
+def split_ranges(ranges, connections):
+    """Split inclusive (start, end) byte ranges into segments for parallel download"""
+    total = sum(end - start + 1 for start, end in ranges)
+    # Use a few more segments than connections so fast connections pick up extra work
+    segment_size = max(MIN_SEGMENT_SIZE, -(-total // (connections * 4)))
+    
+    segments = []
+    for range_start, range_end in ranges:
+        for start in range(range_start, range_end + 1, segment_size):
+            segments.append((start, min(start + segment_size - 1, range_end)))
+    return segments
+
+def check_validator(response, partial):
+    """Make sure a range response comes from the same version of the file"""
+    etag = response.headers.get('ETag')
+    if partial.manifest.get("etag") and etag and etag != partial.manifest["etag"]:
+        raise IOError(f"ETag changed during download: {etag} != {partial.manifest['etag']}")
+
+def download_range(url, partial, start, end, headers, chunk_size, on_chunk):
+    """Download one byte range and write it at its offset in the partial file"""
+    range_headers = dict(headers)
+    range_headers['Range'] = f"bytes={start}-{end}"
+    if partial.validator:
+        range_headers['If-Range'] = partial.validator
+    
+    started = time.perf_counter()
+    response = http_pool.get(url, headers=range_headers, stream=True, timeout=30)
+    metrics.observe_stage("first_byte", time.perf_counter() - started)
+    expected = end - start + 1
+    written = 0
+    flushed = 0
+    try:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server ignored range request (HTTP {response.status_code})")
+        check_validator(response, partial)
         
-        start_time = time.time()
-        response = requests.get(url, headers=headers, stream=True, timeout=30)
+        with open(partial.part_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    chunk = chunk[:expected - written]
+                    f.write(chunk)
+                    written += len(chunk)
+                    f.flush()
+                    partial.mark_available(start, start + written - 1)
+                    on_chunk(len(chunk))
+                    
+                    # Persist progress now and then so a retry loses little work
+                    if written - flushed >= MANIFEST_FLUSH_BYTES:
+                        f.flush()
+                        partial.add_range(start, start + written - 1)
+                        flushed = written
+                    if written >= expected:
+                        break
+    finally:
+        response.close()
+        if written > flushed:
+            partial.add_range(start, start + written - 1)
+    
+    if written != expected:
+        raise IOError(f"Incomplete range {start}-{end}: got {written} of {expected} bytes")
+
+def download_segmented(url, partial, headers, chunk_size, connections, tracker,
+                       cancel_event=None, share=None):
+    """Download the missing parts of a file over several connections using byte ranges"""
+    file_size = partial.manifest["size"]
+    segments = split_ranges(partial.missing_ranges(), connections)
+    logger.info(f"Downloading {url} to {partial.part_path} in {len(segments)} segments "
+                f"over {connections} connections")
+    
+    # Preallocate the file so each segment can be written at its offset
+    if not os.path.exists(partial.part_path):
+        with open(partial.part_path, 'wb') as f:
+            f.truncate(file_size)
+    
+    stop_event = threading.Event()
+    host = bandwidth.host_of(url)
+    
+    def on_chunk(length):
+        # Stop every segment once the job is cancelled or another segment failed
+        check_cancelled(cancel_event)
+        check_cancelled(stop_event)
+        tracker.add(length)
+        if share is not None:
+            share.consume(length, host, cancel_event)
+    
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [
+            executor.submit(download_range, url, partial, start, end,
+                            headers, chunk_size, on_chunk)
+            for start, end in segments
+        ]
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                stop_event.set()
+                for pending in futures:
+                    pending.cancel()
+                raise error
+    
+def download_stream(url, partial, headers, chunk_size, accepts_ranges, tracker,
+                    cancel_event=None, hasher=None, share=None):
+    """Download a file over a single connection, resuming from the contiguous prefix
+    
+    If hasher is given it is fed the whole file, starting with any resumed prefix.
+    """
+    offset = partial.contiguous_prefix() if accepts_ranges else 0
+    
+    request_headers = dict(headers)
+    if offset:
+        request_headers['Range'] = f"bytes={offset}-"
+        if partial.validator:
+            request_headers['If-Range'] = partial.validator
+    
+    logger.info(f"Downloading {url} to {partial.part_path}"
+                + (f" from byte {offset}" if offset else ""))
+    host = bandwidth.host_of(url)
+    
+    started = time.perf_counter()
+    response = http_pool.get(url, headers=request_headers, stream=True, timeout=30)
+    metrics.observe_stage("first_byte", time.perf_counter() - started)
+    downloaded = flushed = 0
+    try:
         response.raise_for_status()
         
-        downloaded = 0
-        with open(filepath, 'wb') as f:
+        if offset and response.status_code != 206:
+            logger.info("Server refused to resume, restarting from the beginning")
+            offset = 0
+        if offset:
+            check_validator(response, partial)
+        partial.keep_prefix(offset)
+        
+        downloaded = flushed = offset
+        with open(partial.part_path, 'r+b' if offset else 'wb') as f:
+            if hasher is not None and offset:
+                hasher.update(f.read(offset))
+            f.seek(offset)
             for chunk in response.iter_content(chunk_size=chunk_size):
                 if chunk:
+                    check_cancelled(cancel_event)
                     f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
                     downloaded += len(chunk)
+                    f.flush()
+                    partial.mark_available(downloaded - len(chunk), downloaded - 1)
                     
-                    # Calculate progress
-                    percent = (downloaded / file_size * 100) if file_size else 0
-                    elapsed = time.time() - start_time
-                    speed = downloaded / elapsed if elapsed > 0 else 0
+                    # Persist progress now and then so a retry loses little work
+                    if downloaded - flushed >= MANIFEST_FLUSH_BYTES:
+                        f.flush()
+                        partial.add_range(0, downloaded - 1)
+                        flushed = downloaded
                     
-                    # Display progress
-                    sys.stdout.write(f"\rProgress: {percent:.1f}% | "
-                                    f"{downloaded/1024/1024:.2f} MB / {file_size/1024/1024:.2f} MB | "
-                                    f"Speed: {speed/1024/1024:.2f} MB/s")
-                    sys.stdout.flush()
+                    tracker.update(downloaded)
+                    if share is not None:
+                        share.consume(len(chunk), host, cancel_event)
+            f.truncate()
+    finally:
+        response.close()
+        if downloaded > flushed:
+            partial.add_range(0, downloaded - 1)
+    
+    return downloaded
+
+def get_live_download(filepath):
+    """PartialDownload for a file that is still being downloaded, or None
+    
+    Downloads running in another worker process are followed through their
+    on-disk manifest.
+    """
+    with live_downloads_lock:
+        partial = live_downloads.get(os.path.abspath(filepath))
+    if partial is not None:
+        return partial
+    if os.path.exists(filepath + '.part.json'):
+        return PartialDownload.follow(filepath)
+    return None
+
+def download_file(url, filepath, headers=None, chunk_size=8192, connections=None,
+                  retries=None, cancel_event=None, on_digest=None, progress_callback=None,
+                  share=None):
+    """Download file with progress tracking, resuming partial downloads
+    
+    progress_callback receives throttled progress events (bytes, total, rate,
+    ETA); without one, progress is printed to stdout. share is the job's
+    bandwidth.Share; without one the download still obeys the global and
+    per-host caps.
+    
+    If on_digest is given it is called with the content digest of the finished
+    file. The single-connection path hashes while streaming; segmented
+    downloads are hashed by reading the assembled file back. Raises
+    storage.StorageFull if the file doesn't fit.
+    """
+    if headers is None:
+        headers = {'User-Agent': get_random_user_agent()}
+    if connections is None:
+        connections = DOWNLOAD_CONNECTIONS
+    if retries is None:
+        retries = DOWNLOAD_RETRIES
+    
+    try:
+        # Create directory if it doesn't exist
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
         
-        print()  # New line after progress
-        logger.info(f"Download completed: {filepath}")
-        return filepath
-            
+        # Finished files are only renamed into place after verification
+        partial = PartialDownload(filepath)
+        if os.path.exists(filepath) and not os.path.exists(partial.part_path):
+            logger.info(f"File already exists: {filepath}")
+            if on_digest is not None:
+                on_digest(content_store.hash_file(filepath).hexdigest())
+            return filepath
     except Exception as e:
         logger.error(f"Download failed: {str(e)}")
         return None
+    
+    # Let readers such as /stream follow the download while it runs
+    with live_downloads_lock:
+        live_downloads[os.path.abspath(filepath)] = partial
+    try:
+        with bandwidth.ensure_share(share) as share:
+            return download_attempts(url, partial, headers, chunk_size, connections, retries,
+                                     cancel_event, on_digest, progress_callback, share)
+    finally:
+        partial.close()
+        storage.default_manager.release(filepath)
+        with live_downloads_lock:
+            live_downloads.pop(os.path.abspath(filepath), None)
+
+def download_attempts(url, partial, headers, chunk_size, connections, retries,
+                      cancel_event, on_digest, progress_callback, share):
+    """Run download attempts for download_file, resuming after each failure"""
+    filepath = partial.filepath
+    for attempt in range(1, retries + 1):
+        try:
+            # Get file size, range support and validators
+            probe = probe_download(url, headers)
+            partial.load(url, probe)
+            file_size = probe["size"]
+            logger.info(f"File size: {file_size/1024/1024:.2f} MB")
+            # Make room for the rest of the file before writing any of it
+            storage.default_manager.reserve(filepath, file_size, cancel_event)
+            check_cancelled(cancel_event)
+            resumed = partial.completed_bytes(partial.manifest)
+            tracker = ProgressTracker(progress_callback, total=file_size,
+                                      downloaded=resumed, file_path=filepath)
+            
+            transfer_started = time.perf_counter()
+            downloaded = None
+            hasher = content_store.new_hasher() if on_digest is not None else None
+            # Use several connections when the server supports byte ranges
+            if probe["accepts_ranges"] and connections > 1 and file_size >= 2 * MIN_SEGMENT_SIZE:
+                try:
+                    download_segmented(url, partial, headers, chunk_size, connections,
+                                       tracker, cancel_event, share)
+                    downloaded = file_size
+                    # Segments arrive out of order, so hash the assembled file
+                    if hasher is not None:
+                        content_store.hash_file(partial.part_path, hasher)
+                except DownloadCancelled:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Segmented download failed, falling back to single stream: {e}")
+            
+            if downloaded is None:
+                downloaded = download_stream(url, partial, headers, chunk_size,
+                                             probe["accepts_ranges"], tracker,
+                                             cancel_event, hasher, share)
+            
+            transfer_time = time.perf_counter() - transfer_started
+            metrics.observe_stage("transfer", transfer_time)
+            metrics.observe_transfer(url, downloaded - resumed, transfer_time)
+            
+            partial.finalize(downloaded)
+            tracker.finish(downloaded=downloaded)
+            if progress_callback is None:
+                print()  # New line after progress
+            if on_digest is not None:
+                on_digest(hasher.hexdigest())
+            logger.info(f"Download completed: {filepath}")
+            return filepath
+        
+        except DownloadCancelled:
+            logger.info(f"Download cancelled: {filepath}")
+            partial.discard()
+            return None
+        except storage.StorageFull:
+            raise
+        except Exception as e:
+            logger.error(f"Download failed (attempt {attempt}/{retries}): {str(e)}")
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+    
+    return None
+
+TITLE_RE = re.compile(r'<title>(.*?)</title>')
 
+# Media sources on an XVideos page, from best to worst
+XVIDEOS_SOURCES_RE = re.compile(
+    r'html5player\.setVideo(?P<kind>HLS|UrlHigh|UrlLow)\([\'"](?P<url>.+?)[\'"]\)'
+    r'|(?P<cdn_url>https?://(?:www\.)?cdn[^\'"\s]+\.mp4[^\'"\s]*)'
+)
+XVIDEOS_RANKING = {"HLS": 3, "UrlHigh": 2, "UrlLow": 1}
+XVIDEOS_PATTERNS = {"title": TITLE_RE, "sources": XVIDEOS_SOURCES_RE}
+
+# Longest title or source URL searched for across page chunks; flashvars blocks
+# can be far longer and use PAGE_SCAN_OVERLAP
+SHORT_MATCH_LIMIT = 4096
+XVIDEOS_LIMITS = {"title": SHORT_MATCH_LIMIT, "sources": SHORT_MATCH_LIMIT}
+
+PORNHUB_FLASHVARS_RE = re.compile(r'var\s+flashvars_\d+\s*=\s*({.*?});', re.DOTALL)
+PORNHUB_PATTERNS = {"title": TITLE_RE, "flashvars": PORNHUB_FLASHVARS_RE}
+PORNHUB_LIMITS = {"title": SHORT_MATCH_LIMIT}
+
+# quality_720p style keys, then mediaDefinitions entries
+PORNHUB_SOURCES_RE = re.compile(
+    r'"quality_(?P<height>\d+)p":"(?P<url>[^"]+)"'
+    r'|"quality":"(?P<quality>[^"]+)"[^}]+"videoUrl":"(?P<video_url>[^"]+)"'
+)
+
+def page_title(matches, suffix, default):
+    """Cleaned <title> of a page with the site's suffix removed"""
+    title = matches[0].group(1).strip() if matches else default
+    return clean_filename(title.replace(suffix, '').strip())
+
+def rank_xvideos_source(match):
+    if match.group('kind'):
+        return XVIDEOS_RANKING[match.group('kind')]
+    # Generic CDN links are a last resort
+    return 0
+
+def rank_pornhub_source(match):
+    if match.group('height'):
+        return (1, int(match.group('height')))
+    quality = match.group('quality')
+    return (0, int(quality) if quality.isdigit() else 0)
+
+def unique_variants(variants):
+    """Quality variants in order, without repeats of the same URL"""
+    seen = set()
+    unique = []
+    for variant in variants:
+        if variant["url"] not in seen:
+            seen.add(variant["url"])
+            unique.append(variant)
+    return unique
+
+def xvideos_variant(match):
+    kind = match.group('kind')
+    return {
+        "quality": kind or "generic",
+        "url": match.group('url') if kind else match.group('cdn_url'),
+        "extension": "m3u8" if kind == "HLS" else "mp4",
+    }
+
+def pornhub_variant(match):
+    height = match.group('height')
+    return {
+        "quality": f"{height}p" if height else match.group('quality'),
+        "url": (match.group('url') or match.group('video_url')).replace('\\/', '/'),
+        "extension": "mp4",
+    }
+
+def xvideos_page_complete(found):
+    # Nothing can beat an HLS source, so stop reading once we have one
+    return bool(found["title"]) and any(match.group('kind') == "HLS"
+                                        for match in found["sources"])
+
+def pornhub_page_complete(found):
+    return bool(found["title"]) and bool(found["flashvars"])
+
+@extractors.register('xvideos.com')
 def get_xvideos_info(url):
     """Extract video information from xvideos.com"""
     logger.info(f"Processing XVideos URL: {url}")
     headers = {'User-Agent': get_random_user_agent()}
     
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        content = response.text
+        # Read the page only as far as needed
+        found = extractors.scan_page(url, XVIDEOS_PATTERNS, xvideos_page_complete,
+                                     headers=headers, limits=XVIDEOS_LIMITS)
         
         # Extract title
-        title_match = re.search(r'<title>(.*?)</title>', content)
-        title = title_match.group(1).strip() if title_match else "xvideos_video"
-        title = title.replace(' - XVIDEOS.COM', '').strip()
-        title = clean_filename(title)
-        
+        title = page_title(found["title"], ' - XVIDEOS.COM', "xvideos_video")
         logger.info(f"Video title: {title}")
         
-        # Find video URLs
-        video_url = None
-        extension = "mp4"  # Default extension
-        
-        # Try to find HLS (m3u8) stream
-        hls_match = re.search(r'html5player\.setVideoHLS\([\'"](.+?)[\'"]\)', content)
-        if hls_match:
-            logger.info("Found HLS stream")
-            video_url = hls_match.group(1)
-            extension = "m3u8"
-        
-        # Try to find high quality MP4
-        if not video_url:
-            high_quality_match = re.search(r'html5player\.setVideoUrlHigh\([\'"](.+?)[\'"]\)', content)
-            if high_quality_match:
-                logger.info("Found high quality MP4")
-                video_url = high_quality_match.group(1)
-                extension = "mp4"
-        
-        # Try to find low quality MP4
-        if not video_url:
-            low_quality_match = re.search(r'html5player\.setVideoUrlLow\([\'"](.+?)[\'"]\)', content)
-            if low_quality_match:
-                logger.info("Found low quality MP4")
-                video_url = low_quality_match.group(1)
-                extension = "mp4"
-        
-        # Last resort: look for any MP4 URL
-        if not video_url:
-            mp4_match = re.search(r'(https?://(?:www\.)?cdn[^\'"\s]+\.mp4[^\'"\s]*)', content)
-            if mp4_match:
-                logger.info("Found generic MP4 URL")
-                video_url = mp4_match.group(1)
-                extension = "mp4"
-        
-        if not video_url:
+        # Download the best video URL: HLS, then high and low quality MP4,
+        # then any CDN MP4 link; the others are kept as variants
+        variants = unique_variants(xvideos_variant(source) for source in
+                                   extractors.ranked(found["sources"], rank_xvideos_source))
+        if not variants:
             logger.error("No video URL found")
             return None
         
+        best = variants[0]
+        extension = best["extension"]
+        logger.info(f"Found {'HLS stream' if extension == 'm3u8' else 'MP4'} ({best['quality']})")
+        
         # Set output filename
         output_filename = f"{title}.{extension}"
         output_path = os.path.join(DOWNLOAD_DIR, output_filename)
         
         return {
             "title": title,
-            "url": video_url,
+            "url": best["url"],
             "extension": extension,
-            "output_path": output_path
+            "output_path": output_path,
+            "variants": variants
         }
         
     except Exception as e:
         logger.error(f"Error extracting XVideos info: {e}")
         return None
 
+@extractors.register('pornhub.com')
 def get_pornhub_info(url):
     """Extract video information from pornhub.com"""
     logger.info(f"Processing PornHub URL: {url}")
     headers = {'User-Agent': get_random_user_agent()}
     
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        content = response.text
+        # Read the page only as far as needed
+        found = extractors.scan_page(url, PORNHUB_PATTERNS, pornhub_page_complete,
+                                     headers=headers, limits=PORNHUB_LIMITS)
         
         # Extract title
-        title_match = re.search(r'<title>(.*?)</title>', content)
-        title = title_match.group(1).strip() if title_match else "pornhub_video"
-        title = title.replace(' - Pornhub.com', '').strip()
-        title = clean_filename(title)
-        
+        title = page_title(found["title"], ' - Pornhub.com', "pornhub_video")
         logger.info(f"Video title: {title}")
         
         # Find video URLs
         # PornHub uses a more complex system with flashvars
-        flashvars_match = re.search(r'var\s+flashvars_\d+\s*=\s*({.*?});', content, re.DOTALL)
-        if not flashvars_match:
+        if not found["flashvars"]:
             logger.error("Couldn't find flashvars data")
             return None
         
-        # Try to extract quality options
-        quality_match = re.search(r'"quality_720p":"([^"]+)"', flashvars_match.group(1))
-        if not quality_match:
-            quality_match = re.search(r'"quality_480p":"([^"]+)"', flashvars_match.group(1))
-        if not quality_match:
-            quality_match = re.search(r'"quality_240p":"([^"]+)"', flashvars_match.group(1))
-        
-        video_url = None
-        if quality_match:
-            video_url = quality_match.group(1).replace('\\/', '/')
-            extension = "mp4"
-        
-        # Try the mediaDefinitions approach if quality not found
-        if not video_url:
-            definitions_match = re.search(r'"mediaDefinitions":\[(.*?)\]', flashvars_match.group(1), re.DOTALL)
-            if definitions_match:
-                # Find highest quality MP4
-                mp4_matches = re.findall(r'"quality":"([^"]+)"[^}]+"videoUrl":"([^"]+)"', definitions_match.group(1))
-                if mp4_matches:
-                    # Sort by quality, highest first
-                    mp4_matches.sort(key=lambda x: int(x[0]) if x[0].isdigit() else 0, reverse=True)
-                    video_url = mp4_matches[0][1].replace('\\/', '/')
-                    extension = "mp4"
-        
-        if not video_url:
+        # Rank every quality option in one pass over flashvars: quality_<N>p
+        # keys by height, then mediaDefinitions entries by quality
+        flashvars = found["flashvars"][0].group(1)
+        variants = unique_variants(pornhub_variant(source) for source in
+                                   extractors.ranked(PORNHUB_SOURCES_RE.finditer(flashvars),
+                                                     rank_pornhub_source))
+        if not variants:
             logger.error("No video URL found")
             return None
         
+        extension = "mp4"
+        
         # Set output filename
         output_filename = f"{title}.{extension}"
         output_path = os.path.join(DOWNLOAD_DIR, output_filename)
         
         return {
             "title": title,
-            "url": video_url,
+            "url": variants[0]["url"],
             "extension": extension,
-            "output_path": output_path
+            "output_path": output_path,
+            "variants": variants
         }
         
     except Exception as e:
         logger.error(f"Error extracting PornHub info: {e}")
         return None
 
-def download_with_youtube_dl(url, output_path):
-    """Download video using youtube-dl"""
-    if youtube_dl is None:
+def download_with_youtube_dl(url, output_path, cancel_event=None, progress_callback=None,
+                             share=None):
+    """Download video using youtube-dl
+    
+    youtube-dl can't report to the shaper as it reads, so it gets a fixed
+    rate limit from the caps in force when it starts.
+    """
+    if not ytdl_pool.available():
         logger.error("YouTube-DL not available")
         return None
         
@@ -264,69 +838,107 @@ def download_with_youtube_dl(url, output_path):
         # Base filename (without extension)
         output_template = os.path.splitext(output_path)[0]
         
-        # YouTube-DL options
+        # YouTube-DL options; progress comes back through the pool
         ydl_opts = {
             'format': 'best[ext=mp4]/best',  # Try to get MP4, otherwise best available
             'outtmpl': output_template + '.%(ext)s',  # Output filename template
             'noplaylist': True,  # Only download single video, not playlist
-            'quiet': False,  # Show progress
-            'no_warnings': False,
             'ignoreerrors': False,
-            'noprogress': False,
             'user_agent': get_random_user_agent(),
         }
+        rate_limit = (share or bandwidth.default_shaper).rate_limit(bandwidth.host_of(url))
+        if rate_limit:
+            ydl_opts['ratelimit'] = rate_limit
         
         logger.info(f"Downloading video with youtube-dl: {url}")
         
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            
-            # Get the actual downloaded file path
-            if 'ext' in info:
-                downloaded_file = f"{output_template}.{info['ext']}"
-            else:
-                # Default to mp4 if extension not found in info
-                downloaded_file = f"{output_template}.mp4"
-            
-            if os.path.exists(downloaded_file):
-                logger.info(f"Download completed: {downloaded_file}")
-                return downloaded_file
-            else:
-                logger.error(f"Downloaded file not found: {downloaded_file}")
-                return None
+        # Runs in a warm worker process; cancelling kills the worker
+        with metrics.timed("youtube_dl"):
+            info = ytdl_pool.default_pool.download(
+                url, ydl_opts,
+                progress_hook=youtube_dl_hook(ProgressTracker(progress_callback, stage="youtube-dl")),
+                cancel_event=cancel_event)
+        
+        # Get the actual downloaded file path
+        if info.get('ext'):
+            downloaded_file = f"{output_template}.{info['ext']}"
+        else:
+            # Default to mp4 if extension not found in info
+            downloaded_file = f"{output_template}.mp4"
+        
+        if os.path.exists(downloaded_file):
+            logger.info(f"Download completed: {downloaded_file}")
+            return downloaded_file
+        else:
+            logger.error(f"Downloaded file not found: {downloaded_file}")
+            return None
     
+    except ytdl_pool.JobCancelled:
+        raise DownloadCancelled()
     except Exception as e:
         logger.error(f"YouTube-DL error: {str(e)}")
         return None
 
-def convert_m3u8_to_mp4(m3u8_url, output_path):
-    """Convert an M3U8 stream to an MP4 file using FFmpeg"""
+def hls_ffmpeg_command(m3u8_url, output_path, mode):
+    """ffmpeg command that remuxes or transcodes an HLS stream to MP4"""
+    if mode == "remux":
+        codec_args = {'codec': 'copy'}
+    else:
+        codec_args = {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'acodec': 'aac'}
+    
+    ffmpeg = load_ffmpeg()
+    if ffmpeg is not None:
+        # Build the command with the ffmpeg-python library
+        return (
+            ffmpeg
+            .input(m3u8_url)
+            .output(output_path, **codec_args)
+            .global_args('-progress', 'pipe:1', '-nostats')
+            .overwrite_output()
+            .compile()
+        )
+    
+    cmd = ['ffmpeg', '-y', '-progress', 'pipe:1', '-nostats', '-i', m3u8_url]
+    if mode == "remux":
+        cmd += ['-c', 'copy', '-bsf:a', 'aac_adtstoasc']
+    else:
+        cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-c:a', 'aac']
+    return cmd + [output_path]
+
+def convert_m3u8_to_mp4(m3u8_url, output_path, cancel_event=None, progress_callback=None,
+                        share=None):
+    """Convert an M3U8 stream to an MP4 file using FFmpeg
+    
+    Only the native segment fetcher obeys bandwidth limits; the ffmpeg
+    fallback reads the stream itself.
+    """
     try:
         logger.info(f"Converting HLS stream to MP4: {output_path}")
         
         # Make sure the output path has .mp4 extension
         mp4_output_path = os.path.splitext(output_path)[0] + '.mp4'
         
-        if ffmpeg_available:
-            # Using ffmpeg-python library
-            (
-                ffmpeg
-                .input(m3u8_url)
-                .output(mp4_output_path, codec='copy')
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            logger.info(f"FFmpeg conversion completed: {mp4_output_path}")
-        else:
-            # Using ffmpeg command
-            logger.info("Using ffmpeg command")
-            ffmpeg_cmd = [
-                'ffmpeg', '-y', '-i', m3u8_url, 
-                '-c', 'copy', 
-                '-bsf:a', 'aac_adtstoasc',
-                mp4_output_path
-            ]
-            subprocess.run(ffmpeg_cmd, check=True)
-            logger.info(f"FFmpeg command conversion completed: {mp4_output_path}")
+        # Prefer fetching segments in parallel and piping them to ffmpeg
+        try:
+            headers = {'User-Agent': get_random_user_agent()}
+            with metrics.timed("hls"):
+                with bandwidth.ensure_share(share) as share:
+                    return hls.download_hls(m3u8_url, mp4_output_path, headers=headers,
+                                            progress_callback=progress_callback,
+                                            cancel_event=cancel_event, share=share)
+        except hls.HLSUnsupported as e:
+            logger.info(f"Native HLS engine can't handle this stream ({e}), using ffmpeg")
+        except Exception as e:
+            check_cancelled(cancel_event)
+            logger.warning(f"Native HLS download failed, using ffmpeg: {e}")
+        
+        # Remux when the codecs allow it, otherwise transcode; the choice is
+        # remembered per stream on the bounded post-processing executor
+        mode = postprocess.default_processor.convert(
+            metadata_cache.normalize_url(m3u8_url),
+            lambda mode: hls_ffmpeg_command(m3u8_url, mp4_output_path, mode),
+            progress_callback, cancel_event)
+        logger.info(f"FFmpeg conversion completed ({mode}): {mp4_output_path}")
         
         if os.path.exists(mp4_output_path):
             return mp4_output_path
@@ -334,23 +946,46 @@ def convert_m3u8_to_mp4(m3u8_url, output_path):
             logger.error(f"Converted file not found: {mp4_output_path}")
             return None
             
+    except DownloadCancelled:
+        raise
     except Exception as e:
         logger.error(f"FFmpeg conversion error: {str(e)}")
         return None
 
-def get_video_info(url):
-    """Get video information based on URL"""
+def get_video_info(url, use_cache=True):
+    """Get video information based on URL, using the metadata cache"""
+    if use_cache:
+        video_info = metadata_cache.default_cache.get(url)
+        if video_info is not None:
+            logger.info(f"Using cached video info: {url}")
+            return video_info
+    
+    with metrics.timed("extract"):
+        video_info = extract_video_info(url)
+    if video_info and use_cache:
+        metadata_cache.default_cache.put(url, video_info)
+    return video_info
+
+def youtube_dl_variants(info):
+    """Quality variants of a youtube-dl result, best first"""
+    return unique_variants({
+        "quality": (f"{f['height']}p" if f.get('height')
+                    else f.get('format_note') or f.get('format_id')),
+        "url": f["url"],
+        "extension": f.get('ext'),
+    } for f in reversed(info.get('formats') or []))
+
+def extract_video_info(url):
+    """Extract video information based on URL"""
     parsed_url = urlparse(url)
-    domain = parsed_url.netloc.lower()
     
     # Handle domain-specific extraction
-    if 'xvideos.com' in domain:
-        return get_xvideos_info(url)
-    elif 'pornhub.com' in domain:
-        return get_pornhub_info(url)
+    extractor = extractors.find_extractor(parsed_url.hostname)
+    if extractor is not None:
+        return extractor(url)
     else:
         # For other sites, try generic youtube-dl approach
-        if youtube_dl is not None:
+        if ytdl_pool.available():
             # Create a temporary output path
             temp_filename = f"video_{int(time.time())}.mp4"
             output_path = os.path.join(DOWNLOAD_DIR, temp_filename)
@@ -361,31 +996,28 @@ def get_video_info(url):
                 ydl_opts = {
                     'format': 'best[ext=mp4]/best',
                     'noplaylist': True,
-                    'quiet': True,
-                    'no_warnings': True,
-                    'noprogress': True,
                 }
                 
-                with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    
-                    if info:
-                        title = info.get('title', 'video')
-                        title = clean_filename(title)
-                        
-                        # Get extension
-                        extension = info.get('ext', 'mp4')
-                        
-                        # Create proper output path
-                        output_filename = f"{title}.{extension}"
-                        output_path = os.path.join(DOWNLOAD_DIR, output_filename)
-                        
-                        return {
-                            "title": title,
-                            "url": info.get('url'),
-                            "extension": extension,
-                            "output_path": output_path
-                        }
+                # Extract in a warm worker process instead of a new YoutubeDL
+                info = ytdl_pool.default_pool.extract(url, ydl_opts)
+                
+                title = info.get('title') or 'video'
+                title = clean_filename(title)
+                
+                # Get extension
+                extension = info.get('ext') or 'mp4'
+                
+                # Create proper output path
+                output_filename = f"{title}.{extension}"
+                output_path = os.path.join(DOWNLOAD_DIR, output_filename)
+                
+                return {
+                    "title": title,
+                    "url": info.get('url'),
+                    "extension": extension,
+                    "output_path": output_path,
+                    "variants": youtube_dl_variants(info)
+                }
             except Exception as e:
                 logger.error(f"Error extracting info with youtube-dl: {e}")
                 return None
@@ -394,62 +1026,405 @@ def get_video_info(url):
         logger.error(f"Unsupported URL or failed to extract info: {url}")
         return None
 
-def download_video(url):
-    """Main function to download video from supported sites"""
+class Flight:
+    """A download that concurrent jobs for the same video share
+    
+    The job that starts it leads and does the transfer; later jobs follow,
+    receiving its progress events and linking its file when it lands.
+    """
+    
+    def __init__(self, keys):
+        self.keys = keys
+        self.done = threading.Event()
+        self.result = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.listeners = []
+    
+    def subscribe(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+    
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.listeners.remove(callback)
+    
+    def relay(self, progress_callback):
+        """Progress callback for the leader that also feeds the followers"""
+        if progress_callback is not None:
+            self.subscribe(progress_callback)
+        
+        def on_progress(event):
+            with self.lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    logger.warning(f"Progress listener failed: {e}")
+        return on_progress
+
+# Flights by normalized page and media URL
+flights = {}
+flights_lock = threading.Lock()
+
+def join_flight(urls):
+    """(flight, True) when the caller should lead a new download of urls,
+    or (the flight already in progress, False) when it should follow"""
+    keys = {metadata_cache.normalize_url(u) for u in urls if u}
+    with flights_lock:
+        for key in keys:
+            if key in flights:
+                return flights[key], False
+        flight = Flight(keys)
+        for key in keys:
+            flights[key] = flight
+        return flight, True
+
+def land_flight(flight, result, cancelled=False):
+    """Publish the leader's outcome and let new jobs start their own flights"""
+    with flights_lock:
+        for key in flight.keys:
+            if flights.get(key) is flight:
+                del flights[key]
+    flight.result = result
+    flight.cancelled = cancelled
+    flight.done.set()
+
+def follow_flight(flight, output_path, cancel_event=None, progress_callback=None):
+    """Wait for another job's download of the same video and link its file
+    
+    Returns the file's path, or None if the leader failed or was cancelled
+    (check flight.cancelled to tell them apart).
+    """
+    if progress_callback is not None:
+        flight.subscribe(progress_callback)
+    try:
+        while not flight.done.wait(FLIGHT_POLL_INTERVAL):
+            check_cancelled(cancel_event)
+    finally:
+        if progress_callback is not None:
+            flight.unsubscribe(progress_callback)
+    
+    if not flight.result:
+        return None
+    store = content_store.default_store
+    digest = store.lookup_path(flight.result)
+    if digest is None:
+        return flight.result
+    return store.materialize(digest, output_path)
+
+def download_video(url, info=None, cancel_event=None, progress_callback=None, share=None):
+    """Main function to download video from supported sites
+    
+    Pass info from an earlier get_video_info(url) call to skip extracting again.
+    progress_callback receives throttled progress events from whichever
+    download method runs; share is the job's bandwidth.Share. Returns the
+    file's path or None, and raises storage.StorageFull if it doesn't fit.
+    """
     try:
         # Create download directory if it doesn't exist
         os.makedirs(DOWNLOAD_DIR, exist_ok=True)
         
-        # Get video info
-        video_info = get_video_info(url)
+        # Get video info unless the caller already extracted it
+        video_info = info if info is not None else get_video_info(url)
         
         if not video_info:
             logger.error("Failed to extract video information")
             return None
         
-        title = video_info.get("title")
         video_url = video_info.get("url")
-        extension = video_info.get("extension")
-        output_path = video_info.get("output_path")
+        output_path = saved_path(video_info)
         
+        # Concurrent jobs for the same page or media URL share one transfer
+        while True:
+            flight, leader = join_flight((url, video_url))
+            if leader:
+                break
+            logger.info(f"Following a download of the same video already in progress: {url}")
+            result = follow_flight(flight, output_path, cancel_event, progress_callback)
+            if not flight.cancelled:
+                return result
+            # The job we followed was cancelled, so lead a new flight
+        
+        result = None
+        try:
+            # Reuse a finished object for this page or media URL before any network I/O
+            store = content_store.default_store
+            digest = store.lookup_url(url) or store.lookup_url(video_url)
+            metrics.cache_lookups.inc(cache="content_store", result="hit" if digest else "miss")
+            if digest:
+                logger.info(f"Already downloaded as object {digest[:12]}")
+                result = store.materialize(digest, output_path)
+                return result
+            
+            # Without a callback the download prints its progress and followers get none
+            result = fetch_video(url, video_info, cancel_event,
+                                 flight.relay(progress_callback) if progress_callback else None,
+                                 share)
+            return result
+        finally:
+            land_flight(flight, result, cancel_event is not None and cancel_event.is_set())
+    
+    except DownloadCancelled:
+        logger.info(f"Download cancelled: {url}")
+        return None
+    except storage.StorageFull as e:
+        logger.error(f"Error downloading video: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error downloading video: {str(e)}")
+        return None
+
+def saved_path(video_info):
+    """Path a video is saved under; HLS streams are remuxed to MP4"""
+    output_path = video_info.get("output_path")
+    if video_info.get("extension") == "m3u8":
+        return os.path.splitext(output_path)[0] + '.mp4'
+    return output_path
+
+def fetch_video(url, video_info, cancel_event=None, progress_callback=None, share=None):
+    """Download a video with the first method that works and store it
+    
+    Returns the stored file's path or None; raises DownloadCancelled.
+    """
+    title = video_info.get("title")
+    video_url = video_info.get("url")
+    extension = video_info.get("extension")
+    store = content_store.default_store
+    
+    # Don't let a different video with the same title reuse this file name
+    output_path = store.claim_path(saved_path(video_info), video_url)
+    try:
         logger.info(f"Title: {title}")
         logger.info(f"Output path: {output_path}")
         
         # Handle different file types
+        check_cancelled(cancel_event)
         if extension == "m3u8":
+            # The stream's size isn't known up front, so only check there's room
+            storage.default_manager.reserve(output_path, video_info.get("filesize") or 0,
+                                            cancel_event)
+            check_cancelled(cancel_event)
             # Convert HLS stream to MP4
-            result = convert_m3u8_to_mp4(video_url, output_path)
+            result = convert_m3u8_to_mp4(video_url, output_path, cancel_event,
+                                         progress_callback, share)
             if result:
-                return result
+                return store.ingest(result, urls=[url, video_url])
             
             # If FFmpeg conversion failed, try direct download
             logger.info("FFmpeg conversion failed, trying direct download")
         
         # Try direct download for MP4 files
         if extension == "mp4":
-            # Download video file
-            result = download_file(video_url, output_path)
+            # Download video file, hashing it on the way in
+            digests = []
+            result = download_file(video_url, output_path, cancel_event=cancel_event,
+                                   on_digest=digests.append,
+                                   progress_callback=progress_callback, share=share)
             if result:
-                return result
+                return store.ingest(result, digests[-1], urls=[url, video_url])
         
         # If all else fails, try youtube-dl
+        check_cancelled(cancel_event)
         logger.info("Regular download failed, trying youtube-dl")
-        result = download_with_youtube_dl(url, output_path)
+        storage.default_manager.reserve(output_path, video_info.get("filesize") or 0,
+                                        cancel_event)
+        check_cancelled(cancel_event)
+        result = download_with_youtube_dl(url, output_path, cancel_event, progress_callback,
+                                          share)
         if result:
-            return result
+            return store.ingest(result, urls=[url])
         
-        # If all download methods failed
+        # If all download methods failed, the cached media URL may be stale
         logger.error("All download methods failed")
+        metadata_cache.default_cache.invalidate(url)
         return None
-    
+    finally:
+        storage.default_manager.release(output_path)
+        store.release_path(output_path)
+
+def expand_url(url):
+    """Video page URLs behind a URL: a playlist's entries, or the URL itself"""
+    # Registered sites are single-video pages; playlists need youtube-dl
+    if not ytdl_pool.available() or extractors.find_extractor(urlparse(url).hostname) is not None:
+        return [url]
+    try:
+        entries = ytdl_pool.default_pool.expand(url)
     except Exception as e:
-        logger.error(f"Error downloading video: {str(e)}")
-        return None
+        logger.warning(f"Couldn't expand playlist {url}: {e}")
+        return [url]
+    if entries:
+        logger.info(f"Expanded playlist {url} to {len(entries)} videos")
+    return entries or [url]
+
+def unique_urls(urls, expand=True, seen=None):
+    """URLs in order with playlists expanded and duplicates removed
+    
+    Returns (urls, duplicates), comparing URLs the way the metadata cache does.
+    Pass the same seen set to successive calls to drop duplicates across them.
+    """
+    seen = set() if seen is None else seen
+    unique = []
+    duplicates = 0
+    for url in urls:
+        for entry in (expand_url(url) if expand else [url]):
+            key = metadata_cache.normalize_url(entry)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            unique.append(entry)
+    return unique, duplicates
+
+def print_batch_progress(event):
+    sys.stdout.write(f"\rBatch: {event['completed']}/{event['total']} done, "
+                     f"{event['failed']} failed | "
+                     f"{event['downloaded_bytes']/1024/1024:.2f} MB | "
+                     f"Speed: {event['speed']/1024/1024:.2f} MB/s")
+    sys.stdout.flush()
+
+class BatchProgress:
+    """Aggregates progress events of many downloads into batch events"""
+    
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.callback = callback or print_batch_progress
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.completed = 0
+        self.failed = 0
+        self.last_emit = 0.0
+    
+    def item_callback(self, url):
+        """Progress callback for one download of the batch"""
+        def on_progress(event):
+            with self.lock:
+                self.latest[url] = event
+            self.emit()
+        return on_progress
+    
+    def finish_item(self, url, result):
+        with self.lock:
+            # Keep finished items' bytes but drop their stale speed
+            if url in self.latest:
+                self.latest[url] = dict(self.latest[url], speed=0.0)
+            if result:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self.emit(force=True)
+    
+    def emit(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_emit < PROGRESS_INTERVAL:
+                return
+            self.last_emit = now
+            events = list(self.latest.values())
+            event = {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+                "downloaded_bytes": sum(e.get("downloaded_bytes") or 0 for e in events),
+                "total_bytes": sum(e.get("total_bytes") or 0 for e in events),
+                "speed": sum(e.get("speed") or 0 for e in events),
+            }
+        self.callback(event)
+
+def download_batch(urls, workers=None, extract_ahead=None, progress_callback=None):
+    """Download many URLs, extracting video info ahead of the download workers
+    
+    Playlists are expanded and duplicates dropped first. Extraction runs on
+    its own threads and stays at most extract_ahead videos ahead of the
+    downloads. Returns {url: file path or None}.
+    """
+    workers = workers or DOWNLOAD_WORKERS
+    extract_ahead = extract_ahead or BATCH_EXTRACT_AHEAD
+    urls, duplicates = unique_urls(urls)
+    if duplicates:
+        logger.info(f"Skipping {duplicates} duplicate URLs")
+    
+    progress = BatchProgress(len(urls), progress_callback)
+    results = {}
+    # Bounded hand-off: extraction blocks once it is far enough ahead
+    ready = queue.Queue(maxsize=extract_ahead)
+    
+    def extract(url):
+        try:
+            info = get_video_info(url)
+        except Exception as e:
+            logger.error(f"Error extracting {url}: {e}")
+            info = None
+        ready.put((url, info))
+    
+    def download_worker():
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            url, info = item
+            try:
+                result = download_video(url, info=info,
+                                        progress_callback=progress.item_callback(url)) \
+                    if info else None
+            except storage.StorageFull:
+                result = None
+            results[url] = result
+            progress.finish_item(url, result)
+    
+    threads = [threading.Thread(target=download_worker, name=f"batch-download-{i}")
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    with ThreadPoolExecutor(max_workers=min(workers, extract_ahead)) as executor:
+        for url in urls:
+            executor.submit(extract, url)
+    for _ in threads:
+        ready.put(None)
+    for thread in threads:
+        thread.join()
+    
+    if progress_callback is None:
+        print()  # New line after progress
+    return results
+
+def read_url_list(path):
+    """URLs from a file (or - for stdin), one per line, ignoring blanks and # comments"""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python video_downloader.py <url>")
+    parser = argparse.ArgumentParser(description="Download videos from supported sites")
+    parser.add_argument('urls', nargs='*', help="video or playlist URLs")
+    parser.add_argument('-f', '--file', help="file with one URL per line (- for stdin)")
+    parser.add_argument('-j', '--jobs', type=int, default=DOWNLOAD_WORKERS,
+                        help="downloads to run at the same time")
+    parser.add_argument('--extract-ahead', type=int, default=BATCH_EXTRACT_AHEAD,
+                        help="videos to extract ahead of the downloads")
+    args = parser.parse_args()
+    setup_logging()
+    
+    urls = list(args.urls)
+    if args.file:
+        urls += read_url_list(args.file)
+    if not urls:
+        parser.print_usage()
         sys.exit(1)
     
-    url = sys.argv[1]
-    download_video(url)
+    if len(urls) == 1 and not args.file:
+        try:
+            download_video(urls[0])
+        except storage.StorageFull:
+            sys.exit(1)
+    else:
+        results = download_batch(urls, args.jobs, args.extract_ahead)
+        failed = [url for url, result in results.items() if not result]
+        print(f"Downloaded {len(results) - len(failed)} of {len(results)} videos")
+        for url in failed:
+            print(f"Failed: {url}")
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import queue
+import selectors
+import threading
+import subprocess
+import importlib.util
+import logging
+
+logger = logging.getLogger('ytdl_pool')
+
+# Long-lived youtube-dl worker processes
+YTDL_WORKERS = int(os.environ.get("YTDL_WORKERS", "2"))
+
+# Jobs a worker runs before it is replaced with a fresh process
+YTDL_MAX_JOBS = int(os.environ.get("YTDL_MAX_JOBS", "50"))
+
+# Seconds without any message from a busy worker before it is considered stuck
+YTDL_STALL_TIMEOUT = int(os.environ.get("YTDL_STALL_TIMEOUT", "300"))
+
+# Idle seconds after which a worker is pinged before it gets a job
+YTDL_HEALTH_CHECK_INTERVAL = 30
+
+WORKER_START_TIMEOUT = 60
+PING_TIMEOUT = 5
+CANCEL_POLL_INTERVAL = 0.5
+
+# Minimum seconds between progress messages from a worker
+WORKER_PROGRESS_INTERVAL = 0.1
+
+# Options every worker's YoutubeDL starts from; jobs add their own on top
+BASE_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+}
+
+PROGRESS_FIELDS = ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+                   'filename')
+
+# Whether youtube_dl can be imported; checked on first use
+youtube_dl_installed = None
+
+def available():
+    """Whether youtube-dl is installed, without importing it into this process"""
+    global youtube_dl_installed
+    if youtube_dl_installed is None:
+        youtube_dl_installed = importlib.util.find_spec("youtube_dl") is not None
+    return youtube_dl_installed
+
+class WorkerError(Exception):
+    """Raised when a job fails inside youtube-dl or the worker dies"""
+
+class JobCancelled(Exception):
+    """Raised when a job's cancel_event is set; the worker is killed"""
+
+def worker_command():
+    """Command that starts a worker process running worker_main"""
+    return [sys.executable, os.path.abspath(__file__)]
+
+class Worker:
+    """A youtube-dl process speaking JSON lines over stdin/stdout"""
+
+    def __init__(self, command=None):
+        self.process = subprocess.Popen(
+            command or worker_command(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        self.buffer = b''
+        self.jobs = 0
+        self.last_used = time.time()
+
+        message = self.receive(WORKER_START_TIMEOUT)
+        if message is None or message.get("event") != "ready":
+            self.close()
+            raise WorkerError(f"youtube-dl worker failed to start: {message}")
+        logger.info(f"Started youtube-dl worker {self.process.pid}")
+
+    def send(self, message):
+        self.process.stdin.write((json.dumps(message) + '\n').encode())
+
+    def receive(self, timeout):
+        """Next message, or None on timeout; raises WorkerError if the process died"""
+        # Read raw bytes so no complete line ever sits in a buffer select() can't see
+        deadline = time.time() + timeout
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.selector.select(remaining):
+                return None
+            data = os.read(self.process.stdout.fileno(), 65536)
+            if not data:
+                raise WorkerError(f"youtube-dl worker {self.process.pid} exited")
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return json.loads(line)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def healthy(self):
+        """Liveness check, pinging workers that have been idle for a while"""
+        if not self.alive():
+            return False
+        if time.time() - self.last_used < YTDL_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            self.send({"op": "ping"})
+            message = self.receive(PING_TIMEOUT)
+            return message is not None and message.get("event") == "pong"
+        except (OSError, ValueError, WorkerError):
+            return False
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        self.selector.close()
+
+class YoutubeDLPool:
+    """Pool of warm youtube-dl worker processes
+
+    Each worker imports youtube-dl and builds its YoutubeDL instance once,
+    then serves extract and download jobs, so the setup cost isn't paid per
+    URL and the work runs outside the app's GIL. Callers wait for a free
+    worker. Workers are started on first use, pinged when they have been idle,
+    replaced after max_jobs jobs, and killed when they stall or their job is
+    cancelled.
+    """
+
+    def __init__(self, size=YTDL_WORKERS, max_jobs=YTDL_MAX_JOBS,
+                 stall_timeout=YTDL_STALL_TIMEOUT, command=None):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.stall_timeout = stall_timeout
+        # Worker command line; defaults to worker_command()
+        self.command = command
+        self.lock = threading.Lock()
+        self.workers = []
+        # Free slots; None means the slot has no running worker yet
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def warm(self):
+        """Start every worker now instead of on first use"""
+        slots = [self.idle.get() for _ in range(self.size)]
+        try:
+            slots = [worker if worker is not None and worker.alive() else self._spawn()
+                     for worker in slots]
+        finally:
+            for worker in slots:
+                self.idle.put(worker)
+
+    def extract(self, url, options=None):
+        """Info for url without downloading: title, ext and url"""
+        return self.run("extract", url, options)
+
+    def expand(self, url, options=None):
+        """Entry URLs of a playlist, or an empty list if url is a single video"""
+        return self.run("expand", url, options)["entries"]
+
+    def download(self, url, options=None, progress_hook=None, cancel_event=None):
+        """Download url; returns the info of what was downloaded"""
+        return self.run("download", url, options, progress_hook, cancel_event)
+
+    def run(self, op, url, options=None, progress_hook=None, cancel_event=None):
+        worker = self._checkout()
+        try:
+            worker.jobs += 1
+            worker.send({"op": op, "url": url, "options": options or {}})
+            last_message = time.time()
+            while True:
+                message = worker.receive(CANCEL_POLL_INTERVAL)
+                if cancel_event is not None and cancel_event.is_set():
+                    raise JobCancelled(f"youtube-dl job cancelled: {url}")
+                if message is None:
+                    if time.time() - last_message > self.stall_timeout:
+                        raise WorkerError(f"youtube-dl worker stalled for "
+                                          f"{self.stall_timeout}s: {url}")
+                    continue
+
+                last_message = time.time()
+                event = message.get("event")
+                if event == "progress":
+                    if progress_hook is not None:
+                        progress_hook(message["data"])
+                elif event == "result":
+                    return message["info"]
+                elif event == "error":
+                    # youtube-dl failed, but the worker itself is fine
+                    error = message["message"]
+                    break
+        except BaseException:
+            # The worker may be mid-job; never hand it to someone else
+            worker.close()
+            worker = None
+            raise
+        finally:
+            self._release(worker)
+        raise WorkerError(error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.size,
+                "running": sum(1 for worker in self.workers if worker.alive()),
+                "free": self.idle.qsize(),
+            }
+
+    def shutdown(self):
+        for _ in range(self.size):
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+        with self.lock:
+            self.workers = []
+
+    def _spawn(self):
+        worker = Worker(self.command)
+        with self.lock:
+            self.workers = [w for w in self.workers if w.alive()] + [worker]
+        return worker
+
+    def _checkout(self):
+        worker = self.idle.get()
+        try:
+            if worker is not None and not worker.healthy():
+                logger.warning(f"Replacing unhealthy youtube-dl worker {worker.process.pid}")
+                worker.close()
+                worker = None
+            return worker or self._spawn()
+        except BaseException:
+            self.idle.put(None)
+            raise
+
+    def _release(self, worker):
+        if worker is not None:
+            worker.last_used = time.time()
+            if worker.jobs >= self.max_jobs:
+                logger.info(f"Recycling youtube-dl worker {worker.process.pid} "
+                            f"after {worker.jobs} jobs")
+                worker.close()
+                worker = None
+        self.idle.put(worker)
+
+# Shared pool; workers start on first use
+default_pool = YoutubeDLPool()
+
+def worker_main():
+    """Entry point of a worker process"""
+    # Keep stdout for the protocol; anything youtube-dl prints goes to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send(message):
+        protocol.write(json.dumps(message) + '\n')
+
+    import youtube_dl
+    ydl = youtube_dl.YoutubeDL(dict(BASE_OPTIONS))
+    send({"event": "ready"})
+
+    last_progress = 0.0
+
+    def hook(d):
+        nonlocal last_progress
+        now = time.time()
+        if d.get('status') == 'downloading' and now - last_progress < WORKER_PROGRESS_INTERVAL:
+            return
+        last_progress = now
+        send({"event": "progress", "data": {k: d.get(k) for k in PROGRESS_FIELDS}})
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request["op"] == "ping":
+            send({"event": "pong"})
+            continue
+
+        # Reuse the warm instance with this job's options
+        ydl.params = dict(BASE_OPTIONS, **request["options"])
+        ydl._progress_hooks = [hook] if request["op"] == "download" else []
+        if request["op"] == "expand":
+            # List playlist entries without extracting each video
+            ydl.params.update({'extract_flat': 'in_playlist', 'noplaylist': False})
+        try:
+            info = ydl.extract_info(request["url"], download=(request["op"] == "download"))
+            if not info:
+                send({"event": "error", "message": "No video information returned"})
+                continue
+            if request["op"] == "expand":
+                entries = info.get('entries') or []
+                send({"event": "result", "info": {"entries": [
+                    entry.get('webpage_url') or entry.get('url')
+                    for entry in entries if entry and (entry.get('webpage_url') or entry.get('url'))
+                ]}})
+                continue
+            send({"event": "result", "info": {
+                "title": info.get('title'),
+                "ext": info.get('ext'),
+                "url": info.get('url'),
+                # Worst to best, as youtube-dl lists them
+                "formats": [{
+                    "format_id": f.get('format_id'),
+                    "format_note": f.get('format_note'),
+                    "height": f.get('height'),
+                    "ext": f.get('ext'),
+                    "url": f.get('url'),
+                } for f in info.get('formats') or [] if f.get('url')],
+            }})
+        except Exception as e:
+            send({"event": "error", "message": str(e)})
+
+if __name__ == '__main__':
+    worker_main()